@@ -18,3 +18,13 @@ condition_type_to_descriptions = {
     "icd9": f"{BASE_FOLDER}/setup_outputs/ICD9_Descriptions.csv",
     "medcat": f"{BASE_FOLDER}/setup_outputs/MedCAT_Descriptions.csv"
 }
+
+## Artifacts keyed by SUBJECT_ID can also be stored as parquet datasets (see setup_scripts/storage.py),
+## partitioned in ranges of this many subject ids
+SUBJECT_ID_PARTITION_SIZE = 10000
+
+## Binary cache of patient names / conditions used by experiments (see experiments/patient_store.py)
+PATIENT_STORE_DIR = f"{BASE_FOLDER}/setup_outputs/patient_store"
+
+## Condition codes, descriptions, wordpiece ids and frequency bins per tokenizer (see experiments/condition_catalog.py)
+CONDITION_CATALOG_DIR = f"{BASE_FOLDER}/setup_outputs/condition_catalog"
@@ -1,9 +1,15 @@
+from functools import partial
 from typing import Callable, List
 
 import numpy as np
 import torch
 from transformers import BertForMaskedLM, BertTokenizer
 
+from experiments.templates import pad_templates
+
+## Targets per comparison against the full vocab when computing ranks on device
+RANK_CHUNK_SIZE = 1024
+
 
 def get_logits_from_templates(
     model: BertForMaskedLM,
@@ -21,7 +27,6 @@ def get_logits_from_templates(
     """
 
     # assert normalize, "Logits not normalized "
-    torch.cuda.empty_cache()
     split_texts = [template.split() for template in templates]
     batch = tokenizer(
         text=split_texts,
@@ -31,8 +36,9 @@ def get_logits_from_templates(
         add_special_tokens=False,
     )
 
+    device = next(model.parameters()).device
     with torch.no_grad():
-        predictions = model(batch.input_ids.cuda(), attention_mask=batch.attention_mask.cuda())
+        predictions = model(batch.input_ids.to(device), attention_mask=batch.attention_mask.to(device))
         mask = batch.attention_mask.sum(-1)
 
         if normalize:
@@ -46,19 +52,231 @@ def get_logits_from_templates(
     return logits
 
 
+def get_target_ranks(
+    logits: torch.Tensor, target_to_row: torch.Tensor, target_ids: torch.Tensor, top_k: int = None
+) -> torch.Tensor:
+    """Return rank of wordpiece target_ids[t] in row target_to_row[t] of `logits` (P, V) (= number of wordpieces
+    with higher score), computed on the device of `logits` in chunks of RANK_CHUNK_SIZE targets.
+
+    ### Args:
+        top_k: Only compare against the top_k scores of each row (partial sort). Ranks >= top_k are
+            returned as top_k.
+    """
+    target_logits = logits[target_to_row, target_ids]
+    if top_k is not None:
+        logits = torch.topk(logits, min(top_k, logits.shape[-1]), dim=-1).values
+
+    ranks = [target_logits.new_zeros(0)]
+    for start in range(0, len(target_logits), RANK_CHUNK_SIZE):
+        chunk = slice(start, start + RANK_CHUNK_SIZE)
+        ranks.append((logits[target_to_row[chunk]] > target_logits[chunk, None]).sum(-1).float())
+
+    return torch.cat(ranks)
+
+
+def get_target_scores_from_ids(
+    model: BertForMaskedLM,
+    input_ids: torch.Tensor,
+    attention_mask: torch.Tensor,
+    target_rows: np.ndarray,
+    target_positions: np.ndarray,
+    target_ids: np.ndarray,
+    normalize: bool = True,
+    temperature: float = 1.0,
+    rank: bool = False,
+    top_k: int = None,
+) -> np.ndarray:
+    """Return MLM score of wordpiece target_ids[t] at position target_positions[t] of row target_rows[t] of the
+    (already tokenized) batch, as array of shape (n_targets,).
+
+    Only hidden states at target positions go through the MLM head, and log softmax / gather happen on the
+    model's device, so only n_targets floats are copied back (instead of batch x length x vocab).
+
+    ### Args:
+        normalize: Scores are either logits (normalize=False) or log probabilities (normalize=True)
+        temperature: Softmax temperature, only used with normalize=True
+        rank: Return rank of target wordpiece (#wordpieces with higher score at its position) instead of score
+        top_k: With rank=True, only rank among the top_k scores of each position (see get_target_ranks)
+    """
+    device = next(model.parameters()).device
+    with torch.no_grad():
+        hidden_states = model.bert(
+            input_ids.to(device), attention_mask=attention_mask.to(device)
+        ).last_hidden_state  # (B, L, H)
+
+        target_rows = torch.as_tensor(target_rows, dtype=torch.long, device=device)
+        target_positions = torch.as_tensor(target_positions, dtype=torch.long, device=device)
+        target_ids = torch.as_tensor(target_ids, dtype=torch.long, device=device)
+
+        ## Many targets share a position (e.g. all conditions of same length), run the head once per position
+        batch_size, length, hidden_size = hidden_states.shape
+        positions, target_to_position = torch.unique(
+            target_rows * length + target_positions, return_inverse=True
+        )
+
+        logits = model.cls(hidden_states.reshape(-1, hidden_size)[positions])  # (P, V)
+        ## Temperature only applies to probabilities, as in get_logits_from_templates
+        if normalize:
+            logits = torch.log_softmax(logits / temperature, dim=-1)
+
+        scores = logits[target_to_position, target_ids]
+
+        if rank:
+            scores = get_target_ranks(logits, target_to_position, target_ids, top_k=top_k)
+
+    return scores.cpu().numpy()
+
+
+def get_target_scores(
+    model: BertForMaskedLM,
+    tokenizer: BertTokenizer,
+    templates: List[str],
+    target_rows: np.ndarray,
+    target_positions: np.ndarray,
+    target_ids: np.ndarray,
+    normalize: bool = True,
+    temperature: float = 1.0,
+    rank: bool = False,
+    top_k: int = None,
+) -> np.ndarray:
+    """Same as `get_target_scores_from_ids`, for template strings (tokenized like get_logits_from_templates).
+    Use instead of get_logits_from_templates when only a few positions / wordpieces of each template are needed.
+    """
+    split_texts = [template.split() for template in templates]
+    batch = tokenizer(
+        text=split_texts,
+        is_split_into_words=True,
+        padding=True,
+        return_tensors="pt",
+        add_special_tokens=False,
+    )
+
+    return get_target_scores_from_ids(
+        model,
+        batch.input_ids,
+        batch.attention_mask,
+        target_rows,
+        target_positions,
+        target_ids,
+        normalize=normalize,
+        temperature=temperature,
+        rank=rank,
+        top_k=top_k,
+    )
+
+
+def get_token_budget_batches(lengths: np.ndarray, token_budget: int) -> List[np.ndarray]:
+    """Group row indices into batches of rows of similar length (shortest first), such that
+    #rows x max length of each batch is at most `token_budget` (a batch has at least one row).
+    """
+    order = np.argsort(lengths, kind="stable")
+    batches, start = [], 0
+    for end in range(1, len(order) + 1):
+        if end == len(order) or (end + 1 - start) * lengths[order[end]] > token_budget:
+            batches.append(order[start:end])
+            start = end
+
+    return batches
+
+
+def get_target_scores_batched(
+    model: BertForMaskedLM,
+    tokenizer: BertTokenizer,
+    templates: List[str],
+    target_rows: np.ndarray,
+    target_positions: np.ndarray,
+    target_ids: np.ndarray,
+    token_budget: int = 8192,
+    normalize: bool = True,
+    temperature: float = 1.0,
+    rank: bool = False,
+    top_k: int = None,
+) -> np.ndarray:
+    """Same as `get_target_scores`, for any number of templates (e.g. from many patients).
+    Templates are tokenized once, then scored with `get_target_scores_batched_from_ids`.
+    """
+    split_texts = [template.split() for template in templates]
+    encoded = tokenizer(text=split_texts, is_split_into_words=True, add_special_tokens=False)["input_ids"]
+
+    return get_target_scores_batched_from_ids(
+        model,
+        tokenizer,
+        encoded,
+        target_rows,
+        target_positions,
+        target_ids,
+        token_budget=token_budget,
+        normalize=normalize,
+        temperature=temperature,
+        rank=rank,
+        top_k=top_k,
+    )
+
+
+def get_target_scores_batched_from_ids(
+    model: BertForMaskedLM,
+    tokenizer: BertTokenizer,
+    encoded: List[List[int]],
+    target_rows: np.ndarray,
+    target_positions: np.ndarray,
+    target_ids: np.ndarray,
+    token_budget: int = 8192,
+    normalize: bool = True,
+    temperature: float = 1.0,
+    rank: bool = False,
+    top_k: int = None,
+) -> np.ndarray:
+    """Score targets of token id lists `encoded` (e.g. from TemplateCompiler.compile).
+
+    Templates are packed into batches of about `token_budget` tokens (see get_token_budget_batches).
+    Targets are routed to the batch holding their row, and scores are scattered back, so the result is in
+    order of the targets.
+    """
+    lengths = np.array([len(ids) for ids in encoded])
+
+    batches = get_token_budget_batches(lengths, token_budget)
+    batch_of_row = np.zeros(len(encoded), dtype=np.int64)
+    row_in_batch = np.zeros(len(encoded), dtype=np.int64)
+    for b, rows in enumerate(batches):
+        batch_of_row[rows] = b
+        row_in_batch[rows] = np.arange(len(rows))
+
+    ## Targets grouped by batch
+    target_batches = batch_of_row[target_rows]
+    target_order = np.argsort(target_batches, kind="stable")
+    boundaries = np.searchsorted(target_batches[target_order], np.arange(len(batches) + 1))
+
+    scores = np.zeros(len(target_rows), dtype=np.float32)
+    for b, rows in enumerate(batches):
+        targets = target_order[boundaries[b] : boundaries[b + 1]]
+        if len(targets) == 0:
+            continue
+
+        input_ids, attention_mask = pad_templates([encoded[row] for row in rows], tokenizer.pad_token_id)
+        scores[targets] = get_target_scores_from_ids(
+            model,
+            input_ids,
+            attention_mask,
+            row_in_batch[target_rows[targets]],
+            target_positions[targets],
+            target_ids[targets],
+            normalize=normalize,
+            temperature=temperature,
+            rank=rank,
+            top_k=top_k,
+        )
+
+    return scores
+
+
 def get_average_predicted_score(
     logits: np.ndarray, target_wordpiece_ids: List[int], start_index: int
 ) -> float:
     """Given a `logits` array of shape (Number of wordpieces, vocab size), return average
     score for the `target_wordpiece_ids`, with positions in logits array starting at `start_index`.
     """
-
-    prediction_value = 0
-    for i, token_index in enumerate(target_wordpiece_ids):
-        wordpiece_logit = logits[start_index + i][token_index]
-        prediction_value += wordpiece_logit
-
-    return float(prediction_value) / len(target_wordpiece_ids)
+    positions = start_index + np.arange(len(target_wordpiece_ids))
+    return float(logits[positions, target_wordpiece_ids].sum()) / len(target_wordpiece_ids)
 
 
 def get_average_predicted_rank(
@@ -67,19 +285,51 @@ def get_average_predicted_rank(
     """Given a `logits` array of shape (Number of wordpieces, vocab size), return average
     rank for the `target_wordpiece_ids`, with positions in logits array starting at `start_index`.
     """
+    positions = start_index + np.arange(len(target_wordpiece_ids))
+    wordpiece_logits = logits[positions, target_wordpiece_ids]
+    wordpiece_ranks = (logits[positions] > wordpiece_logits[:, None]).sum(-1)
 
-    prediction_value = 0
-    for i, token_index in enumerate(target_wordpiece_ids):
-        wordpiece_logit = logits[start_index + i][token_index]
-        wordpiece_rank = (logits[start_index + i] > wordpiece_logit).sum()
-        prediction_value += wordpiece_rank / len(target_wordpiece_ids)
+    return float((wordpiece_ranks / len(target_wordpiece_ids)).sum())
 
-    return float(prediction_value)
 
+def flatten_targets(target_ids_list: List[List[int]], start_indices: List[int]):
+    """Return (row, position, wordpiece id) arrays with one entry per target wordpiece of each row,
+    and number of targets of each row.
+    """
+    counts = np.array([len(target_ids) for target_ids in target_ids_list])
+    rows = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+    positions = np.array(start_indices, dtype=np.int64)[rows] + offsets
+    ids = np.concatenate([np.zeros(0, dtype=np.int64)] + [np.array(t, dtype=np.int64) for t in target_ids_list])
 
-def get_scoring_function(metric: str) -> Callable[[np.ndarray, List[int], int], float]:
+    return rows, positions, ids, counts
+
+
+def get_batched_average_target_score(
+    model: BertForMaskedLM,
+    tokenizer: BertTokenizer,
+    templates: List[str],
+    target_ids_list: List[List[int]],
+    start_indices: List[int],
+    normalize: bool = True,
+    rank: bool = False,
+    top_k: int = None,
+) -> np.ndarray:
+    """Batched `get_average_predicted_score` / `get_average_predicted_rank` of each template, computed
+    directly from the model with `get_target_scores_batched` (only target positions go through the MLM head).
+    Returns average score (or rank) of each template, shape (#templates,).
+    """
+    rows, positions, ids, counts = flatten_targets(target_ids_list, start_indices)
+    scores = get_target_scores_batched(
+        model, tokenizer, templates, rows, positions, ids, normalize=normalize, rank=rank, top_k=top_k
+    )
+
+    return np.bincount(rows, weights=scores, minlength=len(counts)) / counts
+
+
+def get_scoring_function(metric: str, batched: bool = False, top_k: int = None) -> Callable:
     """Returns either function `get_average_predicted_rank` or `get_average_predicted_score` on basis of
-    metric (takes value in [rank, probability]).
+    metric (takes value in [rank, logit, probability]).
 
     Either function has same declaration
     ```python
@@ -88,10 +338,25 @@ def get_scoring_function(metric: str) -> Callable[[np.ndarray, List[int], int],
 
     -- Given a `logits` array of shape (Number of wordpieces, vocab size), return average
     rank/score for the `target_wordpiece_ids`, with positions in logits array starting at `start_index`.
+
+    With batched=True, returns `get_batched_average_target_score` for the metric instead, declared as
+    ```python
+    function_name(
+        model, tokenizer, templates: List[str], target_ids_list: List[List[int]], start_indices: List[int]
+    )
+    ```
+    -- Same for all templates at once, without computing full vocab logits, returns array of shape (#templates,)
+
+    `top_k` (batched rank only) ranks targets among the top_k scores of their position (ranks capped at top_k)
     """
+    assert top_k is None or (batched and metric == "rank"), "top_k is only supported for batched rank"
     if metric in ["logit", "probability"]:
+        if batched:
+            return partial(get_batched_average_target_score, normalize=metric == "probability")
         return get_average_predicted_score
     elif metric == "rank":
+        if batched:
+            return partial(get_batched_average_target_score, normalize=False, rank=True, top_k=top_k)
         return get_average_predicted_rank
     else:
         raise NotImplementedError(f"{metric} function is not implemented")
@@ -1,5 +1,5 @@
 import argparse
-from typing import Dict, List
+from typing import List
 
 import warnings
 
@@ -8,18 +8,15 @@ warnings.filterwarnings("ignore", message=r"Passing", category=FutureWarning)
 import os
 
 import numpy as np
-from scipy.stats import spearmanr
-from experiments.MLM.common import get_average_predicted_score, get_logits_from_templates, mean_std_as_string
-from experiments.metrics import precision_at_k
+from experiments.MLM.common import get_target_scores_batched_from_ids, mean_std_as_string
+from experiments.metrics import batched_precision_at_k, batched_roc_auc, batched_spearman
+from experiments.templates import Segment, TemplateCompiler, mask_string, segments_to_string
 from experiments.utilities import (
-    filter_condition_code_by_count,
-    get_condition_code_to_count,
-    get_condition_code_to_descriptions,
-    get_condition_counts_as_vector,
-    get_condition_labels_as_vector,
+    get_condition_catalog,
+    get_condition_label_matrix,
     get_subject_id_to_patient_info,
+    PatientInfo,
 )
-from sklearn.metrics import roc_auc_score
 from tqdm import tqdm
 from transformers import BertForMaskedLM, BertTokenizer
 
@@ -29,39 +26,137 @@ from scipy.special import logsumexp
 def normalize_logits(
     condition_logits: np.ndarray, condition_baseline_freq, condition_wordpiece_lengths, set_to_use_lengths
 ):
-    condition_logits = condition_logits - logsumexp(condition_logits)
+    """Normalize condition scores within each length group. `condition_logits` is a vector of scores of all
+    conditions, or a (patients x conditions) matrix, normalized row wise.
+    """
+    condition_logits = np.asarray(condition_logits, dtype=np.float64)
+    condition_logits = condition_logits - logsumexp(condition_logits, axis=-1, keepdims=True)
     corrected_logits = np.zeros_like(condition_logits)
 
     for length in condition_wordpiece_lengths:
         mask = set_to_use_lengths == length
-        corrected_logits[mask] = (
-            condition_logits[mask]
-            - logsumexp(condition_logits[mask])
+        corrected_logits[..., mask] = (
+            condition_logits[..., mask]
+            - logsumexp(condition_logits[..., mask], axis=-1, keepdims=True)
             + np.log(condition_baseline_freq[mask].sum())
         )
 
     return corrected_logits
 
 
+def get_condition_targets(condition_wordpiece_ids: List[List[int]], condition_wordpiece_lengths: List[int]):
+    """Targets for scoring every condition in the template of its length. For each wordpiece of each condition,
+    return (template row (index in condition_wordpiece_lengths), offset from first [MASK], wordpiece id,
+    condition index) as arrays.
+    """
+    length_to_row = {length: row for row, length in enumerate(condition_wordpiece_lengths)}
+    rows, offsets, ids, conditions = [], [], [], []
+    for condition_index, wordpiece_ids in enumerate(condition_wordpiece_ids):
+        for offset, wordpiece_id in enumerate(wordpiece_ids):
+            rows.append(length_to_row[len(wordpiece_ids)])
+            offsets.append(offset)
+            ids.append(wordpiece_id)
+            conditions.append(condition_index)
+
+    return np.array(rows), np.array(offsets), np.array(ids), np.array(conditions)
+
+
+def get_average_condition_scores(target_scores: np.ndarray, target_conditions: np.ndarray, set_to_use_lengths):
+    """Average score of wordpieces of each condition (same as get_average_predicted_score per condition)"""
+    score_sums = np.bincount(target_conditions, weights=target_scores, minlength=len(set_to_use_lengths))
+    return score_sums / set_to_use_lengths
+
+
+def get_patient_condition_scores(
+    model: BertForMaskedLM,
+    tokenizer: BertTokenizer,
+    compiler: TemplateCompiler,
+    patients: List[PatientInfo],
+    template_idx: int,
+    condition_wordpiece_lengths: List[int],
+    condition_targets,
+    set_to_use_lengths: np.ndarray,
+    token_budget: int,
+) -> np.ndarray:
+    """Return average score of each condition for each patient, shape (#patients, #conditions).
+
+    Templates of all patients (one per condition wordpiece length) are packed together into token budgeted
+    batches. Row of (patient p, length row l) is p * #lengths + l.
+
+    ### Args:
+        condition_targets: Output of get_condition_targets
+    """
+    target_rows, target_offsets, target_ids, target_conditions = condition_targets
+
+    encoded, start_indices = [], []
+    for patient_info in patients:
+        for length in condition_wordpiece_lengths:
+            input_ids, spans = compiler.compile(
+                name_with_condition_segments(
+                    patient_info.FIRST_NAME, patient_info.LAST_NAME, patient_info.GENDER, length, template_idx
+                )
+            )
+            encoded.append(input_ids)
+        ## Condition starts at same position in all templates of a patient
+        start_indices.append(spans["condition"][0])
+    start_indices = np.array(start_indices)
+
+    ## Targets of all patients, shape (#patients, #targets)
+    rows = np.arange(len(patients))[:, None] * len(condition_wordpiece_lengths) + target_rows[None, :]
+    positions = start_indices[:, None] + target_offsets[None, :]
+    ids = np.broadcast_to(target_ids[None, :], rows.shape)
+
+    target_scores = get_target_scores_batched_from_ids(
+        model, tokenizer, encoded, rows.ravel(), positions.ravel(), ids.ravel(), token_budget=token_budget
+    ).reshape(rows.shape)
+
+    return np.stack(
+        [
+            get_average_condition_scores(scores, target_conditions, set_to_use_lengths)
+            for scores in target_scores
+        ]
+    )
+
+
+def condition_only_segments(condition_length: int) -> List[Segment]:
+    """Segments of empty template with condition replaces with [MASK] string of `condition_length`"""
+    return ["[CLS]", ("condition", mask_string(condition_length)), "[SEP]"]
+
+
 def condition_only_template(condition_length: int) -> str:
     """Generate empty template with condition replaces with [MASK] string of `condition_length`"""
-    mask_string = "[MASK] " * condition_length
-    return f"[CLS] {mask_string.strip()} [SEP]"
+    return segments_to_string(condition_only_segments(condition_length))
+
+
+TEMPLATE_CHOICES = {
+    0: "is a yo patient with",
+    1: "is a m with",
+    2: "is a year old female with",
+    3: "is a yo male with",
+}
+
+
+def name_with_condition_segments(
+    first_name: str, last_name: str, gender: str, condition_length: int, template_idx: int
+) -> List[Segment]:
+    """Segments of filled template with condition replaces with [MASK] string of `condition_length`"""
+    title = "Mr" if gender == "M" else "Mrs"  # I guess just assume married w/e idk ?
+    return [
+        f"[CLS] {title}",
+        ("name", f"{first_name} {last_name}"),
+        TEMPLATE_CHOICES[template_idx],
+        ("condition", mask_string(condition_length)),
+        "[SEP]",
+    ]
 
 
 def name_with_condition_template(
     first_name: str, last_name: str, gender: str, condition_length: int, template_idx: int
 ) -> str:
     """Generate filled template with condition replaces with [MASK] string of `condition_length`"""
-    title = "Mr" if gender == "M" else "Mrs"  # I guess just assume married w/e idk ?
-    mask_string = "[MASK] " * condition_length
-    template_choices = {
-        0: f"[CLS] {title} {first_name} {last_name} is a yo patient with {mask_string.strip()} [SEP]",
-        1: f"[CLS] {title} {first_name} {last_name} is a m with {mask_string.strip()} [SEP]",
-        2: f"[CLS] {title} {first_name} {last_name} is a year old female with {mask_string.strip()} [SEP]",
-        3: f"[CLS] {title} {first_name} {last_name} is a yo male with {mask_string.strip()} [SEP]",
-    }
-    return template_choices[template_idx]
+    return segments_to_string(
+        name_with_condition_segments(first_name, last_name, gender, condition_length, template_idx)
+    )
 
 
 def evaluate(
@@ -71,6 +166,8 @@ def evaluate(
     template_idx: int,
     max_count: int,
     metrics_output_path: str,
+    token_budget: int = 8192,
+    patients_per_batch: int = 128,
 ):
     """
     Evaluate the performance of the model in terms of being able to predict
@@ -93,71 +190,64 @@ def evaluate(
     ### Args:
         condition_type: Which conditions to load for patients. Currently take value in [icd9, medcat]
         template: Which template to use for probing the model.
+        token_budget: Max #templates x padded length in a forward pass (templates of many patients are batched)
+        patients_per_batch: How many patients' templates are tokenized and packed together
     """
 
     ### Load relevant data
 
     subject_id_to_patient_info = get_subject_id_to_patient_info(condition_type=condition_type)
-    condition_code_to_count = get_condition_code_to_count(condition_type=condition_type)
-    condition_code_to_description = get_condition_code_to_descriptions(condition_type=condition_type)
+    catalog = get_condition_catalog(condition_type, tokenizer)
 
-    set_to_use = filter_condition_code_by_count(condition_code_to_count, min_count=0, max_count=max_count)
+    condition_rows = catalog.select(min_count=0, max_count=max_count)
+    set_to_use = catalog.get_set_to_use(min_count=0, max_count=max_count)
 
     print(len(set_to_use))
-    condition_code_to_index: Dict[str, int] = dict(zip(set_to_use, range(len(set_to_use))))
+    label_matrix = get_condition_label_matrix(condition_type, set_to_use)
 
     ### Get list of unique condition lengths (in wordpieces) to generate templates
 
-    condition_code_to_wordpiece_ids: Dict[str, List[str]] = {
-        condition: tokenizer.convert_tokens_to_ids(
-            tokenizer.tokenize(condition_code_to_description[condition])
-        )
-        for condition in set_to_use
-    }  ## Time Saving Measure since we only need condition wordpiece ids moving forward
-
-    condition_wordpiece_lengths = [
-        len(condition_code_to_wordpiece_ids[condition]) for condition in set_to_use
-    ]
+    set_to_use_lengths = np.asarray(catalog.wordpiece_lengths[condition_rows])
 
     from collections import Counter
 
-    print(sorted(list(Counter(condition_wordpiece_lengths).items())))
-    set_to_use_lengths = np.array(condition_wordpiece_lengths)
+    print(sorted(list(Counter(set_to_use_lengths.tolist()).items())))
 
     condition_wordpiece_lengths: List[int] = sorted(
-        list(set(condition_wordpiece_lengths))
+        list(set(set_to_use_lengths.tolist()))
     )  ## Keep Unique Lengths only
 
+    target_rows, target_offsets, target_ids, target_conditions = get_condition_targets(
+        catalog.get_wordpiece_ids(condition_rows), condition_wordpiece_lengths
+    )
+
     ### Get Condition Frequency counts
 
-    condition_baseline_counts = np.array(
-        get_condition_counts_as_vector(condition_code_to_count, condition_code_to_index)
-    )
+    condition_baseline_counts = label_matrix.counts
     condition_baseline_freq = condition_baseline_counts / np.sum(condition_baseline_counts)
 
     ### Get Condition only template logits
 
     ## Generate Template for each unique condition wordpiece length
-    condition_only_templates = [condition_only_template(length) for length in condition_wordpiece_lengths]
-
-    logits = get_logits_from_templates(model, tokenizer, condition_only_templates, normalize=True)
-    logits = {length: logit for length, logit in zip(condition_wordpiece_lengths, logits)}
+    compiler = TemplateCompiler(tokenizer)
+    condition_only_templates = [
+        compiler.compile(condition_only_segments(length)) for length in condition_wordpiece_lengths
+    ]
 
     # Isn't the start index always 1 here? Yes. This is to keep code consistent.
-    start_indices = [tokenizer.tokenize(template).index("[MASK]") for template in condition_only_templates]
-    start_indices = {
-        length: start_index for length, start_index in zip(condition_wordpiece_lengths, start_indices)
-    }
-
-    condition_only_logits: List[float] = []
-    for condition in set_to_use:
-        condition_wp_ids = condition_code_to_wordpiece_ids[condition]
-        condition_length = len(condition_wp_ids)
-        condition_only_logits.append(
-            get_average_predicted_score(
-                logits[condition_length], condition_wp_ids, start_indices[condition_length]
-            )
-        )
+    start_indices = np.array([spans["condition"][0] for _, spans in condition_only_templates])
+
+    target_positions = start_indices[target_rows] + target_offsets
+    target_scores = get_target_scores_batched_from_ids(
+        model,
+        tokenizer,
+        [input_ids for input_ids, _ in condition_only_templates],
+        target_rows,
+        target_positions,
+        target_ids,
+        token_budget=token_budget,
+    )
+    condition_only_logits = get_average_condition_scores(target_scores, target_conditions, set_to_use_lengths)
 
     condition_only_logits = normalize_logits(
         condition_only_logits, condition_baseline_freq, condition_wordpiece_lengths, set_to_use_lengths
@@ -177,10 +267,7 @@ def evaluate(
             precisions_at_k[length]["bin_prob"] = []
             spearmans[length]["bin_prob"] = []
 
-    patient_to_run = [
-        sum(get_condition_labels_as_vector(patient_info.CONDITIONS, condition_code_to_index)) > 0
-        for subject_id, patient_info in subject_id_to_patient_info.items()
-    ]
+    patient_to_run = label_matrix.get_num_positives() > 0
 
     print(sum(patient_to_run))
 
@@ -189,107 +276,65 @@ def evaluate(
         mask = set_to_use_lengths == length
         condition_bin_prob_baselines[mask] = condition_baseline_freq[mask].mean()
 
-    for subject_id, patient_info in tqdm(subject_id_to_patient_info.items()):
-        condition_labels = get_condition_labels_as_vector(patient_info.CONDITIONS, condition_code_to_index)
-        condition_labels = np.array(condition_labels)
+    length_masks = label_matrix.get_column_masks(set_to_use_lengths)
 
-        if condition_labels.sum() == 0:
-            continue  ## Skip if patient is negative for all conditions
+    ## Patients with at least one positive condition, scored in groups of `patients_per_batch`
+    patients_to_run = [
+        (subject_id, patient_info)
+        for subject_id, patient_info in subject_id_to_patient_info.items()
+        if patient_to_run[label_matrix.subject_id_to_row[subject_id]]
+    ]
 
-        ## Generate Template for each unique condition wordpiece length
-        templates = []
-        for length in condition_wordpiece_lengths:
-            template = name_with_condition_template(
-                patient_info.FIRST_NAME, patient_info.LAST_NAME, patient_info.GENDER, length, template_idx
-            )
-            templates.append(template)
-
-        ## Get logits for all templates
-        logits = get_logits_from_templates(model, tokenizer, templates, normalize=True)
-        logits = {length: logit for length, logit in zip(condition_wordpiece_lengths, logits)}
-
-        ## Get Start index for (masked) condition in each template
-        ## Not sure we need to do this for all templates? -> Once we have the index of the mask of one, it should be the same for all?
-        start_indices = [tokenizer.tokenize(template).index("[MASK]") for template in templates]
-        start_indices = {
-            length: start_index for length, start_index in zip(condition_wordpiece_lengths, start_indices)
-        }
-
-        ## For each condition, get corresponding logit array and then compute average score
-        condition_subject_logits = []
-        for condition in set_to_use:
-            condition_wp_ids = condition_code_to_wordpiece_ids[condition]
-            condition_length = len(condition_wp_ids)
-            condition_subject_logits.append(
-                get_average_predicted_score(
-                    logits[condition_length], condition_wp_ids, start_indices[condition_length]
-                )
-            )
+    for b in tqdm(range(0, len(patients_to_run), patients_per_batch)):
+        batch = patients_to_run[b : b + patients_per_batch]
+        batch_condition_scores = get_patient_condition_scores(
+            model,
+            tokenizer,
+            compiler,
+            [patient_info for _, patient_info in batch],
+            template_idx,
+            condition_wordpiece_lengths,
+            (target_rows, target_offsets, target_ids, target_conditions),
+            set_to_use_lengths,
+            token_budget,
+        )
 
-        condition_subject_logits = normalize_logits(
-            condition_subject_logits, condition_baseline_freq, condition_wordpiece_lengths, set_to_use_lengths
+        batch_condition_scores = normalize_logits(
+            batch_condition_scores, condition_baseline_freq, condition_wordpiece_lengths, set_to_use_lengths
         )
+        batch_labels = label_matrix.get_rows([subject_id for subject_id, _ in batch]).toarray()
 
+        ### Calculate and store metrics for all patients in batch, per length bin
         for length in condition_wordpiece_lengths + ["all"]:
-            mask = (
-                set_to_use_lengths == length
-                if length != "all"
-                else np.full_like(set_to_use_lengths, True, dtype=bool)
-            )
-            length_condition_baseline_counts = condition_baseline_counts[mask]
-            length_condition_only_logits = condition_only_logits[mask]
-            length_condition_subject_logits = condition_subject_logits[mask]
-            length_condition_labels = condition_labels[mask]
-
-            if length_condition_labels.sum() == 0 or mask.sum() < 2:
-                ## If patient doesn't have any positive condition or only one condition in bin
+            mask = length_masks[length]
+            if mask.sum() < 2:
+                continue  ## Only one condition in bin
+
+            ## Skip patients without any positive (or negative) condition in bin
+            length_labels = batch_labels[:, mask]
+            length_num_positives = length_labels.sum(-1)
+            valid = (length_num_positives > 0) & (length_num_positives < mask.sum())
+            if not valid.any():
                 continue
 
-            ### Calculate and store metrics for this patient
-            _baseline_roc = roc_auc_score(length_condition_labels, length_condition_baseline_counts)
-            _condition_only_roc = roc_auc_score(length_condition_labels, length_condition_only_logits)
-            _model_roc = roc_auc_score(length_condition_labels, length_condition_subject_logits)
-
-            rocs[length]["baseline"].append(_baseline_roc)
-            rocs[length]["condition_only"].append(_condition_only_roc)
-            rocs[length]["model"].append(_model_roc)
-
-            _baseline_spearman = spearmanr(
-                length_condition_baseline_counts, length_condition_baseline_counts
-            ).correlation
-            _condition_only_spearman = spearmanr(
-                length_condition_baseline_counts, length_condition_only_logits
-            )
-            _model_spearman = spearmanr(length_condition_baseline_counts, length_condition_subject_logits)
-
-            spearmans[length]["baseline"].append(_baseline_spearman)
-            spearmans[length]["condition_only"].append(_condition_only_spearman)
-            spearmans[length]["model"].append(_model_spearman)
-
-            _model_precision_at_k = precision_at_k(
-                length_condition_labels, length_condition_subject_logits, k
-            )
-            _condition_only_precision_at_k = precision_at_k(
-                length_condition_labels, length_condition_only_logits, k
-            )
-            _baseline_precision_at_k = precision_at_k(
-                length_condition_labels, length_condition_baseline_counts, k
-            )
-
-            precisions_at_k[length]["baseline"].append(_baseline_precision_at_k)
-            precisions_at_k[length]["condition_only"].append(_condition_only_precision_at_k)
-            precisions_at_k[length]["model"].append(_model_precision_at_k)
+            length_labels = length_labels[valid]
+            length_condition_baseline_counts = condition_baseline_counts[mask]
 
+            ## Baselines are the same for every patient, and broadcast against labels
+            method_scores = {
+                "baseline": length_condition_baseline_counts,
+                "condition_only": condition_only_logits[mask],
+                "model": batch_condition_scores[valid][:, mask],
+            }
             if length == "all":
-                rocs[length]["bin_prob"].append(
-                    roc_auc_score(length_condition_labels, condition_bin_prob_baselines)
-                )
-                spearmans[length]["bin_prob"].append(
-                    spearmanr(length_condition_baseline_counts, condition_bin_prob_baselines).correlation
-                )
-                precisions_at_k[length]["bin_prob"].append(
-                    precision_at_k(length_condition_labels, condition_bin_prob_baselines, k)
-                )
+                method_scores["bin_prob"] = condition_bin_prob_baselines
+
+            for method, scores in method_scores.items():
+                rocs[length][method] += batched_roc_auc(length_labels, scores).tolist()
+                paks = batched_precision_at_k(length_labels, scores, k)
+                precisions_at_k[length][method] += paks.tolist()
+                spearman = batched_spearman(length_condition_baseline_counts, scores)
+                spearmans[length][method] += np.broadcast_to(spearman, (len(length_labels),)).tolist()
 
     ### Computing and print metrics (averaged over patients)
     with open(f"{metrics_output_path}/results.txt", "w") as f:
@@ -327,11 +372,13 @@ if __name__ == "__main__":
         "--template-idx", help="Which template to select", choices=[0, 1, 2, 3], type=int, required=True
     )
     parser.add_argument("--max-count", type=int, default=500000)
+    parser.add_argument("--token-budget", type=int, default=8192, help="Max tokens (rows x length) per batch")
+    parser.add_argument("--device", type=str, default="cuda")
     parser.add_argument("--metrics-output-path", type=str)
 
     args = parser.parse_args()
     tokenizer = BertTokenizer.from_pretrained(args.tokenizer)
-    model = BertForMaskedLM.from_pretrained(args.model).cuda().eval()
+    model = BertForMaskedLM.from_pretrained(args.model).to(args.device).eval()
 
     metrics_output_path = args.metrics_output_path if args.metrics_output_path is not None else args.model
 
@@ -343,4 +390,12 @@ if __name__ == "__main__":
 
     print(metrics_output_path)
 
-    evaluate(model, tokenizer, args.condition_type, args.template_idx, args.max_count, metrics_output_path)
+    evaluate(
+        model,
+        tokenizer,
+        args.condition_type,
+        args.template_idx,
+        args.max_count,
+        metrics_output_path,
+        token_budget=args.token_budget,
+    )
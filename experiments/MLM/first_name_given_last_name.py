@@ -2,15 +2,29 @@ import argparse
 from typing import List
 
 import numpy as np
-from experiments.MLM.common import (get_logits_from_templates,
-                                    get_scoring_function)
+from experiments.MLM.common import flatten_targets, get_target_scores_batched_from_ids
+from experiments.templates import Segment, TemplateCompiler, mask_string, segments_to_string
 from experiments.utilities import get_patient_name_to_is_reidentified
 from tqdm import tqdm
 from transformers import BertForMaskedLM, BertTokenizer
 
 
 def generate_masked_template(tokenizer: BertTokenizer, name: str) -> str:
-    return "[CLS] {} [SEP]".format("[MASK] " * len(tokenizer.tokenize(name)))
+    return segments_to_string(masked_segments(len(tokenizer.tokenize(name))))
+
+
+def masked_segments(name_length: int) -> List[Segment]:
+    return ["[CLS]", ("target", mask_string(name_length)), "[SEP]"]
+
+
+def template_segments(first_name: str, last_name: str, target_length: int, mode: str) -> List[Segment]:
+    """Segments of generate_template, with masked name of `target_length` wordpieces as "target" segment"""
+    if mode == "mask_first":
+        return ["[CLS]", ("target", mask_string(target_length)), last_name, "[SEP]"]
+    elif mode == "mask_last":
+        return ["[CLS]", first_name, ("target", mask_string(target_length)), "[SEP]"]
+    else:
+        raise NotImplementedError(f"{mode} is not available")
 
 
 def generate_template(tokenizer: BertTokenizer, first_name: str, last_name: str, mode: str) -> str:
@@ -21,17 +35,18 @@ def generate_template(tokenizer: BertTokenizer, first_name: str, last_name: str,
     @param mode will determine if we mask out first or last name.
     @return the template to be encoded (with MASKs).
     """
-    if mode == "mask_first":
-        tok_name = tokenizer.tokenize(first_name)
-        mask_string = "[MASK] " * len(tok_name)
-        return f"[CLS] {mask_string.strip()} {last_name} [SEP]"
-    elif mode == "mask_last":
-        tok_name = tokenizer.tokenize(last_name)
-        mask_string = "[MASK] " * len(tok_name)
-        return f"[CLS] {first_name} {mask_string.strip()} [SEP]"
-
-
-def evaluate(model: BertForMaskedLM, tokenizer: BertTokenizer, mode: str, metric: str, metrics_output_path):
+    target_length = len(tokenizer.tokenize(first_name if mode == "mask_first" else last_name))
+    return segments_to_string(template_segments(first_name, last_name, target_length, mode))
+
+
+def evaluate(
+    model: BertForMaskedLM,
+    tokenizer: BertTokenizer,
+    mode: str,
+    metric: str,
+    metrics_output_path,
+    token_budget: int = 8192,
+):
     """Evaluate the performance of the model in terms of being able to predict
     conditons associated with certain names (via templates).
     @param model is the BERT model to encode with.
@@ -39,12 +54,15 @@ def evaluate(model: BertForMaskedLM, tokenizer: BertTokenizer, mode: str, metric
     @param tokenizer is the BERT tokenizer.
     @param stanza is whether or not we use stanza conditions
     @param mode is if we do this normally or mask out everything.
+    @param metric is rank or probability, computed on the model's device.
+    @param token_budget is max #templates x padded length in a forward pass.
     """
 
     patient_name_to_reidentified = get_patient_name_to_is_reidentified()
 
+    compiler = TemplateCompiler(tokenizer)
     filled_templates = []
-    masked_templates = []
+    name_lengths = []
     target_ids_list = []
     start_indices = []
     labels = []
@@ -54,57 +72,64 @@ def evaluate(model: BertForMaskedLM, tokenizer: BertTokenizer, mode: str, metric
         if len(first_name) == 0 or len(last_name) == 0:
             continue
 
-        filled_template = generate_template(tokenizer, first_name, last_name, mode)
-        filled_templates.append(filled_template)
-        masked_templates.append(generate_masked_template(tokenizer, name))
+        first_name_ids, last_name_ids = compiler.encode(first_name), compiler.encode(last_name)
+        target_name_ids = first_name_ids if mode == "mask_first" else last_name_ids
+        segments = template_segments(first_name, last_name, len(target_name_ids), mode)
+        input_ids, spans = compiler.compile(segments)
+        filled_templates.append(input_ids)
 
-        assert len(tokenizer.tokenize(filled_templates[-1])) == len(
-            tokenizer.tokenize(masked_templates[-1])
-        ), breakpoint()
+        ## Masked template has a [MASK] per wordpiece of full name (same length as filled template)
+        name_lengths.append(len(first_name_ids) + len(last_name_ids))
 
-        target = first_name if mode == "mask_first" else last_name
-        target_ids: List[int] = tokenizer.convert_tokens_to_ids(tokenizer.tokenize(target))
-        target_ids_list.append(target_ids)
-
-        start_index = tokenizer.tokenize(filled_template).index("[MASK]")
-        start_indices.append(start_index)
+        target_ids_list.append(target_name_ids)
+        start_indices.append(spans["target"][0])
 
         labels.append(is_reidentified)
 
-    scoring_function = get_scoring_function(metric)
+    ## One target per wordpiece of each name : (name row, position, wordpiece id)
+    target_rows, target_positions, target_ids, target_counts = flatten_targets(target_ids_list, start_indices)
 
-    score_difference = []
+    average_per_name = lambda target_scores: (
+        np.bincount(target_rows, weights=target_scores, minlength=len(labels)) / target_counts
+    )
+    rank = metric == "rank"
 
-    batch_size = 100
-    for b in tqdm(range(0, len(labels), batch_size)):
-        filled_logits = get_logits_from_templates(
-            model, tokenizer, filled_templates[b : b + batch_size], normalize=True
-        )
-        masked_logits = get_logits_from_templates(
-            model, tokenizer, masked_templates[b : b + batch_size], normalize=True
+    ## Filled templates, batched by length
+    filled_scores = get_target_scores_batched_from_ids(
+        model, tokenizer, filled_templates, target_rows, target_positions, target_ids, token_budget, rank=rank
+    )
+    filled_scores = average_per_name(filled_scores)
+
+    ## Masked template only depends on name length, so run it once per distinct length
+    name_lengths = np.array(name_lengths)
+    target_name_lengths = name_lengths[target_rows]
+    masked_scores = np.zeros(len(target_rows), dtype=np.float32)
+    for length in tqdm(np.unique(name_lengths)):
+        targets = np.flatnonzero(target_name_lengths == length)
+        input_ids, spans = compiler.compile(masked_segments(length))
+        ## Full name starts after [CLS] in filled and masked templates, so target positions are the same
+        assert spans["target"][0] == 1
+        masked_scores[targets] = get_target_scores_batched_from_ids(
+            model,
+            tokenizer,
+            [input_ids],
+            np.zeros(len(targets), dtype=np.int64),
+            target_positions[targets],
+            target_ids[targets],
+            token_budget,
+            rank=rank,
         )
+    masked_scores = average_per_name(masked_scores)
 
-        batch_start_indices = start_indices[b : b + batch_size]
-        batch_target_ids_list = target_ids_list[b : b + batch_size]
-
-        for i in range(len(batch_start_indices)):
-            filled_score = scoring_function(
-                filled_logits[i], batch_target_ids_list[i], batch_start_indices[i]
-            )
-            masked_score = scoring_function(
-                masked_logits[i], batch_target_ids_list[i], batch_start_indices[i]
-            )
-            score_difference.append(np.exp(filled_score) - np.exp(masked_score))
-
-    score_difference = np.array(score_difference)
+    score_difference = np.exp(filled_scores) - np.exp(masked_scores)
     labels = np.array(labels)
 
     from sklearn.metrics import roc_auc_score
     from experiments.metrics import precision_at_k
 
     with open(f"{metrics_output_path}/results.txt", "w") as f :
-        f.write(roc_auc_score(labels, score_difference))  
-        f.write(precision_at_k(labels, score_difference, k=50))
+        f.write(f"AUC {roc_auc_score(labels, score_difference)}\n")
+        f.write(f"P@50 {precision_at_k(labels, score_difference, k=50)}\n")
 
 
 if __name__ == "__main__":
@@ -115,6 +140,7 @@ if __name__ == "__main__":
     parser.add_argument(
         "--metric", help="Which metric to calculate ?", choices=["rank", "probability"], required=True
     )
+    parser.add_argument("--token-budget", type=int, default=8192, help="Max tokens (rows x length) per batch")
     parser.add_argument("--metrics-output-path", type=str)
     args = parser.parse_args()
 
@@ -127,4 +153,4 @@ if __name__ == "__main__":
     metrics_output_path = os.path.join(metrics_output_path, f"first_name_given_last_name/{args.mode}_{args.metric}")
     os.makedirs(metrics_output_path, exist_ok=True)
 
-    evaluate(model, tokenizer, args.mode, args.metric, metrics_output_path)
+    evaluate(model, tokenizer, args.mode, args.metric, metrics_output_path, args.token_budget)
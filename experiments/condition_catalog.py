@@ -0,0 +1,183 @@
+"""
+Condition Catalog
+=================
+
+Everything experiments need about the conditions of a condition type, for a given tokenizer, built once and
+stored in config.CONDITION_CATALOG_DIR as a folder of .npy files (memory mapped on load):
+
+    - codes: condition codes of the patient store (sorted, single character codes excluded, same as
+      utilities.filter_condition_code_by_count) and their index into PatientStore.get_codes()
+    - descriptions, and their wordpiece ids (ragged: flat ids + offsets) / wordpiece length
+    - count of occurrence (same as utilities.get_condition_code_to_count) and frequency bin
+
+Rows are in the order of `set_to_use` of the experiments, so all experiments select conditions (`select`)
+from the same ordering. The catalog is rebuilt when the patient store or the tokenizer vocabulary changes.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from typing import List
+
+import config
+import numpy as np
+
+from experiments.patient_store import PatientStore, pack_strings, unpack_strings
+
+CATALOG_VERSION = 1
+
+NUM_FREQUENCY_BINS = 5
+
+
+def get_frequency_bin_indices(counts: np.ndarray, condition_type: str, max_count: int = None) -> np.ndarray:
+    """Frequency bin (0 to NUM_FREQUENCY_BINS - 1) of each count, -1 if above the last bin.
+
+    ### Args:
+        counts: Count of occurrence of each condition
+        condition_type: icd9 bins have fixed cut offs, medcat bins split [0, max_count] evenly
+        max_count: Largest count over all conditions (default counts.max())
+    """
+    counts = np.asarray(counts)
+    if condition_type == "medcat":
+        max_count = counts.max() if max_count is None else max_count
+        bin_cut_offs = np.array(
+            [max_count / NUM_FREQUENCY_BINS * i + 1 for i in range(1, NUM_FREQUENCY_BINS + 1)]
+        )
+    elif condition_type == "icd9":
+        bin_cut_offs = np.array([3, 5, 10, 20, 10000])
+    else:
+        raise NotImplementedError(f"No frequency bins for {condition_type}")
+
+    ## First bin with count <= cut off
+    bins = np.searchsorted(bin_cut_offs, counts, side="left")
+    return np.where(bins < NUM_FREQUENCY_BINS, bins, -1)
+
+
+def get_tokenizer_signature(tokenizer) -> str:
+    vocab = sorted(tokenizer.get_vocab().items(), key=lambda item: item[1])
+    key = json.dumps([getattr(tokenizer, "do_lower_case", None), vocab])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+
+class ConditionCatalog:
+    """Conditions of `condition_type` with descriptions tokenized by `tokenizer`.
+
+    ### Args:
+        condition_type: Takes value in config.condition_type_to_file
+        tokenizer: HuggingFace tokenizer of the model used by the experiment
+        store: PatientStore of condition_type (see utilities.get_patient_store)
+    """
+
+    def __init__(self, condition_type: str, tokenizer, store: PatientStore, catalog_dir: str = None):
+        assert (
+            condition_type in config.condition_type_to_file
+        ), f"Unknown Condition type, Select From {list(config.condition_type_to_file.keys())}"
+
+        self.condition_type = condition_type
+        self.catalog_dir = catalog_dir if catalog_dir is not None else config.CONDITION_CATALOG_DIR
+
+        key = json.dumps(
+            [CATALOG_VERSION, os.path.basename(store.get_store_file()), get_tokenizer_signature(tokenizer)]
+        )
+        key = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+        path = os.path.join(self.catalog_dir, f"{condition_type}-{key}")
+        if not os.path.exists(path):
+            self.build(path, tokenizer, store)
+
+        self.arrays = {
+            name[: -len(".npy")]: np.load(os.path.join(path, name), mmap_mode="r")
+            for name in os.listdir(path)
+            if name.endswith(".npy")
+        }
+
+    def build(self, path: str, tokenizer, store: PatientStore):
+        print(f"Building condition catalog {path}")
+        arrays = {}
+
+        store_codes = store.get_codes()
+        code_indices = [i for i, code in enumerate(store_codes) if len(code) != 1]
+        codes = [store_codes[i] for i in code_indices]
+        arrays["code_indices"] = np.array(code_indices, dtype=np.int64)
+        arrays["codes"], arrays["codes_offsets"] = pack_strings(codes)
+
+        code_to_description = dict(zip(*store.get_descriptions()))
+        descriptions = [code_to_description.get(code, "") for code in codes]
+        arrays["descriptions"], arrays["descriptions_offsets"] = pack_strings(descriptions)
+
+        ## Same ids as tokenizer.convert_tokens_to_ids(tokenizer.tokenize(description)), in one batched call
+        wordpiece_ids = tokenizer(descriptions, add_special_tokens=False)["input_ids"] if len(codes) > 0 else []
+        lengths = np.array([len(ids) for ids in wordpiece_ids], dtype=np.int64)
+        arrays["wordpiece_lengths"] = lengths
+        arrays["wordpiece_offsets"] = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        arrays["wordpiece_ids"] = np.array([i for ids in wordpiece_ids for i in ids], dtype=np.int64)
+
+        counts = store.code_counts[arrays["code_indices"]]
+        arrays["counts"] = counts
+        ## Bins are over counts of all codes (as get_frequency_bins of condition_code_to_count)
+        arrays["frequency_bins"] = get_frequency_bin_indices(
+            counts, self.condition_type, max_count=store.code_counts.max() if len(store.code_counts) else 0
+        )
+
+        ## Folder of this process only, so concurrent builders (e.g. one job per frequency bin) never touch each
+        ## other's files. The first to finish publishes its catalog, the others discard their identical copy.
+        os.makedirs(self.catalog_dir, exist_ok=True)
+        tmp_path = f"{path}.tmp-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        os.makedirs(tmp_path)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, f"{name}.npy"), array)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+            shutil.rmtree(tmp_path)
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    @property
+    def code_indices(self) -> np.ndarray:
+        """Index of each condition into PatientStore.get_codes()"""
+        return self.arrays["code_indices"]
+
+    @property
+    def counts(self) -> np.ndarray:
+        return self.arrays["counts"]
+
+    @property
+    def wordpiece_lengths(self) -> np.ndarray:
+        return self.arrays["wordpiece_lengths"]
+
+    @property
+    def frequency_bins(self) -> np.ndarray:
+        """Frequency bin of each condition, -1 if not in any bin (see get_frequency_bin_indices)"""
+        return self.arrays["frequency_bins"]
+
+    def get_codes(self) -> List[str]:
+        return unpack_strings(self.arrays["codes"], self.arrays["codes_offsets"])
+
+    def get_descriptions(self) -> List[str]:
+        return unpack_strings(self.arrays["descriptions"], self.arrays["descriptions_offsets"])
+
+    def get_wordpiece_ids(self, rows: np.ndarray = None) -> List[List[int]]:
+        """Wordpiece ids of description of each condition in `rows` (default all)"""
+        rows = np.arange(len(self)) if rows is None else rows
+        offsets, ids = self.arrays["wordpiece_offsets"], self.arrays["wordpiece_ids"]
+        return [ids[offsets[row] : offsets[row + 1]].tolist() for row in np.asarray(rows).tolist()]
+
+    def select(self, min_count: int, max_count: int) -> np.ndarray:
+        """Rows of conditions occurring between min_count and max_count (as filter_condition_code_by_count)"""
+        return np.flatnonzero((self.counts >= min_count) & (self.counts <= max_count))
+
+    def get_set_to_use(self, min_count: int, max_count: int) -> List[str]:
+        codes = self.get_codes()
+        return [codes[row] for row in self.select(min_count, max_count).tolist()]
+
+    def get_frequency_bins(self, rows: np.ndarray = None) -> List[List[str]]:
+        """Codes of conditions in `rows` (default all) in each frequency bin (see get_frequency_bins)"""
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows)
+        codes = self.get_codes()
+        bins = self.frequency_bins[rows]
+        return [[codes[row] for row in rows[bins == n].tolist()] for n in range(NUM_FREQUENCY_BINS)]
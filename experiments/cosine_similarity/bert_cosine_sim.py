@@ -1,14 +1,14 @@
 import argparse
-from typing import Dict, List
+from typing import List, Tuple
 
 import numpy as np
 import torch
 from experiments.metrics import differential_score
+from experiments.templates import Segment, TemplateCompiler, segments_to_string
 from experiments.utilities import (
-    PatientInfo, filter_condition_code_by_count,
-    get_condition_code_to_count,
-    get_condition_code_to_descriptions,
-    get_condition_labels_as_vector,
+    PatientInfo,
+    get_condition_catalog,
+    get_condition_label_matrix,
     get_subject_id_to_patient_info,
 )
 from tqdm import tqdm
@@ -19,63 +19,67 @@ normalize = lambda x: torch.nn.functional.normalize(x, dim=-1)
 cosine_sim = lambda x, y: (normalize(x) * normalize(y)).sum(-1)
 
 
-def generate_template(first_name, last_name, gender, condition_description):
+def generate_segments(first_name, last_name, gender, condition_description) -> List[Segment]:
     title = "Mr" if gender == "M" else "Mrs"  # I guess just assume married w/e idk ?
-    return f"[CLS] {title} {first_name} {last_name} is a yo patient with {condition_description} [SEP]"
+    return [
+        f"[CLS] {title}",
+        ("name", f"{first_name} {last_name}"),
+        "is a yo patient with",
+        ("condition", condition_description),
+        "[SEP]",
+    ]
+
+
+def generate_template(first_name, last_name, gender, condition_description):
+    return segments_to_string(generate_segments(first_name, last_name, gender, condition_description))
 
 
 def get_name_condition_similarities(
     model: BertModel,
-    tokenizer: BertTokenizerFast,
-    templates: List[str],
-    name_start_index: int,
-    name_end_index: int,
-    condition_start_index: int,
-    condition_end_index: int,
+    compiler: TemplateCompiler,
+    encoded: List[List[int]],
+    name_spans: List[Tuple[int, int]],
+    condition_spans: List[Tuple[int, int]],
 ):
+    """Similarities between name and condition wordpieces of each template.
+
+    ### Args:
+        encoded: Token ids of each template (TemplateCompiler.compile)
+        name_spans, condition_spans: (start, end) of name / condition wordpieces in each template
+    """
     mean_similarities = []
     max_similarities = []
     all_pair_similarities = []
 
     batch_size = 3000
-    for b in tqdm(range(0, len(templates), batch_size), disable=True):
-        batch = templates[b : b + batch_size]
-        split_texts = [template.split() for template in batch]
-        batch = tokenizer(
-            text=split_texts,
-            is_split_into_words=True,
-            padding=True,
-            return_tensors="pt",
-            add_special_tokens=False,
-        )
+    for b in tqdm(range(0, len(encoded), batch_size), disable=True):
+        input_ids, attention_mask = compiler.pad(encoded[b : b + batch_size])
 
         with torch.no_grad():
             predictions = model(
-                batch.input_ids.cuda(), attention_mask=batch.attention_mask.cuda(), output_hidden_states=True
+                input_ids.cuda(), attention_mask=attention_mask.cuda(), output_hidden_states=True
             )
             hidden_states = predictions.last_hidden_state  # (B, L, H)
-            template_lengths = batch.attention_mask.sum(-1)
-
-            name_embeddings = hidden_states[:, name_start_index:name_end_index]  # (B, L_name, H)
-
-            # (B, L_cond, H) This is necessary since each condition has difference wordpiece length.
-            # Therefore, we can keep it as tensor anymore.
-            condition_embeddings = []  
 
+            # (B, L_name, H) / (B, L_cond, H) This is necessary since each condition has difference wordpiece
+            # length. Therefore, we can't keep it as tensor anymore.
+            name_embeddings, condition_embeddings = [], []
             for i in range(hidden_states.shape[0]):
-                template_hidden_states = hidden_states[i, : template_lengths[i]]
-                condition_embeddings.append(template_hidden_states[condition_start_index:condition_end_index])
-
-            mean_condition_embeddings = torch.cat(
-                [embedding.mean(0)[None, :] for embedding in condition_embeddings], dim=0
-            )  # (B, H)
-            similarity = cosine_sim(name_embeddings.mean(1), mean_condition_embeddings)  # (B, )
+                name_start, name_end = name_spans[b + i]
+                condition_start, condition_end = condition_spans[b + i]
+                name_embeddings.append(hidden_states[i, name_start:name_end])
+                condition_embeddings.append(hidden_states[i, condition_start:condition_end])
+
+            mean_name_embeddings = torch.stack([embedding.mean(0) for embedding in name_embeddings])  # (B, H)
+            mean_condition_embeddings = torch.stack([embedding.mean(0) for embedding in condition_embeddings])
+            similarity = cosine_sim(mean_name_embeddings, mean_condition_embeddings)  # (B, )
             mean_similarities.append(similarity.cpu().data.numpy())
 
-            max_condition_embeddings = torch.cat(
-                [embedding.max(0).values[None, :] for embedding in condition_embeddings], dim=0
+            max_name_embeddings = torch.stack([embedding.max(0).values for embedding in name_embeddings])
+            max_condition_embeddings = torch.stack(
+                [embedding.max(0).values for embedding in condition_embeddings]
             )  # (B, H)
-            similarity = cosine_sim(name_embeddings.max(1).values, max_condition_embeddings)
+            similarity = cosine_sim(max_name_embeddings, max_condition_embeddings)
             max_similarities.append(similarity.cpu().data.numpy())
 
             for i, embedding in enumerate(condition_embeddings):
@@ -95,12 +99,12 @@ def main(model, tokenizer: BertTokenizerFast, condition_type: str, metrics_outpu
     ## Get Relevant data
 
     subject_id_to_patient_info = get_subject_id_to_patient_info(condition_type=condition_type)
-    condition_code_to_count = get_condition_code_to_count(condition_type=condition_type)
-    condition_code_to_description = get_condition_code_to_descriptions(condition_type=condition_type)
+    catalog = get_condition_catalog(condition_type, tokenizer)
+    condition_code_to_description = dict(zip(catalog.get_codes(), catalog.get_descriptions()))
 
-    set_to_use = filter_condition_code_by_count(condition_code_to_count, min_count=0, max_count=500000)
+    set_to_use = catalog.get_set_to_use(min_count=0, max_count=500000)
 
-    condition_code_to_index: Dict[str, int] = dict(zip(set_to_use, range(len(set_to_use))))
+    label_matrix = get_condition_label_matrix(condition_type, set_to_use)
 
     mean_differential_sim, max_differential_sim, all_pair_differential_sim = [], [], []
 
@@ -109,48 +113,26 @@ def main(model, tokenizer: BertTokenizerFast, condition_type: str, metrics_outpu
     all_subject_ids = sorted(list(subject_id_to_patient_info.keys()))
     all_subject_ids = sorted(resample(all_subject_ids, replace=False, n_samples=10000, random_state=2021))
 
+    compiler = TemplateCompiler(tokenizer)
     for subject_id in tqdm(all_subject_ids):
         patient_info = subject_id_to_patient_info[subject_id]
-        templates = []
+        encoded, name_spans, condition_spans = [], [], []
         for condition in set_to_use:
             desc = condition_code_to_description[condition]
-            templates.append(
-                generate_template(patient_info.FIRST_NAME, patient_info.LAST_NAME, patient_info.GENDER, desc)
+            input_ids, spans = compiler.compile(
+                generate_segments(patient_info.FIRST_NAME, patient_info.LAST_NAME, patient_info.GENDER, desc)
             )
-
-        name = patient_info.FIRST_NAME + " " + patient_info.LAST_NAME
-        name_length = len(tokenizer.tokenize(name))
-
-        ## Following info may change if we change the template structure.
-        ## Following are on basis of structure [CLS] {title} {name} is a yo patient with {condition} [SEP]
-        example_template = tokenizer.tokenize(templates[0])
-        name_start_index = 2  # Name Starts after [CLS] {title}
-        name_end_index = name_start_index + name_length
-        condition_start_index = example_template.index("patient") + 2
-        condition_end_index = -1
-
-        assert (
-            tokenizer.convert_tokens_to_string(example_template[name_start_index:name_end_index])
-            == " ".join(name.lower().split())
-        ), breakpoint()
-        assert (
-            tokenizer.convert_tokens_to_string(example_template[condition_start_index:condition_end_index])
-            == " ".join(condition_code_to_description[set_to_use[0]].lower().split())
-        ), breakpoint()
+            encoded.append(input_ids)
+            name_spans.append(spans["name"])
+            condition_spans.append(spans["condition"])
 
         ## Pass all templates to BERT and return similarities
 
         mean_similarities, max_similarities, all_pair_similarities = get_name_condition_similarities(
-            model,
-            tokenizer,
-            templates,
-            name_start_index,
-            name_end_index,
-            condition_start_index,
-            condition_end_index,
+            model, compiler, encoded, name_spans, condition_spans
         )
 
-        condition_labels = get_condition_labels_as_vector(patient_info.CONDITIONS, condition_code_to_index)
+        condition_labels = label_matrix.get_row(subject_id)
 
         mean_differential_sim.append(differential_score(condition_labels, mean_similarities))
         max_differential_sim.append(differential_score(condition_labels, max_similarities))
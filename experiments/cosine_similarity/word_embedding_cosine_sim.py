@@ -1,5 +1,4 @@
 import argparse
-from typing import Dict
 
 import gensim
 import numpy as np
@@ -8,7 +7,7 @@ from experiments.utilities import (
     filter_condition_code_by_count,
     get_condition_code_to_count,
     get_condition_code_to_descriptions,
-    get_condition_labels_as_vector,
+    get_condition_label_matrix,
     get_subject_id_to_patient_info,
 )
 from experiments.metrics import differential_score
@@ -40,7 +39,7 @@ def main(model: gensim.models.KeyedVectors, condition_type: str, metrics_output_
 
     set_to_use = filter_condition_code_by_count(condition_code_to_count, min_count=50, max_count=500000)
 
-    condition_code_to_index: Dict[str, int] = dict(zip(set_to_use, range(len(set_to_use))))
+    label_matrix = get_condition_label_matrix(condition_type, set_to_use)
 
     mean_condition_embeddings = []
     max_condition_embeddings = []
@@ -84,8 +83,8 @@ def main(model: gensim.models.KeyedVectors, condition_type: str, metrics_output_
             similarity_matrix = condition_embeddings @ name_embeddings.T
             all_pair_similarities.append(np.max(similarity_matrix))
 
-        condition_labels = get_condition_labels_as_vector(patient_info.CONDITIONS, condition_code_to_index)
-        if sum(condition_labels) == 0: continue
+        condition_labels = label_matrix.get_row(subject_id)
+        if condition_labels.sum() == 0: continue
         mean_differential_sim.append(differential_score(condition_labels, mean_similarities))
         max_differential_sim.append(differential_score(condition_labels, max_similarities))
         all_pair_differential_sim.append(differential_score(condition_labels, all_pair_similarities))
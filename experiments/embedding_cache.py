@@ -0,0 +1,144 @@
+"""
+CLS Embedding Cache
+===================
+
+Probing experiments embed the same templates over and over (per condition, per prober, per rerun). Embeddings
+are cached on disk keyed by sha1(template token ids), in a folder per model fingerprint:
+
+    <cache dir>/<model fingerprint>/
+        meta.json                 -- embedding dimension
+        <shard>.keys              -- 16 byte key of each row, appended
+        <shard>.embeddings        -- float16 embedding of each row, appended (memory mapped on read)
+
+Shards are append-only and each process writes to its own shard, so runs sharing the cache never write to the
+same file. Keys are written after their embeddings, so an interrupted write never indexes a missing row.
+
+The index is rebuilt from the keys files when the cache is opened: per shard, a sorted array of its keys (as
+16 byte numpy void scalars) and the row of each, looked up with searchsorted. Millions of keys then take a
+few arrays instead of millions of python bytes objects and tuples.
+
+Enabled by setting environment variable CLS_EMBEDDING_CACHE to the folder to use.
+"""
+
+import hashlib
+import json
+import os
+import uuid
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+KEY_BYTES = 16
+KEY_DTYPE = np.dtype(f"V{KEY_BYTES}")
+
+## Rows per shard file before a process starts a new shard
+MAX_SHARD_ROWS = 1000000
+
+
+def get_template_key(input_ids: List[int]) -> bytes:
+    return hashlib.sha1(np.asarray(input_ids, dtype=np.int32).tobytes()).digest()[:KEY_BYTES]
+
+
+class EmbeddingCache:
+    def __init__(self, path: str, model_fingerprint: str, dim: int):
+        self.path = os.path.join(path, model_fingerprint)
+        self.dim = dim
+        os.makedirs(self.path, exist_ok=True)
+
+        meta_file = os.path.join(self.path, "meta.json")
+        if not os.path.exists(meta_file):
+            with open(meta_file, "w") as f:
+                json.dump({"dim": dim}, f)
+        with open(meta_file) as f:
+            assert json.load(f)["dim"] == dim, f"Embedding dimension of {self.path} is not {dim}"
+
+        ## Per shard: keys sorted, and row of each sorted key
+        self.sorted_keys: Dict[str, np.ndarray] = {}
+        self.sorted_rows: Dict[str, np.ndarray] = {}
+        self.shard_rows: Dict[str, int] = {}
+        self.mapped: Dict[str, np.memmap] = {}
+        for name in sorted(os.listdir(self.path)):
+            if name.endswith(".keys"):
+                self.load_keys(name[: -len(".keys")])
+
+        self.shard = None
+
+    def load_keys(self, shard: str):
+        with open(os.path.join(self.path, shard + ".keys"), "rb") as f:
+            keys = f.read()
+
+        num_rows = len(keys) // KEY_BYTES
+        keys = np.frombuffer(keys[: num_rows * KEY_BYTES], dtype=KEY_DTYPE)
+        order = np.argsort(keys, kind="stable")
+        self.sorted_keys[shard] = keys[order]
+        self.sorted_rows[shard] = order.astype(np.int64)
+        self.shard_rows[shard] = num_rows
+
+    def lookup(self, keys: np.ndarray, shard: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (found, row) of each of `keys` (KEY_DTYPE array) in `shard`"""
+        sorted_keys = self.sorted_keys[shard]
+        if len(sorted_keys) == 0:
+            return np.zeros(len(keys), dtype=bool), np.zeros(len(keys), dtype=np.int64)
+
+        positions = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+        return sorted_keys[positions] == keys, self.sorted_rows[shard][positions]
+
+    def get_embeddings(self, shard: str, rows: np.ndarray) -> np.ndarray:
+        ## Remap if shard grew since it was mapped
+        if shard not in self.mapped or len(self.mapped[shard]) < self.shard_rows[shard]:
+            self.mapped[shard] = np.memmap(
+                os.path.join(self.path, shard + ".embeddings"),
+                dtype=np.float16,
+                mode="r",
+                shape=(self.shard_rows[shard], self.dim),
+            )
+        return np.asarray(self.mapped[shard][rows])
+
+    def get(self, keys: List[bytes]) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (embeddings, found) of `keys`, rows of keys not in cache are zero"""
+        keys = np.frombuffer(b"".join(keys), dtype=KEY_DTYPE)
+        embeddings = np.zeros((len(keys), self.dim), dtype=np.float32)
+        found = np.zeros(len(keys), dtype=bool)
+
+        for shard in self.sorted_keys:
+            in_shard, rows = self.lookup(keys, shard)
+            in_shard &= ~found
+            if in_shard.any():
+                embeddings[in_shard] = self.get_embeddings(shard, rows[in_shard])
+                found |= in_shard
+
+        return embeddings, found
+
+    def put(self, keys: List[bytes], embeddings: np.ndarray):
+        """Append `embeddings` of `keys` not already in cache"""
+        keys = np.frombuffer(b"".join(keys), dtype=KEY_DTYPE)
+        new = np.ones(len(keys), dtype=bool)
+        for shard in self.sorted_keys:
+            new &= ~self.lookup(keys, shard)[0]
+
+        ## First occurrence of each new key, in order
+        _, first = np.unique(keys, return_index=True)
+        new[np.setdiff1d(np.arange(len(keys)), first)] = False
+        new = np.flatnonzero(new)
+        if len(new) == 0:
+            return
+
+        if self.shard is None or self.shard_rows[self.shard] >= MAX_SHARD_ROWS:
+            self.shard = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+            self.sorted_keys[self.shard] = np.zeros(0, dtype=KEY_DTYPE)
+            self.sorted_rows[self.shard] = np.zeros(0, dtype=np.int64)
+            self.shard_rows[self.shard] = 0
+
+        with open(os.path.join(self.path, self.shard + ".embeddings"), "ab") as f:
+            f.write(np.asarray(embeddings, dtype=np.float16)[new].tobytes())
+        with open(os.path.join(self.path, self.shard + ".keys"), "ab") as f:
+            f.write(keys[new].tobytes())
+
+        ## Merge new keys into the sorted keys of the shard
+        start = self.shard_rows[self.shard]
+        order = np.argsort(keys[new], kind="stable")
+        new_keys, new_rows = keys[new][order], start + order
+        positions = np.searchsorted(self.sorted_keys[self.shard], new_keys)
+        self.sorted_keys[self.shard] = np.insert(self.sorted_keys[self.shard], positions, new_keys)
+        self.sorted_rows[self.shard] = np.insert(self.sorted_rows[self.shard], positions, new_rows)
+        self.shard_rows[self.shard] = start + len(new)
@@ -1,4 +1,5 @@
 import numpy as np
+from scipy.stats import rankdata
 
 def precision_at_k(labels, logits, k=10) -> float:
     top_k = np.argsort(logits)[-k:]
@@ -14,4 +15,37 @@ def differential_score(labels, scores) -> float:
     positive_scores = scores[labels == 1].mean()
     negative_scores = scores[labels == 0].mean()
 
-    return positive_scores - negative_scores
\ No newline at end of file
+    return positive_scores - negative_scores
+
+def batched_roc_auc(labels: np.ndarray, scores: np.ndarray) -> np.ndarray:
+    """ROC AUC of each row of binary `labels` (B, N) against `scores` (B, N), or (N,) shared by all rows.
+    Rank based (Mann-Whitney U, ties count half, same as roc_auc_score). NaN for rows with a single class.
+    """
+    labels = np.asarray(labels, dtype=bool)
+    ranks = np.broadcast_to(rankdata(scores, axis=-1), labels.shape)
+    num_positives = labels.sum(-1)
+    num_negatives = labels.shape[-1] - num_positives
+
+    positive_rank_sums = np.where(labels, ranks, 0).sum(-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (positive_rank_sums - num_positives * (num_positives + 1) / 2) / (num_positives * num_negatives)
+
+def batched_spearman(x: np.ndarray, scores: np.ndarray) -> np.ndarray:
+    """Spearman correlation of `x` (N,) with each row of `scores` (B, N), or with `scores` (N,).
+    Same as spearmanr(x, row).correlation, NaN for constant rows.
+    """
+    x_ranks = rankdata(x)
+    x_ranks = x_ranks - x_ranks.mean()
+    ranks = rankdata(scores, axis=-1)
+    ranks = ranks - ranks.mean(-1, keepdims=True)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (ranks * x_ranks).sum(-1) / np.sqrt((ranks ** 2).sum(-1) * (x_ranks ** 2).sum())
+
+def batched_precision_at_k(labels: np.ndarray, scores: np.ndarray, k=10) -> np.ndarray:
+    """precision_at_k for each row of `labels` (B, N), with `scores` (B, N) or (N,) shared by all rows"""
+    labels = np.asarray(labels)
+    top_k = np.argsort(scores, axis=-1)[..., -k:]
+    top_k = np.broadcast_to(top_k, labels.shape[:-1] + top_k.shape[-1:])
+    return np.take_along_axis(labels, top_k, axis=-1).mean(-1)
+
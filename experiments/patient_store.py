@@ -0,0 +1,201 @@
+"""
+Patient Store
+=============
+
+Binary cache of everything experiments.utilities loads about patients, built once per condition type and
+version of the source files (reidentified subject ids, names, conditions, descriptions), and stored as a
+single npz in config.PATIENT_STORE_DIR:
+
+    - reidentified subject ids
+    - names / gender of all patients (int subject ids, strings packed as utf-8 bytes + offsets)
+    - condition codes interned as sorted code table + per code count (over reidentified patients)
+    - per patient conditions in CSR form (offsets into an array of code indices) for reidentified patients
+      with a name and at least one condition
+    - code descriptions
+
+Sources are identified by path, size and mtime, so changing any of them rebuilds the store on next use.
+"""
+
+import hashlib
+import json
+import os
+import uuid
+from typing import List
+
+import config
+import numpy as np
+
+from setup_scripts.storage import COLUMN_DTYPES, columnar_path, has_columnar, read_table
+
+STORE_VERSION = 1
+
+
+def pack_strings(strings: List[str]):
+    """Return (utf-8 bytes as uint8 array, offsets) of strings"""
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(s) for s in encoded])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def unpack_strings(data: np.ndarray, offsets: np.ndarray) -> List[str]:
+    data = data.tobytes()
+    offsets = offsets.tolist()
+    return [data[start:end].decode("utf-8") for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def get_path_signature(path: str):
+    """Path, size and mtime of CSV `path`, or of every file of its parquet dataset"""
+    if has_columnar(path):
+        root = columnar_path(path)
+        files = sorted(os.path.join(d, f) for d, _, fs in os.walk(root) for f in fs)
+    else:
+        files = [path]
+
+    return [(os.path.abspath(f), os.stat(f).st_size, int(os.stat(f).st_mtime)) for f in files]
+
+
+class PatientStore:
+    """Patient data for `condition_type` (or names only, if condition_type is None).
+
+    ### Args:
+        condition_type: Takes value in config.condition_type_to_file
+        debug: Only keep first 1000 reidentified subject ids (see utilities.is_debugging_mode)
+    """
+
+    def __init__(self, condition_type: str = None, debug: bool = False, store_dir: str = None):
+        assert (
+            condition_type is None or condition_type in config.condition_type_to_file
+        ), f"Unknown Condition type, Select From {list(config.condition_type_to_file.keys())}"
+
+        self.condition_type = condition_type
+        self.debug = debug
+        self.store_dir = store_dir if store_dir is not None else config.PATIENT_STORE_DIR
+
+        store_file = self.get_store_file()
+        if not os.path.exists(store_file):
+            self.build(store_file)
+
+        with np.load(store_file) as store:
+            self.arrays = {name: store[name] for name in store.files}
+
+    def get_sources(self) -> List[str]:
+        sources = [config.MODIFIED_SUBJECT_IDS, config.SUBJECT_ID_to_NAME]
+        if self.condition_type is not None:
+            sources += [
+                config.condition_type_to_file[self.condition_type],
+                config.condition_type_to_descriptions[self.condition_type],
+            ]
+        return sources
+
+    def get_store_file(self) -> str:
+        key = json.dumps(
+            [STORE_VERSION, self.condition_type, self.debug, [get_path_signature(p) for p in self.get_sources()]]
+        )
+        key = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.store_dir, f"{self.condition_type or 'names'}-{key}.npz")
+
+    def build(self, store_file: str):
+        print(f"Building patient store {store_file}")
+        import pandas as pd
+
+        arrays = {}
+
+        reidentified_subject_ids = read_table(config.MODIFIED_SUBJECT_IDS, columns=["SUBJECT_ID"]).SUBJECT_ID.values
+        if self.debug:
+            reidentified_subject_ids = reidentified_subject_ids[:1000]
+        arrays["reidentified_subject_ids"] = reidentified_subject_ids.astype(np.int64)
+
+        names = read_table(config.SUBJECT_ID_to_NAME, columns=["SUBJECT_ID", "FIRST_NAME", "LAST_NAME", "GENDER"])
+        names.fillna("", inplace=True)
+        arrays["subject_ids"] = names.SUBJECT_ID.values.astype(np.int64)
+        for column in ["FIRST_NAME", "LAST_NAME", "GENDER"]:
+            arrays[column], arrays[column + "_offsets"] = pack_strings(names[column].astype(str).tolist())
+
+        if self.condition_type is not None:
+            conditions = read_table(
+                config.condition_type_to_file[self.condition_type],
+                columns=["SUBJECT_ID", "CODE"],
+                subject_ids=reidentified_subject_ids,
+            )
+            codes, code_indices, code_counts = np.unique(
+                conditions.CODE.values.astype(str), return_inverse=True, return_counts=True
+            )
+            arrays["codes"], arrays["codes_offsets"] = pack_strings(codes.tolist())
+            arrays["code_counts"] = code_counts.astype(np.int64)
+
+            ## Patients in order of names file (as merge in utilities did), with conditions sorted by code
+            conditions = pd.DataFrame(
+                {"SUBJECT_ID": conditions.SUBJECT_ID.values.astype(np.int64), "CODE_INDEX": code_indices}
+            )
+            conditions = conditions.sort_values(by=["SUBJECT_ID", "CODE_INDEX"])
+            patients = names.reset_index(drop=True)
+            patients = patients[
+                patients.SUBJECT_ID.isin(reidentified_subject_ids)
+                & patients.SUBJECT_ID.isin(conditions.SUBJECT_ID.values)
+            ]
+            arrays["patient_rows"] = patients.index.values.astype(np.int64)
+
+            condition_subject_ids = conditions.SUBJECT_ID.values
+            patient_subject_ids = patients.SUBJECT_ID.values.astype(np.int64)
+            starts = np.searchsorted(condition_subject_ids, patient_subject_ids, "left")
+            ends = np.searchsorted(condition_subject_ids, patient_subject_ids, "right")
+            arrays["condition_offsets"] = np.concatenate([[0], np.cumsum(ends - starts)]).astype(np.int64)
+            arrays["condition_indices"] = np.concatenate(
+                [conditions.CODE_INDEX.values[start:end] for start, end in zip(starts, ends)] + [np.zeros(0)]
+            ).astype(np.int32)
+
+            descriptions = pd.read_csv(
+                config.condition_type_to_descriptions[self.condition_type], dtype=COLUMN_DTYPES
+            )
+            descriptions.fillna("", inplace=True)
+            for column in ["CODE", "DESCRIPTION"]:
+                arrays["description_" + column], arrays["description_" + column + "_offsets"] = pack_strings(
+                    descriptions[column].astype(str).tolist()
+                )
+
+        os.makedirs(self.store_dir, exist_ok=True)
+        ## Temporary file of this process only, so concurrent builders never write to the same file. Replacing
+        ## is atomic, so the last builder wins with an identical store.
+        tmp_file = f"{store_file}.tmp-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        with open(tmp_file, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_file, store_file)
+
+    def get_strings(self, name: str) -> List[str]:
+        return unpack_strings(self.arrays[name], self.arrays[name + "_offsets"])
+
+    @property
+    def reidentified_subject_ids(self) -> np.ndarray:
+        return self.arrays["reidentified_subject_ids"]
+
+    @property
+    def subject_ids(self) -> np.ndarray:
+        """Subject ids of all patients with a name"""
+        return self.arrays["subject_ids"]
+
+    @property
+    def patient_rows(self) -> np.ndarray:
+        """Rows (into subject_ids / names) of reidentified patients with conditions"""
+        return self.arrays["patient_rows"]
+
+    @property
+    def condition_offsets(self) -> np.ndarray:
+        """Conditions of patient_rows[i] are codes[condition_indices[condition_offsets[i]:condition_offsets[i+1]]]"""
+        return self.arrays["condition_offsets"]
+
+    @property
+    def condition_indices(self) -> np.ndarray:
+        return self.arrays["condition_indices"]
+
+    @property
+    def code_counts(self) -> np.ndarray:
+        """Number of condition rows of reidentified patients, per code in codes"""
+        return self.arrays["code_counts"]
+
+    def get_codes(self) -> List[str]:
+        """Sorted unique condition codes of reidentified patients"""
+        return self.get_strings("codes")
+
+    def get_descriptions(self):
+        return self.get_strings("description_CODE"), self.get_strings("description_DESCRIPTION")
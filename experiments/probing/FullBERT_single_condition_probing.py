@@ -3,14 +3,9 @@ import argparse
 import numpy as np
 import torch
 from experiments.metrics import precision_at_k
-from experiments.probing.LR_single_condition_probing import get_frequency_bins, get_non_zero_count_conditions
+from experiments.probing.LR_single_condition_probing import get_non_zero_count_conditions
 from experiments.probing.common import generate_name_condition_template
-from experiments.utilities import (
-    filter_condition_code_by_count,
-    get_condition_code_to_count,
-    get_condition_code_to_descriptions,
-    get_subject_id_to_patient_info,
-)
+from experiments.utilities import get_condition_catalog, get_subject_id_to_patient_info
 from sklearn.metrics import roc_auc_score
 from sklearn.model_selection import train_test_split
 from sklearn.utils import resample
@@ -104,12 +99,12 @@ def train_and_evaluate(
     ### Get Relevant Data
 
     subject_id_to_patient_info = get_subject_id_to_patient_info(condition_type=condition_type)
-    condition_code_to_count = get_condition_code_to_count(condition_type=condition_type)
-    condition_code_to_description = get_condition_code_to_descriptions(condition_type=condition_type)
+    catalog = get_condition_catalog(condition_type, tokenizer)
+    condition_code_to_description = dict(zip(catalog.get_codes(), catalog.get_descriptions()))
 
-    set_to_use = filter_condition_code_by_count(condition_code_to_count, min_count=0, max_count=500000)
+    set_to_use = catalog.get_set_to_use(min_count=0, max_count=500000)
 
-    binned_conditions = get_frequency_bins(condition_code_to_count, condition_type)
+    binned_conditions = catalog.get_frequency_bins()
 
     subject_ids = sorted(list(subject_id_to_patient_info.keys()))
     train_subject_ids, test_subject_ids = train_test_split(
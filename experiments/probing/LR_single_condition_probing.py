@@ -1,16 +1,13 @@
 import argparse
-from typing import Dict, List, Set
+from functools import partial
+from typing import Dict, List, Set, Tuple
 
 import numpy as np
 from experiments.metrics import precision_at_k
-from experiments.probing.common import generate_name_condition_template, get_cls_embeddings
-from experiments.utilities import (
-    PatientInfo,
-    filter_condition_code_by_count,
-    get_condition_code_to_count,
-    get_condition_code_to_descriptions,
-    get_subject_id_to_patient_info,
-)
+from experiments.condition_catalog import NUM_FREQUENCY_BINS, get_frequency_bin_indices
+from experiments.probing.common import generate_name_condition_template, get_cls_embeddings, load_cls_model
+from experiments.probing.probes import BatchedMLPProbe
+from experiments.utilities import PatientInfo, get_condition_catalog, get_subject_id_to_patient_info
 from sklearn.neural_network import MLPClassifier
 from sklearn.metrics import roc_auc_score
 from sklearn.model_selection import train_test_split
@@ -26,21 +23,9 @@ def get_frequency_bins(condition_code_to_count: Dict[str, int], condition_type:
     @return a 2D array, where each inner array represents a different frequency
     bin. Each inner array contains condition codes belonging to that bin.
     """
-    nbins = 5
-    if condition_type == "medcat":
-        max_count = max(condition_code_to_count.values())
-        bin_cut_offs = [max_count / nbins * i + 1 for i in range(1, nbins + 1)]
-    elif condition_type == "icd9":
-        bin_cut_offs = [3, 5, 10, 20, 10000]
-
-    bins = [[] for _ in range(nbins)]
-    for code, count in condition_code_to_count.items():
-        for n in range(nbins):
-            if count <= bin_cut_offs[n]:
-                bins[n].append(code)
-                break
-
-    return bins
+    codes = list(condition_code_to_count.keys())
+    bin_indices = get_frequency_bin_indices(list(condition_code_to_count.values()), condition_type)
+    return [[code for code, n in zip(codes, bin_indices.tolist()) if n == b] for b in range(NUM_FREQUENCY_BINS)]
 
 
 def get_non_zero_count_conditions(
@@ -55,6 +40,35 @@ def get_non_zero_count_conditions(
     return set([code for code, count in condition_code_to_count.items() if count > 0])
 
 
+def get_condition_templates(
+    subject_ids: List, subject_id_to_patient_info: Dict[str, PatientInfo], condition: str, desc: str
+) -> Tuple[List[str], List[bool]]:
+    """Templates with condition description `desc` and label of `condition`, for each patient in subject_ids"""
+    templates, labels = [], []
+    for subject_id in subject_ids:
+        patient_info = subject_id_to_patient_info[subject_id]
+        templates.append(
+            generate_name_condition_template(
+                patient_info.FIRST_NAME, patient_info.LAST_NAME, patient_info.GENDER, desc
+            )
+        )
+        labels.append(condition in patient_info.CONDITIONS)
+
+    return templates, labels
+
+
+def get_upsampled_indices(labels: List[bool]) -> List[int]:
+    """Indices of all negative examples, and of positive examples upsampled to the same number"""
+    negative_indices = [i for i, x in enumerate(labels) if x == 0]
+    positive_indices = [i for i, x in enumerate(labels) if x == 1]
+
+    # We set replace = to False in another file; does this matter?
+    positive_indices = resample(
+        positive_indices, replace=True, n_samples=len(negative_indices), random_state=2021
+    )
+    return negative_indices + positive_indices
+
+
 def train_and_evaluate(
     model: BertModel,
     tokenizer: BertTokenizer,
@@ -62,19 +76,21 @@ def train_and_evaluate(
     sampling_bin: int,
     n: int,
     metrics_output_path: str,
+    batched: bool = False,
 ):
     """Train and evaluate the model on N conditions.
     @param n is the number of conditions to sample the bin from.
+    @param batched trains probes of all N conditions at once as one torch model (BatchedMLPProbe).
     """
     ### Get Relevant Data
 
     subject_id_to_patient_info = get_subject_id_to_patient_info(condition_type=condition_type)
-    condition_code_to_count = get_condition_code_to_count(condition_type=condition_type)
-    condition_code_to_description = get_condition_code_to_descriptions(condition_type=condition_type)
+    catalog = get_condition_catalog(condition_type, tokenizer)
+    condition_code_to_description = dict(zip(catalog.get_codes(), catalog.get_descriptions()))
 
-    set_to_use = filter_condition_code_by_count(condition_code_to_count, min_count=0, max_count=500000)
+    set_to_use = catalog.get_set_to_use(min_count=0, max_count=500000)
 
-    binned_conditions = get_frequency_bins(condition_code_to_count, condition_type)
+    binned_conditions = catalog.get_frequency_bins()
 
     subject_ids = sorted(list(subject_id_to_patient_info.keys()))
     train_subject_ids, test_subject_ids = train_test_split(
@@ -100,63 +116,64 @@ def train_and_evaluate(
     np.random.seed(2021)
     sampled_conditions = np.random.choice(condition_bin, size=n, replace=False)
 
-    ## Train a Classifier for Each Condition
+    ## Train a Classifier for Each Condition (all at once if batched)
+
+    classifiers = {}
+    if batched:
+        print(f"Training {len(sampled_conditions)} probes at once")
+        train_embeddings = np.zeros(
+            (len(sampled_conditions), len(train_subject_ids), model.config.hidden_size), dtype=np.float32
+        )
+        train_labels = np.zeros((len(sampled_conditions), len(train_subject_ids)), dtype=bool)
+        train_indices = []
+        for k, condition in enumerate(tqdm(sampled_conditions)):
+            desc = condition_code_to_description[condition]
+            train_templates, train_labels[k] = get_condition_templates(
+                train_subject_ids, subject_id_to_patient_info, condition, desc
+            )
+            train_embeddings[k] = get_cls_embeddings(model, tokenizer, train_templates, disable_tqdm=True)
+            train_indices.append(get_upsampled_indices(train_labels[k]))
+
+        probe = BatchedMLPProbe(len(sampled_conditions), model.config.hidden_size)
+        probe.fit(train_embeddings, train_labels, train_indices)
+        for k, condition in enumerate(sampled_conditions):
+            classifiers[condition] = partial(probe.predict_proba, head=k)
 
     auc_score_list, precision_at_10_list = [], []
     for condition in tqdm(sampled_conditions):
         desc = condition_code_to_description[condition]
 
-        ## Get all train templates and labels for all train patients, for this condition
-        train_templates = []
-        train_labels = []
-        for subject_id in train_subject_ids:
-            patient_info = subject_id_to_patient_info[subject_id]
-            template = generate_name_condition_template(
-                patient_info.FIRST_NAME, patient_info.LAST_NAME, patient_info.GENDER, desc
+        if not batched:
+            ## Get all train templates and labels for all train patients, for this condition
+            train_templates, train_labels = get_condition_templates(
+                train_subject_ids, subject_id_to_patient_info, condition, desc
             )
-            label = condition in patient_info.CONDITIONS
-
-            train_templates.append(template)
-            train_labels.append(label)
-
-        ## Resample to Upsample positive examples
 
-        negative_indices = [i for i, x in enumerate(train_labels) if x == 0]
-        positive_indices = [i for i, x in enumerate(train_labels) if x == 1]
+            ## Resample to Upsample positive examples
+            total_indices = get_upsampled_indices(train_labels)
 
-        # We set replace = to False in another file; does this matter?
-        positive_indices = resample(
-            positive_indices, replace=True, n_samples=len(negative_indices), random_state=2021
-        )
-        total_indices = negative_indices + positive_indices
+            ## Embed each patient's template once, upsampled training set is gathered from the unique embeddings
 
-        train_templates = [train_templates[i] for i in total_indices]
-        train_labels = [train_labels[i] for i in total_indices]
+            train_embeddings = get_cls_embeddings(model, tokenizer, train_templates, disable_tqdm=True)
+            train_embeddings = train_embeddings[total_indices]
+            train_labels = [train_labels[i] for i in total_indices]
 
-        ## Train the LR model
+            ## Train the LR model
 
-        train_embeddings = get_cls_embeddings(model, tokenizer, train_templates, disable_tqdm=True)
-        clf = MLPClassifier(hidden_layer_sizes=(128,), random_state=2021).fit(train_embeddings, train_labels)
+            clf = MLPClassifier(hidden_layer_sizes=(128,), random_state=2021)
+            clf.fit(train_embeddings, train_labels)
+            classifiers[condition] = clf.predict_proba
 
         ## Get all test templates and labels for all test patients, for this condition
 
-        test_templates = []
-        test_labels = []
-
-        for subject_id in test_subject_ids:
-            patient_info = subject_id_to_patient_info[subject_id]
-            template = generate_name_condition_template(
-                patient_info.FIRST_NAME, patient_info.LAST_NAME, patient_info.GENDER, desc
-            )
-            label = condition in patient_info.CONDITIONS
-
-            test_templates.append(template)
-            test_labels.append(label)
+        test_templates, test_labels = get_condition_templates(
+            test_subject_ids, subject_id_to_patient_info, condition, desc
+        )
 
         ## Get Embeddings for all test patients, and make prediction with LR model
 
         test_embeddings = get_cls_embeddings(model, tokenizer, test_templates, disable_tqdm=True)
-        test_predictions = clf.predict_proba(test_embeddings)[:, 1]
+        test_predictions = classifiers[condition](test_embeddings)[:, 1]
 
         auc_score = roc_auc_score(test_labels, test_predictions)
         precision_at_10 = precision_at_k(test_labels, test_predictions, k=10)
@@ -184,21 +201,37 @@ if __name__ == "__main__":
         help="Which frequency bin to use?",
         type=int,
     )
+    parser.add_argument(
+        "--batched", action="store_true", help="Train probes of all conditions at once (torch, CPU threads)"
+    )
+    parser.add_argument("--num-threads", type=int, help="CPU threads for --batched probes")
     parser.add_argument("--metrics-output-path", type=str)
     args = parser.parse_args()
 
+    if args.num_threads is not None:
+        import torch
+
+        torch.set_num_threads(args.num_threads)
+
     tokenizer = BertTokenizer.from_pretrained(args.tokenizer)
-    model = BertModel.from_pretrained(args.model).cuda().eval()
+    model = load_cls_model(args.model)
 
     import os
 
     metrics_output_path = args.metrics_output_path if args.metrics_output_path is not None else args.model
     metrics_output_path = os.path.join(
         metrics_output_path,
-        f"LR_single_conditions_probing/{args.condition_type}_{args.conditions}_{args.frequency_bin}",
+        f"LR_single_conditions_probing/{args.condition_type}_{args.conditions}_{args.frequency_bin}"
+        + ("_batched" if args.batched else ""),
     )
     os.makedirs(metrics_output_path, exist_ok=True)
 
     train_and_evaluate(
-        model, tokenizer, args.condition_type, args.frequency_bin, args.conditions, metrics_output_path
+        model,
+        tokenizer,
+        args.condition_type,
+        args.frequency_bin,
+        args.conditions,
+        metrics_output_path,
+        batched=args.batched,
     )
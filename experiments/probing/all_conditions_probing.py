@@ -1,13 +1,11 @@
 import argparse
-from typing import Dict
+from typing import Dict, Iterator, List
 
 import numpy as np
 from experiments.metrics import precision_at_k
 from experiments.utilities import (
-    filter_condition_code_by_count,
-    get_condition_code_to_count,
-    get_condition_code_to_descriptions,
-    get_condition_labels_as_vector,
+    get_condition_catalog,
+    get_condition_label_matrix,
     get_subject_id_to_patient_info,
 )
 from sklearn.linear_model import LogisticRegression
@@ -19,10 +17,80 @@ from tqdm import tqdm
 from transformers import BertModel, BertTokenizerFast
 
 from experiments.probing.common import (
-    generate_condition_only_template,
-    generate_name_condition_template,
-    get_cls_embeddings,
+    generate_condition_only_segments,
+    generate_name_condition_segments,
+    get_cls_embeddings_from_ids,
+    iterate_cls_embeddings,
+    load_cls_model,
 )
+from experiments.probing.probes import IncrementalProbe
+from experiments.templates import TemplateCompiler
+
+
+## Templates generated and embedded at once while streaming training templates
+EMBEDDING_CHUNK_SIZE = 20000
+
+
+def sample_negative_pairs(positive_pairs: np.ndarray, num_pairs: int, n_samples: int, random_state: int):
+    """Sample `n_samples` distinct pairs out of range(num_pairs) not in sorted `positive_pairs`, without
+    materializing all negative pairs
+    """
+    random_state = np.random.RandomState(random_state)
+    n_samples = min(n_samples, num_pairs - len(positive_pairs))
+
+    sampled = np.zeros(0, dtype=np.int64)
+    while len(sampled) < n_samples:
+        candidates = random_state.randint(0, num_pairs, size=2 * (n_samples - len(sampled)) + 16)
+        candidates = candidates[~np.isin(candidates, positive_pairs)]
+        candidates = np.concatenate([sampled, candidates])
+        ## Keep first draw of each pair, in draw order
+        _, first = np.unique(candidates, return_index=True)
+        sampled = candidates[np.sort(first)][:n_samples]
+
+    return sampled
+
+
+class PairTemplates:
+    """Lazily generated templates (token ids) of (patient, condition) `pairs`, given as flat indices
+    patient_index * len(set_to_use) + condition_index into `subject_ids` x `set_to_use`
+    """
+
+    def __init__(
+        self,
+        compiler: TemplateCompiler,
+        subject_ids: List,
+        set_to_use: List[str],
+        pairs: np.ndarray,
+        subject_id_to_patient_info: Dict,
+        condition_code_to_description: Dict[str, str],
+        template_mode: str,
+    ):
+        if template_mode not in ["name_and_condition", "condition_only"]:
+            raise NotImplementedError(f"{template_mode} is not available")
+
+        self.compiler = compiler
+        self.subject_ids = subject_ids
+        self.set_to_use = set_to_use
+        self.pairs = pairs
+        self.subject_id_to_patient_info = subject_id_to_patient_info
+        self.condition_code_to_description = condition_code_to_description
+        self.template_mode = template_mode
+
+    def __len__(self) -> int:
+        return len(self.pairs)
+
+    def __iter__(self) -> Iterator[List[int]]:
+        for pair in self.pairs.tolist():
+            patient_index, condition_index = divmod(pair, len(self.set_to_use))
+            desc = self.condition_code_to_description[self.set_to_use[condition_index]]
+            if self.template_mode == "name_and_condition":
+                patient_info = self.subject_id_to_patient_info[self.subject_ids[patient_index]]
+                segments = generate_name_condition_segments(
+                    patient_info.FIRST_NAME, patient_info.LAST_NAME, patient_info.GENDER, desc
+                )
+            else:
+                segments = generate_condition_only_segments(desc)
+            yield self.compiler.compile(segments)[0]
 
 
 def run_probe(
@@ -32,6 +100,7 @@ def run_probe(
     template_mode: str,
     prober: str,
     metrics_output_path: str,
+    incremental: bool = False,
 ):
     """Train and evaluate the model trained on the data.
 
@@ -40,17 +109,19 @@ def run_probe(
         template_mode: Choices in [name_and_condition, condition_only].
                         Specify if name should be included in template
         prober: LR or MLP
+        incremental: Train prober with torch while training templates are embedded (see probes.py),
+                        instead of sklearn on all embeddings at once
     """
 
     ### Get Relevant Data
 
     subject_id_to_patient_info = get_subject_id_to_patient_info(condition_type=condition_type)
-    condition_code_to_count = get_condition_code_to_count(condition_type=condition_type)
-    condition_code_to_description = get_condition_code_to_descriptions(condition_type=condition_type)
+    catalog = get_condition_catalog(condition_type, tokenizer)
+    condition_code_to_description = dict(zip(catalog.get_codes(), catalog.get_descriptions()))
 
-    set_to_use = filter_condition_code_by_count(condition_code_to_count, min_count=0, max_count=500000)
+    set_to_use = catalog.get_set_to_use(min_count=0, max_count=500000)
 
-    condition_code_to_index: Dict[str, int] = dict(zip(set_to_use, range(len(set_to_use))))
+    label_matrix = get_condition_label_matrix(condition_type, set_to_use)
 
     ## Divide patients into train and test group
 
@@ -66,85 +137,84 @@ def run_probe(
 
     print(f"Train Subject Ids : {len(train_subject_ids)}")
     print(f"Test Subject Ids : {len(test_subject_ids)}")
-    import pdb; pdb.set_trace()
-
-    ## Get training example by generating template for all train patients and all conditions
 
-    subject_condition_templates = []
-    subject_condition_labels = []
-
-    for subject_id in train_subject_ids:
-        patient_info = subject_id_to_patient_info[subject_id]
-        for condition in set_to_use:
-            desc = condition_code_to_description[condition]
-            if template_mode == "name_and_condition":
-                template = generate_name_condition_template(
-                    patient_info.FIRST_NAME, patient_info.LAST_NAME, patient_info.GENDER, desc
-                )
-            elif template_mode == "condition_only":
-                template = generate_condition_only_template(desc)
-            else:
-                raise NotImplementedError(f"{template_mode} is not available")
-            subject_condition_templates.append(template)
+    ## Sample training (patient, condition) pairs first, as flat indices into train patients x set_to_use
 
-        condition_labels = get_condition_labels_as_vector(patient_info.CONDITIONS, condition_code_to_index)
-        subject_condition_labels += list(condition_labels)
+    train_label_rows, train_label_columns = label_matrix.get_rows(train_subject_ids).nonzero()
+    positive_pairs = np.sort(train_label_rows.astype(np.int64) * len(set_to_use) + train_label_columns)
 
     ## Downsample negative labels since most patients only have few positive conditions
-
-    negative_indices = [i for i, x in enumerate(subject_condition_labels) if x == 0]
-    positive_indices = [i for i, x in enumerate(subject_condition_labels) if x == 1]
-
-    negative_indices = resample(
-        negative_indices, replace=False, n_samples=len(positive_indices), random_state=2021
+    negative_pairs = sample_negative_pairs(
+        positive_pairs, len(train_subject_ids) * len(set_to_use), len(positive_pairs), random_state=2021
     )
-    total_indices = negative_indices + positive_indices
-
-    train_templates = [subject_condition_templates[i] for i in total_indices]
-    train_labels = [subject_condition_labels[i] for i in total_indices]
-
-    print(len(train_templates))
-
-    ## Get [CLS] token embedding for each template and train a LR classifier
-
-    train_cls_embeddings = get_cls_embeddings(model, tokenizer, train_templates)
+    train_pairs = np.concatenate([negative_pairs, positive_pairs])
+    train_labels = [0] * len(negative_pairs) + [1] * len(positive_pairs)
+
+    print(len(train_pairs))
+
+    ## Get [CLS] token embedding for each template (generated lazily) and train a LR classifier
+
+    if incremental:
+        ## Chunks are trained on as they are embedded, so they should mix positives and negatives
+        order = np.random.RandomState(2021).permutation(len(train_pairs))
+        train_pairs, train_labels = train_pairs[order], np.array(train_labels)[order]
+
+    compiler = TemplateCompiler(tokenizer)
+    train_templates = PairTemplates(
+        compiler,
+        train_subject_ids,
+        set_to_use,
+        train_pairs,
+        subject_id_to_patient_info,
+        condition_code_to_description,
+        template_mode,
+    )
+    train_cls_embeddings = iterate_cls_embeddings(model, compiler, train_templates, EMBEDDING_CHUNK_SIZE)
+    num_chunks = -(-len(train_templates) // EMBEDDING_CHUNK_SIZE)
 
     print(f"Training {prober} Model")
-    if prober == "LR":
-        classifier = LogisticRegression(random_state=2021, max_iter=10000).fit(
-            train_cls_embeddings, train_labels
-        )
-    elif prober == "MLP":
-        classifier = MLPClassifier(hidden_layer_sizes=(128,), random_state=2021).fit(
-            train_cls_embeddings, train_labels
+    if incremental:
+        train_chunks = (
+            (embeddings, train_labels[i * EMBEDDING_CHUNK_SIZE : (i + 1) * EMBEDDING_CHUNK_SIZE])
+            for i, embeddings in enumerate(train_cls_embeddings)
         )
+        classifier = IncrementalProbe(model.config.hidden_size, prober)
+        classifier.fit_chunks(tqdm(train_chunks, total=num_chunks))
     else:
-        raise NotImplementedError(f"{prober} not implemented")
+        train_cls_embeddings = np.concatenate(list(tqdm(train_cls_embeddings, total=num_chunks)))
+        if prober == "LR":
+            classifier = LogisticRegression(random_state=2021, max_iter=10000).fit(
+                train_cls_embeddings, train_labels
+            )
+        elif prober == "MLP":
+            classifier = MLPClassifier(hidden_layer_sizes=(128,), random_state=2021).fit(
+                train_cls_embeddings, train_labels
+            )
+        else:
+            raise NotImplementedError(f"{prober} not implemented")
     print(f"{prober} Model Trained")
 
     ## Get templates and labels for test set patients
 
     auc_scores, paks = [], []
 
+    condition_pairs = np.arange(len(set_to_use))
     for subject_id in tqdm(test_subject_ids):
-        test_templates = []
-        patient_info = subject_id_to_patient_info[subject_id]
-        for condition in set_to_use:
-            desc = condition_code_to_description[condition]
-            if template_mode == "name_and_condition":
-                template = generate_name_condition_template(
-                    patient_info.FIRST_NAME, patient_info.LAST_NAME, patient_info.GENDER, desc
-                )
-            elif template_mode == "condition_only":
-                template = generate_condition_only_template(desc)
-            else:
-                raise NotImplementedError(f"{template_mode} is not available")
-            test_templates.append(template)
+        test_templates = PairTemplates(
+            compiler,
+            [subject_id],
+            set_to_use,
+            condition_pairs,
+            subject_id_to_patient_info,
+            condition_code_to_description,
+            template_mode,
+        )
 
-        condition_labels = get_condition_labels_as_vector(patient_info.CONDITIONS, condition_code_to_index)
-        test_labels = list(condition_labels)
+        test_labels = label_matrix.get_row(subject_id)
 
-        test_cls_embeddings = get_cls_embeddings(model, tokenizer, test_templates, disable_tqdm=True)
+        test_cls_embeddings = get_cls_embeddings_from_ids(
+            model, compiler, list(test_templates), disable_tqdm=True
+        )
         test_predictions = classifier.predict_proba(test_cls_embeddings)[:, 1]
 
         try:
@@ -182,19 +252,39 @@ if __name__ == "__main__":
         required=True,
         help="Which probing model to train on top of BERT embeddings ?",
     )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Train prober (torch, CPU) on embedding chunks as they are produced, with early stopping",
+    )
+    parser.add_argument("--num-threads", type=int, help="CPU threads for --incremental prober")
     parser.add_argument("--metrics-output-path", type=str)
     args = parser.parse_args()
 
+    if args.num_threads is not None:
+        import torch
+
+        torch.set_num_threads(args.num_threads)
+
     tokenizer = BertTokenizerFast.from_pretrained(args.tokenizer)
-    model = BertModel.from_pretrained(args.model).cuda().eval()
+    model = load_cls_model(args.model)
 
     import os
 
     metrics_output_path = args.metrics_output_path if args.metrics_output_path is not None else args.model
     metrics_output_path = os.path.join(
         metrics_output_path,
-        f"all_conditions_probing/{args.condition_type}_{args.template_mode}_{args.prober}",
+        f"all_conditions_probing/{args.condition_type}_{args.template_mode}_{args.prober}"
+        + ("_incremental" if args.incremental else ""),
     )
     os.makedirs(metrics_output_path, exist_ok=True)
 
-    run_probe(model, tokenizer, args.condition_type, args.template_mode, args.prober, metrics_output_path)
+    run_probe(
+        model,
+        tokenizer,
+        args.condition_type,
+        args.template_mode,
+        args.prober,
+        metrics_output_path,
+        incremental=args.incremental,
+    )
@@ -1,38 +1,165 @@
-from typing import List
+import hashlib
+import os
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional
 
 import numpy as np
 import torch
+from experiments.embedding_cache import EmbeddingCache, get_template_key
+from experiments.templates import Segment, TemplateCompiler, segments_to_string
+from setup_scripts.entity_cache import get_model_fingerprint
 from tqdm import tqdm
+from transformers import BertModel
+
+cls_embedding_caches: Dict[int, Optional[EmbeddingCache]] = {}
+
+
+def load_cls_model(model_path: str) -> BertModel:
+    """BertModel at `model_path` on GPU in eval mode. Records whether its pooler (which gives the CLS
+    embeddings) was in the checkpoint: MLM checkpoints have none, and the pooler is then randomly initialized.
+    """
+    model, loading_info = BertModel.from_pretrained(model_path, output_loading_info=True)
+    model.pooler_from_checkpoint = not any(key.startswith("pooler.") for key in loading_info["missing_keys"])
+    return model.cuda().eval()
+
+
+def get_cls_model_fingerprint(model) -> str:
+    """Identify model by its files (if loaded from a local folder) and its pooler weights.
+
+    A pooler missing from the checkpoint is randomly initialized on every load, so such a model gets a new
+    fingerprint (and cache folder) each run. get_cls_embedding_cache skips the cache for those (when loaded
+    with load_cls_model).
+    """
+    name_or_path = model.config._name_or_path
+    paths = []
+    if os.path.isdir(name_or_path):
+        paths = sorted(os.path.join(name_or_path, name) for name in os.listdir(name_or_path))
+        paths = [path for path in paths if os.path.isfile(path)]
+
+    pooler_checksum = ""
+    if getattr(model, "pooler", None) is not None:
+        weight = model.pooler.dense.weight.detach().float().cpu().numpy()
+        pooler_checksum = hashlib.sha1(weight.tobytes()).hexdigest()
+
+    return get_model_fingerprint(*paths, extra=f"{type(model).__name__}|{name_or_path}|{pooler_checksum}")
+
+
+def get_cls_embedding_cache(model) -> Optional[EmbeddingCache]:
+    """EmbeddingCache of model in CLS_EMBEDDING_CACHE folder, None if environment variable is not set or the
+    pooler of model was randomly initialized (see load_cls_model), as its embeddings change on every load
+    """
+    if "CLS_EMBEDDING_CACHE" not in os.environ:
+        return None
+
+    if id(model) not in cls_embedding_caches:
+        if not getattr(model, "pooler_from_checkpoint", True):
+            cls_embedding_caches[id(model)] = None
+            print("Not using CLS embedding cache, pooler of model is randomly initialized (not in checkpoint)")
+        else:
+            cls_embedding_caches[id(model)] = EmbeddingCache(
+                os.environ["CLS_EMBEDDING_CACHE"], get_cls_model_fingerprint(model), model.config.hidden_size
+            )
+            print(f"Using CLS embedding cache {cls_embedding_caches[id(model)].path}")
+
+    return cls_embedding_caches[id(model)]
 
 
 def get_cls_embeddings(model, tokenizer, templates: List[str], disable_tqdm: bool = False) -> np.ndarray:
+    split_texts = [template.split() for template in templates]
+    encoded = tokenizer(text=split_texts, is_split_into_words=True, add_special_tokens=False)["input_ids"]
+    return get_cls_embeddings_from_ids(model, TemplateCompiler(tokenizer), encoded, disable_tqdm=disable_tqdm)
+
+
+def get_cls_embeddings_from_ids(
+    model, compiler: TemplateCompiler, encoded: List[List[int]], disable_tqdm: bool = False
+) -> np.ndarray:
+    """Same as get_cls_embeddings, for templates already compiled to token ids.
+
+    With CLS_EMBEDDING_CACHE set, embeddings are read from the cache and only templates never seen by the
+    model are passed through it (once each). Cached embeddings are float16, so all returned embeddings are
+    rounded to float16 precision, whether they were cached or not.
+    """
+    cache = get_cls_embedding_cache(model)
+    if cache is None:
+        return compute_cls_embeddings(model, compiler, encoded, disable_tqdm=disable_tqdm)
+
+    keys = [get_template_key(input_ids) for input_ids in encoded]
+    embeddings, found = cache.get(keys)
+
+    ## First occurrence of each missing template
+    missing = {}
+    for i in np.flatnonzero(~found).tolist():
+        missing.setdefault(keys[i], i)
+
+    if len(missing) > 0:
+        computed = compute_cls_embeddings(
+            model, compiler, [encoded[i] for i in missing.values()], disable_tqdm=disable_tqdm
+        )
+        cache.put(list(missing.keys()), computed)
+        computed = computed.astype(np.float16).astype(np.float32)
+
+        key_to_computed = dict(zip(missing.keys(), range(len(missing))))
+        for i in np.flatnonzero(~found).tolist():
+            embeddings[i] = computed[key_to_computed[keys[i]]]
+
+    return embeddings
+
+
+def iterate_cls_embeddings(
+    model, compiler: TemplateCompiler, templates: Iterable[List[int]], chunk_size: int = 20000
+) -> Iterator[np.ndarray]:
+    """Embeddings (as get_cls_embeddings_from_ids) of `templates` in chunks of `chunk_size` templates.
+    Templates are pulled from the iterable one chunk at a time, so they can be generated lazily.
+    """
+    templates = iter(templates)
+    while True:
+        chunk = list(islice(templates, chunk_size))
+        if len(chunk) == 0:
+            return
+        yield get_cls_embeddings_from_ids(model, compiler, chunk, disable_tqdm=True)
+
+
+def compute_cls_embeddings(
+    model, compiler: TemplateCompiler, encoded: List[List[int]], disable_tqdm: bool = False
+) -> np.ndarray:
+    """Pooler output of model for each template in `encoded`"""
     embeddings = []
     batch_size = 2000
-    for b in tqdm(range(0, len(templates), batch_size), disable=disable_tqdm):
-        batch = templates[b : b + batch_size]
-        split_texts = [template.split() for template in batch]
-        batch = tokenizer(
-            text=split_texts,
-            is_split_into_words=True,
-            padding=True,
-            return_tensors="pt",
-            add_special_tokens=False,
-        )
+    for b in tqdm(range(0, len(encoded), batch_size), disable=disable_tqdm):
+        input_ids, attention_mask = compiler.pad(encoded[b : b + batch_size])
 
         with torch.no_grad():
-            predictions = model(batch.input_ids.cuda(), attention_mask=batch.attention_mask.cuda())
+            predictions = model(input_ids.cuda(), attention_mask=attention_mask.cuda())
             cls_embeddings = predictions.pooler_output.cpu().data.numpy()
             embeddings.append(cls_embeddings)
 
     return np.concatenate(embeddings, axis=0)
 
 
+def generate_condition_only_segments(condition_description: str) -> List[Segment]:
+    return ["[CLS]", ("condition", condition_description.strip()), "[SEP]"]
+
+
 def generate_condition_only_template(condition_description: str):
-    return f"[CLS] {condition_description.strip()} [SEP]"
+    return segments_to_string(generate_condition_only_segments(condition_description))
+
+
+def generate_name_condition_segments(
+    first_name: str, last_name: str, gender: str, condition_description: str
+) -> List[Segment]:
+    title = "Mr" if gender == "M" else "Mrs"  # I guess just assume married w/e idk ?
+    return [
+        f"[CLS] {title}",
+        ("name", f"{first_name} {last_name}"),
+        "is a yo patient with",
+        ("condition", condition_description),
+        "[SEP]",
+    ]
 
 
 def generate_name_condition_template(
     first_name: str, last_name: str, gender: str, condition_description: str
 ):
-    title = "Mr" if gender == "M" else "Mrs"  # I guess just assume married w/e idk ?
-    return f"[CLS] {title} {first_name} {last_name} is a yo patient with {condition_description} [SEP]"
+    return segments_to_string(
+        generate_name_condition_segments(first_name, last_name, gender, condition_description)
+    )
@@ -2,12 +2,12 @@ import argparse
 
 import numpy as np
 from experiments.metrics import precision_at_k
-from experiments.probing.common import get_cls_embeddings
+from experiments.probing.common import get_cls_embeddings, load_cls_model
 from experiments.utilities import get_patient_name_to_is_reidentified
 from sklearn.linear_model import LogisticRegression
 from sklearn.metrics import roc_auc_score
 from sklearn.model_selection import train_test_split
-from transformers import BertModel, BertTokenizer
+from transformers import BertTokenizer
 
 
 def generate_name_templates(name):
@@ -60,7 +60,7 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     tokenizer = BertTokenizer.from_pretrained(args.tokenizer)
-    model = BertModel.from_pretrained(args.model).cuda().eval()
+    model = load_cls_model(args.model)
 
     import os
     metrics_output_path = args.metrics_output_path if args.metrics_output_path is not None else args.model
@@ -0,0 +1,345 @@
+"""
+Torch Probes
+============
+
+Probes (logistic regression or one hidden layer MLP) trained with torch on CPU threads from a stream of
+(embeddings, labels) chunks, so the training set never has to be embedded or held in memory at once:
+
+    - each chunk is trained on as it arrives (mini-batch SGD for LR, Adam for MLP, like sklearn's MLP)
+    - the next chunk is produced in a background thread meanwhile (e.g. BERT embeddings on GPU)
+    - a slice of the first chunks is held out, and training stops early once its loss stops improving
+
+BatchedMLPProbe trains many independent MLP probes (one per condition) at once, vectorized over probes.
+
+Predictions follow sklearn (`predict_proba(X)[:, 1]`), so probes can be used in place of the sklearn models.
+"""
+
+import queue
+import threading
+from typing import Iterable, Iterator, List, Tuple
+
+import numpy as np
+import torch
+
+
+def prefetch(iterator: Iterable, size: int = 1) -> Iterator:
+    """Iterate over `iterator` in a background thread, producing up to `size` items ahead"""
+    items = queue.Queue(maxsize=size)
+    done = object()
+    stop = threading.Event()
+
+    def produce():
+        try:
+            items_iterator = iter(iterator)
+            ## Check before pulling each item, so nothing more is produced once the consumer stopped
+            while not stop.is_set():
+                try:
+                    item = next(items_iterator)
+                except StopIteration:
+                    items.put(done)
+                    return
+                items.put(item)
+        except BaseException as e:
+            items.put(e)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        ## Consumer stopped early (e.g. early stopping), let the producer finish its current item and exit
+        stop.set()
+        while thread.is_alive():
+            try:
+                items.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+class IncrementalProbe:
+    """LR or MLP probe on `input_dim` dimensional embeddings, trained chunk by chunk.
+
+    ### Args:
+        prober: LR or MLP (one hidden layer of `hidden_size` relu units)
+        passes_per_chunk: Epochs over each chunk before moving to the next one
+        validation_size: Number of examples held out (from the first chunks) for early stopping
+        patience: Stop after this many chunks without improvement of validation loss
+    """
+
+    def __init__(
+        self,
+        input_dim: int,
+        prober: str = "LR",
+        hidden_size: int = 128,
+        learning_rate: float = None,
+        weight_decay: float = 1e-4,
+        batch_size: int = 256,
+        passes_per_chunk: int = 5,
+        validation_size: int = 10000,
+        patience: int = 3,
+        random_state: int = 2021,
+    ):
+        generator = torch.Generator().manual_seed(random_state)
+        self.random_state = np.random.RandomState(random_state)
+
+        if prober == "LR":
+            self.model = torch.nn.Linear(input_dim, 1)
+            self.optimizer = torch.optim.SGD(
+                self.model.parameters(),
+                lr=learning_rate if learning_rate is not None else 1e-2,
+                momentum=0.9,
+                weight_decay=weight_decay,
+            )
+        elif prober == "MLP":
+            self.model = torch.nn.Sequential(
+                torch.nn.Linear(input_dim, hidden_size), torch.nn.ReLU(), torch.nn.Linear(hidden_size, 1)
+            )
+            self.optimizer = torch.optim.Adam(
+                self.model.parameters(),
+                lr=learning_rate if learning_rate is not None else 1e-3,
+                weight_decay=weight_decay,
+            )
+        else:
+            raise NotImplementedError(f"{prober} not implemented")
+
+        ## torch's default Linear initialization, from the local generator instead of the global seed
+        with torch.no_grad():
+            for layer in self.model.modules():
+                if isinstance(layer, torch.nn.Linear):
+                    bound = 1 / np.sqrt(layer.in_features)
+                    for p in (layer.weight, layer.bias):
+                        p.copy_((torch.rand(p.shape, generator=generator) * 2 - 1) * bound)
+
+        self.batch_size = batch_size
+        self.passes_per_chunk = passes_per_chunk
+        self.validation_size = validation_size
+        self.patience = patience
+
+        self.validation_X, self.validation_y = [], []
+        self.best_loss, self.best_state, self.chunks_without_improvement = np.inf, None, 0
+
+    def loss(self, X: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
+        return torch.nn.functional.binary_cross_entropy_with_logits(self.model(X).squeeze(-1), y)
+
+    def hold_out(self, X: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Move up to the remaining validation size of (X, y) to the validation set, return the rest"""
+        num_held_out = sum(len(v) for v in self.validation_y)
+        n = min(self.validation_size - num_held_out, len(y) // 2)
+        if n <= 0:
+            return X, y
+
+        self.validation_X.append(X[:n])
+        self.validation_y.append(y[:n])
+        return X[n:], y[n:]
+
+    def partial_fit(self, X: np.ndarray, y: np.ndarray):
+        """Train on one chunk, `passes_per_chunk` epochs of shuffled mini-batches"""
+        X = torch.as_tensor(np.asarray(X, dtype=np.float32))
+        y = torch.as_tensor(np.asarray(y, dtype=np.float32))
+
+        self.model.train()
+        for _ in range(self.passes_per_chunk):
+            order = torch.from_numpy(self.random_state.permutation(len(y)))
+            for b in range(0, len(y), self.batch_size):
+                batch = order[b : b + self.batch_size]
+                self.optimizer.zero_grad()
+                self.loss(X[batch], y[batch]).backward()
+                self.optimizer.step()
+
+        return self
+
+    def validation_loss(self) -> float:
+        self.model.eval()
+        with torch.no_grad():
+            X = torch.as_tensor(np.concatenate(self.validation_X).astype(np.float32))
+            y = torch.as_tensor(np.concatenate(self.validation_y).astype(np.float32))
+            return self.loss(X, y).item()
+
+    def fit_chunks(self, chunks: Iterable[Tuple[np.ndarray, np.ndarray]]):
+        """Train on a stream of (X, y) chunks (should be shuffled), produced in a background thread meanwhile.
+        Stops consuming the stream on early stopping, and keeps the parameters with the best validation loss.
+        """
+        for X, y in prefetch(chunks):
+            X, y = self.hold_out(X, y)
+            self.partial_fit(X, y)
+
+            loss = self.validation_loss()
+            if loss < self.best_loss:
+                self.best_loss, self.chunks_without_improvement = loss, 0
+                self.best_state = {k: v.clone() for k, v in self.model.state_dict().items()}
+            else:
+                self.chunks_without_improvement += 1
+                if self.chunks_without_improvement >= self.patience:
+                    print(f"Early stopping, best validation loss {self.best_loss}")
+                    break
+
+        if self.best_state is not None:
+            self.model.load_state_dict(self.best_state)
+
+        return self
+
+    def predict_proba(self, X: np.ndarray) -> np.ndarray:
+        self.model.eval()
+        with torch.no_grad():
+            positive = torch.sigmoid(self.model(torch.as_tensor(np.asarray(X, dtype=np.float32))).squeeze(-1))
+        positive = positive.numpy()
+        return np.stack([1 - positive, positive], axis=1)
+
+
+class BatchedMLPProbe:
+    """`num_heads` independent one hidden layer MLP probes (as sklearn MLPClassifier(hidden_layer_sizes=(128,)))
+    trained at once, vectorized over heads. Head k only sees its own inputs X[k] and training examples.
+
+    Training follows MLPClassifier defaults step for step: same initialization and shuffling (random state per
+    head), each epoch goes once through a head's own shuffled examples in mini-batches of `batch_size` (the last
+    one smaller), with Adam (sklearn's update rule, step count per head) and L2 penalty `alpha`. A head stops
+    training once its epoch loss has not improved by `tol` for more than `n_iter_no_change` epochs. Heads with
+    fewer mini-batches than others are padded, and padded steps update nothing.
+    """
+
+    def __init__(
+        self,
+        num_heads: int,
+        input_dim: int,
+        hidden_size: int = 128,
+        learning_rate: float = 1e-3,
+        alpha: float = 1e-4,
+        batch_size: int = 200,
+        max_iter: int = 200,
+        tol: float = 1e-4,
+        n_iter_no_change: int = 10,
+        random_state: int = 2021,
+    ):
+        ## Each head draws its initialization and shuffling from its own RandomState(random_state), in the same
+        ## order as MLPClassifier(random_state=random_state) does
+        self.random_states = [np.random.RandomState(random_state) for _ in range(num_heads)]
+
+        ## Glorot uniform initialization, as sklearn
+        parameters = [[], [], [], []]
+        for random_state_k in self.random_states:
+            for layer, (fan_in, fan_out) in enumerate([(input_dim, hidden_size), (hidden_size, 1)]):
+                bound = np.sqrt(6 / (fan_in + fan_out))
+                parameters[2 * layer].append(random_state_k.uniform(-bound, bound, (fan_in, fan_out)))
+                parameters[2 * layer + 1].append(random_state_k.uniform(-bound, bound, fan_out))
+
+        W1, b1, W2, b2 = (torch.as_tensor(np.stack(p), dtype=torch.float32) for p in parameters)
+        self.W1, self.b1 = torch.nn.Parameter(W1), torch.nn.Parameter(b1)
+        self.W2, self.b2 = torch.nn.Parameter(W2[:, :, 0]), torch.nn.Parameter(b2[:, 0])
+        self.parameters = [self.W1, self.b1, self.W2, self.b2]
+
+        ## Adam state, with its own step count per head
+        self.learning_rate = learning_rate
+        self.first_moments = [torch.zeros_like(p) for p in self.parameters]
+        self.second_moments = [torch.zeros_like(p) for p in self.parameters]
+        self.steps = torch.zeros(num_heads)
+
+        self.alpha = alpha
+        self.batch_size = batch_size
+        self.max_iter = max_iter
+        self.tol = tol
+        self.n_iter_no_change = n_iter_no_change
+
+    def forward(self, X: torch.Tensor, heads: torch.Tensor = None) -> torch.Tensor:
+        """Logits (H, B) of inputs X (H, B, input_dim) of `heads` (default all)"""
+        W1, b1, W2, b2 = (p if heads is None else p[heads] for p in self.parameters)
+        hidden = torch.relu(torch.baddbmm(b1[:, None, :], X, W1))
+        return (hidden * W2[:, None, :]).sum(-1) + b2[:, None]
+
+    def adam_step(
+        self, update: torch.Tensor, beta_1: float = 0.9, beta_2: float = 0.999, epsilon: float = 1e-8
+    ):
+        """Adam update (as sklearn's AdamOptimizer) of the parameters of heads where `update` (H,) is True"""
+        self.steps += update.float()
+        ## Heads never updated yet (step 0) get a learning rate of 0 instead of 0 / 0
+        bias_correction = (1 - beta_1 ** self.steps).clamp(min=1e-12)
+        learning_rates = self.learning_rate * torch.sqrt(1 - beta_2 ** self.steps) / bias_correction
+        with torch.no_grad():
+            for p, m, v in zip(self.parameters, self.first_moments, self.second_moments):
+                shape = (-1,) + (1,) * (p.dim() - 1)
+                mask = update.view(shape)
+                m.copy_(torch.where(mask, beta_1 * m + (1 - beta_1) * p.grad, m))
+                v.copy_(torch.where(mask, beta_2 * v + (1 - beta_2) * p.grad ** 2, v))
+                p -= torch.where(mask, learning_rates.view(shape) * m / (torch.sqrt(v) + epsilon), 0.0)
+                p.grad = None
+
+    def fit(self, X: np.ndarray, y: np.ndarray, indices: List[np.ndarray]):
+        """Train head k on examples X[k][indices[k]] with labels y[k][indices[k]].
+
+        ### Args:
+            X: (num_heads, N, input_dim) inputs of each head
+            y: (num_heads, N) binary labels
+            indices: Training examples of each head (may repeat, e.g. upsampled)
+        """
+        num_heads = len(indices)
+        sizes = np.array([len(index) for index in indices])
+        steps_per_epoch = int(max((sizes + self.batch_size - 1) // self.batch_size))
+        padded_size = steps_per_epoch * self.batch_size
+        heads = np.arange(num_heads)[:, None]
+
+        ## Example k of each padded epoch is real if k < size of the head
+        valid = np.arange(padded_size)[None, :] < sizes[:, None]
+        valid = valid.reshape(num_heads, steps_per_epoch, self.batch_size)
+
+        active = np.ones(num_heads, dtype=bool)
+        best_loss = np.full(num_heads, np.inf)
+        epochs_no_change = np.zeros(num_heads, dtype=np.int64)
+        ## Epochs each head trained for (as MLPClassifier.n_iter_)
+        self.n_iter = np.zeros(num_heads, dtype=np.int64)
+
+        ## Shuffled again before each epoch, starting from the previous order (as MLPClassifier)
+        sample_orders = [np.arange(len(index)) for index in indices]
+        for epoch in range(self.max_iter):
+            orders = np.zeros((num_heads, padded_size), dtype=np.int64)
+            for k, index in enumerate(indices):
+                sample_orders[k] = sample_orders[k][self.random_states[k].permutation(len(index))]
+                orders[k, : len(index)] = np.asarray(index)[sample_orders[k]]
+            orders = orders.reshape(num_heads, steps_per_epoch, self.batch_size)
+
+            epoch_loss = torch.zeros(num_heads)
+            for step in range(steps_per_epoch):
+                batch = orders[:, step]
+                mask = torch.as_tensor(valid[:, step], dtype=torch.float32)
+                counts = mask.sum(-1)
+                update = torch.as_tensor(active) & (counts > 0)
+                X_batch = torch.as_tensor(X[heads, batch].astype(np.float32))
+                y_batch = torch.as_tensor(y[heads, batch].astype(np.float32))
+
+                ## Per head mean loss over its real examples of the batch, L2 penalty scaled by that count
+                counts = counts.clamp(min=1)
+                losses = torch.nn.functional.binary_cross_entropy_with_logits(
+                    self.forward(X_batch), y_batch, reduction="none"
+                )
+                losses = (losses * mask).sum(-1) / counts
+                penalty = (self.W1 ** 2).sum((1, 2)) + (self.W2 ** 2).sum(1)
+                losses = losses + self.alpha * penalty / (2 * counts)
+
+                (losses * update.float()).sum().backward()
+                self.adam_step(update)
+                epoch_loss += losses.detach() * mask.sum(-1)
+
+            self.n_iter += active
+            ## Same counting as sklearn's _update_no_improvement_count
+            epoch_loss = (epoch_loss / torch.as_tensor(sizes, dtype=torch.float32)).numpy()
+            improved = epoch_loss <= best_loss - self.tol
+            epochs_no_change = np.where(active, np.where(improved, 0, epochs_no_change + 1), epochs_no_change)
+            best_loss = np.where(active, np.minimum(best_loss, epoch_loss), best_loss)
+
+            active &= epochs_no_change <= self.n_iter_no_change
+            if not active.any():
+                print(f"All heads converged after {epoch + 1} epochs")
+                break
+
+        return self
+
+    def predict_proba(self, X: np.ndarray, head: int) -> np.ndarray:
+        """sklearn style probabilities (N, 2) of head `head` for inputs X (N, input_dim)"""
+        with torch.no_grad():
+            X = torch.as_tensor(np.asarray(X, dtype=np.float32))[None]
+            positive = torch.sigmoid(self.forward(X, torch.tensor([head])))[0].numpy()
+        return np.stack([1 - positive, positive], axis=1)
@@ -0,0 +1,84 @@
+"""
+Template Compiler
+=================
+
+Experiments build millions of templates like `[CLS] Mr {name} is a yo patient with {condition} [SEP]` that only
+differ in a few segments. Instead of tokenizing every template string, a template is given as a list of
+segments, each segment is tokenized once (and cached), and templates are assembled by concatenating the
+token ids of their segments. Segments can be named, to get their (start, end) token span in the template
+directly.
+
+Tokenization is the same as for `tokenizer(text=template.split(), is_split_into_words=True,
+add_special_tokens=False)`, i.e. every whitespace separated word is tokenized on its own, so segments split
+at word boundaries give identical ids.
+
+    compiler = TemplateCompiler(tokenizer)
+    input_ids, spans = compiler.compile(["[CLS]", "Mr", ("name", "john doe"), "is a yo patient with",
+                                         ("condition", "heart failure"), "[SEP]"])
+    spans["condition"]  ## (start, end) of condition wordpieces in input_ids
+"""
+
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+import torch
+
+Segment = Union[str, Tuple[str, str]]
+
+
+def mask_string(length: int) -> str:
+    return " ".join(["[MASK]"] * length)
+
+
+def segments_to_string(segments: List[Segment]) -> str:
+    """Template string equivalent to segments (what the experiments used to build)"""
+    return " ".join(segment if isinstance(segment, str) else segment[1] for segment in segments)
+
+
+def pad_templates(encoded: List[List[int]], pad_token_id: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Return (input_ids, attention_mask) tensors of right padded `encoded` templates"""
+    lengths = [len(input_ids) for input_ids in encoded]
+    input_ids = np.full((len(encoded), max(lengths)), pad_token_id, dtype=np.int64)
+    attention_mask = np.zeros_like(input_ids)
+    for i, (ids, length) in enumerate(zip(encoded, lengths)):
+        input_ids[i, :length] = ids
+        attention_mask[i, :length] = 1
+
+    return torch.from_numpy(input_ids), torch.from_numpy(attention_mask)
+
+
+class TemplateCompiler:
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.cache: Dict[str, List[int]] = {}
+
+    def encode(self, text: str) -> List[int]:
+        """Token ids of text (cached)"""
+        if text not in self.cache:
+            words = text.split()
+            self.cache[text] = (
+                self.tokenizer(text=words, is_split_into_words=True, add_special_tokens=False)["input_ids"]
+                if len(words) > 0
+                else []
+            )
+        return self.cache[text]
+
+    def compile(self, segments: List[Segment]) -> Tuple[List[int], Dict[str, Tuple[int, int]]]:
+        """Return token ids of template made of `segments`, and (start, end) span of each named segment.
+
+        ### Args:
+            segments: Each segment is either a string, or a tuple (name, string) for named segments
+        """
+        input_ids, spans = [], {}
+        for segment in segments:
+            name, text = (None, segment) if isinstance(segment, str) else segment
+            segment_ids = self.encode(text)
+            if name is not None:
+                spans[name] = (len(input_ids), len(input_ids) + len(segment_ids))
+            input_ids = input_ids + segment_ids
+
+        return input_ids, spans
+
+    def pad(self, encoded: List[List[int]]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Return (input_ids, attention_mask) tensors of right padded `encoded` templates"""
+        return pad_templates(encoded, self.tokenizer.pad_token_id)
@@ -1,6 +1,10 @@
 import config
-import pandas as pd
+import numpy as np
 from collections import namedtuple
+from scipy.sparse import csr_matrix
+
+from experiments.condition_catalog import ConditionCatalog
+from experiments.patient_store import PatientStore
 
 from typing import Dict, List, Set
 
@@ -15,13 +19,35 @@ def is_debugging_mode() -> bool:
     return False
 
 
+patient_stores: Dict[tuple, PatientStore] = {}
+
+
+def get_patient_store(condition_type: str = None) -> PatientStore:
+    """Return PatientStore for condition_type (loaded once per process, built once per version of the data)"""
+    key = (condition_type, is_debugging_mode())
+    if key not in patient_stores:
+        patient_stores[key] = PatientStore(condition_type, debug=key[1])
+
+    return patient_stores[key]
+
+
+condition_catalogs: Dict[tuple, ConditionCatalog] = {}
+
+
+def get_condition_catalog(condition_type: str, tokenizer) -> ConditionCatalog:
+    """Return ConditionCatalog of condition_type for tokenizer (loaded once per process, built once per version
+    of the patient store and tokenizer vocabulary)
+    """
+    key = (condition_type, is_debugging_mode(), id(tokenizer))
+    if key not in condition_catalogs:
+        condition_catalogs[key] = ConditionCatalog(condition_type, tokenizer, get_patient_store(condition_type))
+
+    return condition_catalogs[key]
+
+
 def get_reidentified_subject_ids_set() -> Set[str]:
     """Return the set of subject ids for patients that had their names occur in notes"""
-    subject_ids = pd.read_csv(config.MODIFIED_SUBJECT_IDS).SUBJECT_ID.values
-    if is_debugging_mode():
-        subject_ids = subject_ids[:1000]
-
-    return set(subject_ids)
+    return set(get_patient_store().reidentified_subject_ids.tolist())
 
 
 PatientInfo = namedtuple("PatientInfo", field_names=["FIRST_NAME", "LAST_NAME", "GENDER", "CONDITIONS"])
@@ -33,57 +59,34 @@ def get_subject_id_to_patient_info(condition_type: str) -> Dict[str, PatientInfo
     ### Args:
         condition_type: What conditions to include in PatientInfo. Takes value in [icd9, stanza]
     """
-    subject_id_to_names = pd.read_csv(config.SUBJECT_ID_to_NAME)
-    subject_id_to_names.fillna("", inplace=True)
-
     assert (
         condition_type in config.condition_type_to_file
     ), f"Unknown Condition type, Select From {list(config.condition_type_to_file.keys())}"
 
-    ## Select ICD9 or Stanza on basis of condition_type
-    subject_id_to_condition_codes = pd.read_csv(config.condition_type_to_file[condition_type])
-
-    ## Filter to reidentified subject ids only
-    reidentified_subject_ids = get_reidentified_subject_ids_set()
-    subject_id_to_names = subject_id_to_names[subject_id_to_names.SUBJECT_ID.isin(reidentified_subject_ids)]
-    subject_id_to_condition_codes = subject_id_to_condition_codes[
-        subject_id_to_condition_codes.SUBJECT_ID.isin(reidentified_subject_ids)
-    ]
-
-    ## Convert to subject_id to list of conditions
-    subject_id_to_condition_codes = (
-        subject_id_to_condition_codes.groupby("SUBJECT_ID")["CODE"]
-        .apply(lambda x: sorted(list(x.values)))
-        .reset_index()
-    )
+    store = get_patient_store(condition_type)
+    first_names, last_names, genders = (store.get_strings(c) for c in ["FIRST_NAME", "LAST_NAME", "GENDER"])
+    codes = store.get_codes()
+    condition_indices = store.condition_indices.tolist()
+    offsets = store.condition_offsets.tolist()
 
-    ## Merge condition info with demographics
-    subject_id_info = subject_id_to_names.merge(subject_id_to_condition_codes, on="SUBJECT_ID")
+    subject_id_to_patient_info = {}
+    for i, row in enumerate(store.patient_rows.tolist()):
+        conditions = [codes[j] for j in condition_indices[offsets[i] : offsets[i + 1]]]
+        subject_id_to_patient_info[int(store.subject_ids[row])] = PatientInfo(
+            first_names[row], last_names[row], genders[row], conditions
+        )
 
-    ## Create dictionary mapping subject id to patient info
-    first_names = list(subject_id_info["FIRST_NAME"].values)
-    last_names = list(subject_id_info["LAST_NAME"].values)
-    genders = list(subject_id_info["GENDER"].values)
-    conditions = list(subject_id_info["CODE"].values)
-
-    patient_info = [PatientInfo(*tup) for tup in zip(first_names, last_names, genders, conditions)]
-    subject_ids = list(subject_id_info["SUBJECT_ID"].values)
-
-    return dict(zip(subject_ids, patient_info))
+    return subject_id_to_patient_info
 
 
 def get_patient_name_to_is_reidentified() -> Dict[str, int]:
     """Return a Dict mapping patient full name to label indicating whether the patient was reidentified."""
-    subject_id_to_name = pd.read_csv(config.SUBJECT_ID_to_NAME)
-    subject_id_to_name.fillna("", inplace=True)
-
-    reidentified_subject_ids: Set[str] = get_reidentified_subject_ids_set()
-
-    subject_id_to_name["MODIFIED"] = subject_id_to_name.SUBJECT_ID.apply(
-        lambda x: 1 if x in reidentified_subject_ids else 0
-    )
-    names: List[str] = list((subject_id_to_name.FIRST_NAME + " " + subject_id_to_name.LAST_NAME).values)
-    reidentified: List[int] = list(subject_id_to_name.MODIFIED.values)
+    store = get_patient_store()
+    names: List[str] = [
+        first_name + " " + last_name
+        for first_name, last_name in zip(store.get_strings("FIRST_NAME"), store.get_strings("LAST_NAME"))
+    ]
+    reidentified: List[int] = np.isin(store.subject_ids, store.reidentified_subject_ids).astype(int).tolist()
 
     labeled_names: Dict[str, int] = dict(zip(names, reidentified))
 
@@ -100,17 +103,16 @@ def get_condition_code_to_count(condition_type: str) -> Dict[str, int]:
     ### Args:
         condition_type: What conditions to return count of. Takes value in [icd9, stanza]
     """
-    reidentified_subject_ids = get_reidentified_subject_ids_set()
-
     assert (
         condition_type in config.condition_type_to_file
     ), f"Unknown Condition type, Select From {list(config.condition_type_to_file.keys())}"
 
-    subject_id_to_icd = pd.read_csv(config.condition_type_to_file[condition_type])
+    store = get_patient_store(condition_type)
+    codes, counts = store.get_codes(), store.code_counts.tolist()
 
-    ## Filter to reidentified subject ids only
-    subject_id_to_icd = subject_id_to_icd[subject_id_to_icd.SUBJECT_ID.isin(reidentified_subject_ids)]
-    return subject_id_to_icd.CODE.value_counts().to_dict()
+    ## Most frequent first, like value_counts
+    order = np.argsort(-store.code_counts, kind="stable").tolist()
+    return {codes[i]: counts[i] for i in order}
 
 
 def get_condition_code_to_descriptions(condition_type: str) -> Dict[str, str]:
@@ -119,10 +121,8 @@ def get_condition_code_to_descriptions(condition_type: str) -> Dict[str, str]:
     ### Args:
         condition_type: What conditions to return descriptions of. Takes value in [icd9, stanza]
     """
-    code_description_df = pd.read_csv(config.condition_type_to_descriptions[condition_type])
-    return dict(
-        zip(list(code_description_df["CODE"].values), list(code_description_df["DESCRIPTION"].values))
-    )
+    codes, descriptions = get_patient_store(condition_type).get_descriptions()
+    return dict(zip(codes, descriptions))
 
 
 def filter_condition_code_by_count(
@@ -186,3 +186,64 @@ def get_condition_labels_as_vector(
             label_vector[condition_code_to_index[code]] = 1
 
     return label_vector
+
+
+class ConditionLabelMatrix:
+    """Binary labels of patients x conditions (`set_to_use`) as scipy.sparse CSR matrix, built once per experiment.
+
+    ### Args:
+        subject_ids: Subject id of each row
+        labels: CSR matrix of shape (len(subject_ids), len(set_to_use)), 1 if patient has condition
+        counts: Count of occurrence of each condition (same as get_condition_counts_as_vector)
+    """
+
+    def __init__(self, subject_ids: np.ndarray, labels: csr_matrix, counts: np.ndarray):
+        self.subject_ids = subject_ids
+        self.labels = labels
+        self.counts = counts
+        self.subject_id_to_row = {subject_id: row for row, subject_id in enumerate(subject_ids.tolist())}
+
+    def get_row(self, subject_id) -> np.ndarray:
+        """Dense label vector of patient (same as get_condition_labels_as_vector)"""
+        return self.labels[self.subject_id_to_row[subject_id]].toarray().ravel()
+
+    def get_rows(self, subject_ids: List) -> csr_matrix:
+        """CSR labels of patients `subject_ids`, in that order"""
+        return self.labels[[self.subject_id_to_row[subject_id] for subject_id in subject_ids]]
+
+    def get_num_positives(self) -> np.ndarray:
+        """Number of positive conditions of each row"""
+        return self.labels.getnnz(axis=1)
+
+    @staticmethod
+    def get_column_masks(column_bins: np.ndarray) -> Dict:
+        """Boolean column mask for each unique value of `column_bins` (bin of each condition), plus "all" """
+        masks = {value: column_bins == value for value in np.unique(column_bins).tolist()}
+        masks["all"] = np.ones(len(column_bins), dtype=bool)
+        return masks
+
+
+def get_condition_label_matrix(condition_type: str, set_to_use: List[str]) -> ConditionLabelMatrix:
+    """Return ConditionLabelMatrix of all patients in get_subject_id_to_patient_info(condition_type) (same row
+    order) and conditions in set_to_use (column i is set_to_use[i]).
+    """
+    store = get_patient_store(condition_type)
+    condition_code_to_index = dict(zip(set_to_use, range(len(set_to_use))))
+
+    ## Column of each code in the store, -1 if not in set_to_use
+    code_columns = np.array([condition_code_to_index.get(code, -1) for code in store.get_codes()], dtype=np.int64)
+
+    num_patients = len(store.patient_rows)
+    rows = np.repeat(np.arange(num_patients), np.diff(store.condition_offsets))
+    columns = code_columns[store.condition_indices]
+    keep = columns >= 0
+
+    labels = csr_matrix(
+        (np.ones(keep.sum(), dtype=np.int8), (rows[keep], columns[keep])), shape=(num_patients, len(set_to_use))
+    )
+    labels.data = np.minimum(labels.data, 1)  ## duplicate rows of same code are summed on construction
+
+    counts = np.zeros(len(set_to_use), dtype=np.int64)
+    np.add.at(counts, code_columns[code_columns >= 0], store.code_counts[code_columns >= 0])
+
+    return ConditionLabelMatrix(store.subject_ids[store.patient_rows], labels, counts)
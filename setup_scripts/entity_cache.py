@@ -0,0 +1,90 @@
+"""
+Content Addressed Entity Cache
+==============================
+
+MIMIC notes repeat a lot of boilerplate, so MedCAT extraction is cached per text segment (paragraph of a note,
+or a whole short text like a generated sentence). Segments are whitespace normalized and keyed by
+sha1(model fingerprint, segment). Results live in a sqlite file (shared across runs, scripts and processes),
+with an LRU dictionary in memory in front of it.
+
+Enabled by setting environment variable MEDCAT_ENTITY_CACHE to the sqlite file to use.
+"""
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+Entity = Tuple[str, str, Tuple[str, ...]]
+
+SEGMENT_BOUNDARY = re.compile(r"\n\s*\n")
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def split_segments(text: str) -> List[str]:
+    """Split text into whitespace normalized paragraphs (non empty)"""
+    segments = [WHITESPACE_PATTERN.sub(" ", segment).strip() for segment in SEGMENT_BOUNDARY.split(text)]
+    return [segment for segment in segments if len(segment) > 0]
+
+
+def get_model_fingerprint(*paths: str, extra: str = "") -> str:
+    """Identify model files by path, size and mtime, so cached entities of a different model are not reused"""
+    parts = [extra]
+    for path in paths:
+        stat = os.stat(path)
+        parts.append(f"{os.path.abspath(path)}:{stat.st_size}:{int(stat.st_mtime)}")
+
+    return hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()
+
+
+class EntityCache:
+    def __init__(self, path: str, model_fingerprint: str, max_memory_entries: int = 100000):
+        self.path = path
+        self.model_fingerprint = model_fingerprint
+        self.max_memory_entries = max_memory_entries
+        self.memory = OrderedDict()
+        self.connection = None
+        self.pid = None
+
+    def get_connection(self) -> sqlite3.Connection:
+        ## sqlite connections can't be shared across fork, so each process opens its own
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, timeout=600, isolation_level=None)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS entities (key TEXT PRIMARY KEY, entities TEXT)")
+            self.pid = os.getpid()
+
+        return self.connection
+
+    def key(self, segment: str) -> str:
+        return hashlib.sha1(f"{self.model_fingerprint}\0{segment}".encode("utf-8")).hexdigest()
+
+    def remember(self, key: str, entities: List[Entity]):
+        self.memory[key] = entities
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def get(self, segment: str) -> Optional[List[Entity]]:
+        key = self.key(segment)
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+
+        row = self.get_connection().execute("SELECT entities FROM entities WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+
+        entities = [(text, cui, tuple(icd_codes)) for text, cui, icd_codes in json.loads(row[0])]
+        self.remember(key, entities)
+        return entities
+
+    def put(self, segment: str, entities: List[Entity]):
+        key = self.key(segment)
+        self.get_connection().execute(
+            "INSERT OR REPLACE INTO entities (key, entities) VALUES (?, ?)", (key, json.dumps(entities))
+        )
+        self.remember(key, entities)
@@ -0,0 +1,283 @@
+"""
+MedCAT Model Loading
+====================
+
+`CDB.load_dict` / `Vocab.load_dict` take minutes, and used to run at import time of every script that
+(indirectly) imports the MedCAT setup scripts. Here models are loaded on first use instead, and can be
+converted once into a snapshot that loads fast:
+
+    <model file>.snapshot/
+        object.pickle   -- model pickled with protocol 5, large numpy arrays stored out of band
+        buffers.bin     -- the out of band arrays, 64 byte aligned
+        buffers.npy     -- (offset, length) of each array in buffers.bin
+        meta.json       -- size and mtime of the model file the snapshot was made from
+
+MedCAT keeps its vectors in dicts of small arrays (e.g. CDB.cui2context_vec, Vocab.vocab[word]["vec"]), each
+far below MIN_OUT_OF_BAND_BYTES. Before pickling, such dicts are packed into one matrix (plus the keys), which
+is stored out of band, and unpacked on load into a plain dict of row views into the matrix.
+
+buffers.bin is memory mapped copy-on-write, so arrays are not copied on load, and forked workers (and other
+jobs on the same machine) share the same pages until they write to them. A snapshot is only used while it
+matches its model file.
+
+Usage:
+    - python setup_scripts/medcat_models.py snapshot  (converts MEDCAT_CDB_FILE and MEDCAT_VOCAB_FILE)
+    - python setup_scripts/medcat_models.py benchmark  (times load_dict vs snapshot load of both models)
+"""
+
+import copy
+import json
+import mmap
+import os
+import pickle
+import shutil
+import time
+from typing import Optional
+
+import numpy as np
+
+## Arrays smaller than this stay inside object.pickle
+MIN_OUT_OF_BAND_BYTES = 4096
+ALIGNMENT = 64
+
+## Dicts with fewer vectors than this are pickled as they are
+MIN_PACKED_VECTORS = 1000
+
+TUI_FILTER = ["T047", "T048", "T184"]
+
+models = {}
+
+
+def snapshot_path(model_file: str) -> str:
+    return model_file + ".snapshot"
+
+
+def get_source_signature(model_file: str):
+    stat = os.stat(model_file)
+    return {"source_size": stat.st_size, "source_mtime": int(stat.st_mtime)}
+
+
+def has_snapshot(model_file: str) -> bool:
+    meta_file = os.path.join(snapshot_path(model_file), "meta.json")
+    if not os.path.exists(meta_file):
+        return False
+
+    with open(meta_file) as f:
+        return json.load(f) == get_source_signature(model_file)
+
+
+class PackedVectors:
+    """Dict of key -> vector (`field` None) or key -> record dict with a vector in record[field], with all
+    vectors stacked in one matrix. Unpickles as the original dict (see unpack_vectors).
+    """
+
+    def __init__(self, keys: list, matrix: np.ndarray, has_vector: np.ndarray, records: list, field: str):
+        self.keys = keys
+        self.matrix = matrix
+        self.has_vector = has_vector
+        self.records = records
+        self.field = field
+
+    def __reduce__(self):
+        return unpack_vectors, (self.keys, self.matrix, self.has_vector, self.records, self.field)
+
+
+def unpack_vectors(keys: list, matrix: np.ndarray, has_vector: np.ndarray, records: list, field: str) -> dict:
+    vectors = [row if has else None for row, has in zip(matrix, has_vector.tolist())]
+    if field is None:
+        return dict(zip(keys, vectors))
+
+    for record, vector in zip(records, vectors):
+        record[field] = vector
+    return dict(zip(keys, records))
+
+
+def pack_vectors(d: dict) -> Optional[PackedVectors]:
+    """Pack `d` if its values are 1-d arrays of the same shape and dtype (or None), or dicts holding such an
+    array under the same key. Return None if `d` is not a dict of vectors.
+    """
+    if len(d) < MIN_PACKED_VECTORS:
+        return None
+
+    values = list(d.values())
+    first = values[0]
+    if isinstance(first, dict):
+        if not all(isinstance(v, dict) for v in values):
+            return None
+        ## Field of the vector, from the first record that has one (others may hold None)
+        record = next((v for v in values if any(isinstance(x, np.ndarray) for x in v.values())), {})
+        fields = [k for k, v in record.items() if isinstance(v, np.ndarray)]
+        if len(fields) != 1:
+            return None
+        field = fields[0]
+        vectors = [v.get(field) for v in values]
+    else:
+        field = None
+        vectors = values
+
+    template = next((v for v in vectors if v is not None), None)
+    if not isinstance(template, np.ndarray) or template.ndim != 1:
+        return None
+    for v in vectors:
+        if v is not None and not (
+            isinstance(v, np.ndarray) and v.shape == template.shape and v.dtype == template.dtype
+        ):
+            return None
+
+    has_vector = np.array([v is not None for v in vectors], dtype=bool)
+    matrix = np.zeros((len(vectors), len(template)), dtype=template.dtype)
+    for row, v in enumerate(vectors):
+        if v is not None:
+            matrix[row] = v
+
+    records = None
+    if field is not None:
+        records = [{k: v for k, v in record.items() if k != field} for record in values]
+
+    return PackedVectors(list(d.keys()), matrix, has_vector, records, field)
+
+
+def pack_model(obj):
+    """Shallow copy of `obj` with its dicts of vectors (attributes) replaced by PackedVectors"""
+    packed = copy.copy(obj)
+    for name, value in vars(obj).items():
+        if type(value) is dict:
+            packed_value = pack_vectors(value)
+            if packed_value is not None:
+                setattr(packed, name, packed_value)
+                print(f"Packed {name} into a {packed_value.matrix.shape} matrix")
+
+    return packed
+
+
+def save_snapshot(obj, model_file: str):
+    """Save `obj` (loaded from `model_file`) as snapshot of `model_file`"""
+    snapshot_dir = snapshot_path(model_file)
+    if os.path.exists(snapshot_dir):
+        shutil.rmtree(snapshot_dir)
+    os.makedirs(snapshot_dir)
+
+    spans = []
+    with open(os.path.join(snapshot_dir, "buffers.bin"), "wb") as buffers_file:
+
+        def write_buffer(buffer: pickle.PickleBuffer):
+            raw = buffer.raw()
+            if raw.nbytes < MIN_OUT_OF_BAND_BYTES:
+                return True  ## serialize in band
+
+            buffers_file.write(b"\0" * (-buffers_file.tell() % ALIGNMENT))
+            spans.append((buffers_file.tell(), raw.nbytes))
+            buffers_file.write(raw)
+            return False
+
+        with open(os.path.join(snapshot_dir, "object.pickle"), "wb") as f:
+            pickle.dump(pack_model(obj), f, protocol=5, buffer_callback=write_buffer)
+
+    np.save(os.path.join(snapshot_dir, "buffers.npy"), np.array(spans, dtype=np.int64).reshape(-1, 2))
+
+    ## Written last, so an interrupted conversion is never used
+    with open(os.path.join(snapshot_dir, "meta.json"), "w") as f:
+        json.dump(get_source_signature(model_file), f)
+
+
+def load_snapshot(model_file: str):
+    snapshot_dir = snapshot_path(model_file)
+    spans = np.load(os.path.join(snapshot_dir, "buffers.npy"))
+
+    buffers = []
+    if len(spans) > 0:
+        with open(os.path.join(snapshot_dir, "buffers.bin"), "rb") as f:
+            ## Copy-on-write, so vectors can still be updated (e.g. training) without touching the file
+            mapped = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY))
+        buffers = [mapped[offset : offset + length] for offset, length in spans.tolist()]
+
+    with open(os.path.join(snapshot_dir, "object.pickle"), "rb") as f:
+        return pickle.load(f, buffers=buffers)
+
+
+def load_model(model_class, model_file: str):
+    """Load `model_class` (medcat CDB or Vocab) from snapshot of `model_file` if there is one, else load_dict"""
+    if has_snapshot(model_file):
+        model = load_snapshot(model_file)
+        print(f"Loaded {model_class.__name__} snapshot of {model_file}")
+    else:
+        model = model_class()
+        model.load_dict(model_file)
+        print(f"Loaded {model_class.__name__} from {model_file} (no snapshot, run medcat_models.py snapshot)")
+
+    return model
+
+
+def get_cdb():
+    """CDB at MEDCAT_CDB_FILE, loaded on first call"""
+    if "cdb" not in models:
+        from medcat.cdb import CDB
+
+        models["cdb"] = load_model(CDB, os.environ["MEDCAT_CDB_FILE"])
+
+    return models["cdb"]
+
+
+def get_vocab():
+    """Vocab at MEDCAT_VOCAB_FILE, loaded on first call"""
+    if "vocab" not in models:
+        from medcat.utils.vocab import Vocab
+
+        models["vocab"] = load_model(Vocab, os.environ["MEDCAT_VOCAB_FILE"])
+
+    return models["vocab"]
+
+
+def get_cat():
+    """CAT annotating conditions (TUI_FILTER) with get_cdb() and get_vocab(), created on first call.
+    Call it before forking workers, so they share the loaded model.
+    """
+    if "cat" not in models:
+        from medcat.cat import CAT
+
+        models["cat"] = CAT(cdb=get_cdb(), vocab=get_vocab())
+        models["cat"].spacy_cat.TUI_FILTER = TUI_FILTER
+
+    return models["cat"]
+
+
+def benchmark(model_class, model_file: str):
+    """Print load time of `model_file` with load_dict and from its snapshot, and snapshot sizes"""
+    start = time.perf_counter()
+    model_class().load_dict(model_file)
+    print(f"{model_file}: load_dict {time.perf_counter() - start:.2f}s")
+
+    if not has_snapshot(model_file):
+        print(f"{model_file}: no snapshot, run medcat_models.py snapshot")
+        return
+
+    start = time.perf_counter()
+    load_snapshot(model_file)
+    snapshot_dir = snapshot_path(model_file)
+    print(
+        f"{model_file}: snapshot {time.perf_counter() - start:.2f}s, "
+        f"object.pickle {os.path.getsize(os.path.join(snapshot_dir, 'object.pickle')) / 2 ** 20:.1f}MB, "
+        f"buffers.bin {os.path.getsize(os.path.join(snapshot_dir, 'buffers.bin')) / 2 ** 20:.1f}MB, "
+        f"{len(np.load(os.path.join(snapshot_dir, 'buffers.npy')))} out of band arrays"
+    )
+
+
+from argparse import ArgumentParser
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("action", choices=["snapshot", "benchmark"])
+    args = parser.parse_args()
+
+    from medcat.cdb import CDB
+    from medcat.utils.vocab import Vocab
+
+    for model_class, model_file in [(CDB, os.environ["MEDCAT_CDB_FILE"]), (Vocab, os.environ["MEDCAT_VOCAB_FILE"])]:
+        if args.action == "benchmark":
+            benchmark(model_class, model_file)
+            continue
+
+        model = model_class()
+        model.load_dict(model_file)
+        save_snapshot(model, model_file)
+        print(f"Saved snapshot of {model_file} to {snapshot_path(model_file)}")
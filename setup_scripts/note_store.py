@@ -0,0 +1,237 @@
+"""
+Span Overlay Note Store
+=======================
+
+`SUBJECT_ID_to_NOTES_1a` and `_1b` only differ from `SUBJECT_ID_to_NOTES_original` in the name placeholders
+(plus preprocessing). Instead of keeping a full copy of the corpus per variant, we index the placeholder spans
+of the original notes once
+
+    NOTE_ID (row in original notes), OFFSET, LENGTH, KIND (index in PLACEHOLDER_KINDS)
+
+and materialize the 1a / 1b text on read by splicing the current names (SUBJECT_ID_to_NAME) into those spans.
+After resampling names, only `reidentify` needs to be re-run, which uses the index alone.
+
+Usage:
+    - python setup_scripts/note_store.py index --input-file SUBJECT_ID_to_NOTES_original.csv \
+        --index-file NOTES_placeholder_spans.npz
+    - python setup_scripts/note_store.py reidentify --index-file NOTES_placeholder_spans.npz \
+        --input-names SUBJECT_ID_to_NAME.csv --output-file reidentified_subject_ids.csv
+    - python setup_scripts/note_store.py materialize --input-file SUBJECT_ID_to_NOTES_original.csv \
+        --index-file NOTES_placeholder_spans.npz --input-names SUBJECT_ID_to_NAME.csv \
+        --variant {1a|1b} --output-file SUBJECT_ID_to_NOTES_{1a|1b}.csv
+"""
+
+from typing import Iterator, List
+
+import config
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from setup_scripts.notes_preprocessing_and_name_insertion import (
+    OUTPUT_COLUMNS,
+    PLACEHOLDER_KINDS,
+    PLACEHOLDER_PATTERN,
+    add_name_at_bos,
+    get_placeholder_kind,
+)
+from setup_scripts.notes_preprocessing_functions import preprocess_text
+from setup_scripts.storage import (
+    OUTPUT_FORMATS,
+    PartitionedWriter,
+    get_table_signature,
+    iterate_table,
+    read_table,
+    remove_columnar,
+    write_table,
+)
+
+VARIANTS = ["1a", "1b"]
+KIND_TO_INDEX = {kind: i for i, (kind, _) in enumerate(PLACEHOLDER_KINDS)}
+
+
+def get_source_signature(input_file: str) -> str:
+    """Signature of the original notes as read by iterate_table (parquet dataset if one exists, else CSV), so
+    we can detect an index built from different notes
+    """
+    return get_table_signature(input_file)
+
+
+def build_index(input_file: str, index_file: str, chunksize: int = 100000):
+    """Scan original notes once and save placeholder spans of all kinds in PLACEHOLDER_KINDS to `index_file`"""
+    note_subject_ids = []
+    note_ids, offsets, lengths, kinds = [], [], [], []
+
+    note_id = 0
+    for chunk in tqdm(iterate_table(input_file, chunksize, columns=["SUBJECT_ID", "TEXT"])):
+        note_subject_ids.append(chunk.SUBJECT_ID.values)
+        for text in chunk.TEXT.values:
+            for match in PLACEHOLDER_PATTERN.finditer(text):
+                kind = get_placeholder_kind(match.group(1))
+                if kind is not None:
+                    note_ids.append(note_id)
+                    offsets.append(match.start())
+                    lengths.append(match.end() - match.start())
+                    kinds.append(KIND_TO_INDEX[kind])
+            note_id += 1
+
+    np.savez(
+        index_file,
+        note_subject_ids=np.concatenate(note_subject_ids).astype(np.int64),
+        note_ids=np.array(note_ids, dtype=np.int64),
+        offsets=np.array(offsets, dtype=np.int64),
+        lengths=np.array(lengths, dtype=np.int32),
+        kinds=np.array(kinds, dtype=np.int8),
+        source_signature=np.array(get_source_signature(input_file)),
+    )
+    print(f"Indexed {len(note_ids)} placeholder spans in {note_id} notes")
+
+
+class SpanIndex:
+    def __init__(self, index_file: str):
+        index = np.load(index_file)
+        self.note_subject_ids = index["note_subject_ids"]
+        self.note_ids = index["note_ids"]
+        self.offsets = index["offsets"]
+        self.lengths = index["lengths"]
+        self.kinds = index["kinds"]
+        self.source_signature = str(index["source_signature"])
+
+    def check_source(self, input_file: str):
+        assert (
+            self.source_signature == get_source_signature(input_file)
+        ), f"Span index was built from different notes than {input_file}, rebuild it"
+
+    def span_range(self, note_id: int):
+        """Return (start, end) of the spans of note `note_id` in span arrays"""
+        return np.searchsorted(self.note_ids, note_id, "left"), np.searchsorted(self.note_ids, note_id, "right")
+
+
+def splice_names(text: str, offsets, lengths, kinds, names: List[str]) -> str:
+    """Replace spans (offsets, lengths) of text with names[kind]."""
+    pieces, previous_end = [], 0
+    for offset, length, kind in zip(offsets, lengths, kinds):
+        pieces.append(text[previous_end:offset])
+        pieces.append(names[kind])
+        previous_end = offset + length
+    pieces.append(text[previous_end:])
+
+    return "".join(pieces)
+
+
+def iterate_notes(
+    input_file: str, index_file: str, input_names: str, variant: str, chunksize: int = 100000
+) -> Iterator[pd.DataFrame]:
+    """Yield the 1a / 1b variant of the notes in chunks, with columns OUTPUT_COLUMNS.
+    Produces the same rows as notes_preprocessing_and_name_insertion.run, without a full regex pass.
+    """
+    assert variant in VARIANTS, f"Unknown variant, Select From {VARIANTS}"
+
+    span_index = SpanIndex(index_file)
+    span_index.check_source(input_file)
+    subject_id_to_names = read_table(input_names)
+
+    note_id = 0
+    for chunk in iterate_table(input_file, chunksize):
+        chunk["NOTE_ID"] = np.arange(note_id, note_id + len(chunk))
+        note_id += len(chunk)
+
+        chunk = chunk.merge(subject_id_to_names, how="inner", on="SUBJECT_ID")
+
+        texts = []
+        for row_note_id, text, first_name, last_name in zip(
+            chunk.NOTE_ID.values, chunk.TEXT.values, chunk.FIRST_NAME.values, chunk.LAST_NAME.values
+        ):
+            start, end = span_index.span_range(row_note_id)
+            if start < end:
+                names = [first_name if kind == "FIRST_NAME" else last_name for kind, _ in PLACEHOLDER_KINDS]
+                text = splice_names(
+                    text,
+                    span_index.offsets[start:end],
+                    span_index.lengths[start:end],
+                    span_index.kinds[start:end],
+                    names,
+                )
+            texts.append(preprocess_text(text))
+
+        chunk["MOD_TEXT"] = texts
+        chunk = chunk[chunk.MOD_TEXT.str.strip().str.len() > 0].copy()
+
+        if variant == "1b":
+            chunk["MOD_TEXT"] = [
+                add_name_at_bos({"FIRST_NAME": first_name, "LAST_NAME": last_name, "MOD_TEXT": text})
+                for first_name, last_name, text in zip(chunk.FIRST_NAME, chunk.LAST_NAME, chunk.MOD_TEXT)
+            ]
+
+        chunk["TEXT"] = chunk["MOD_TEXT"]
+        yield chunk[OUTPUT_COLUMNS]
+
+
+def iterate_note_chunks(
+    input_file: str,
+    chunksize: int = 100000,
+    index_file: str = None,
+    input_names: str = None,
+    variant: str = None,
+) -> Iterator[pd.DataFrame]:
+    """Yield notes stored at `input_file` in chunks, or, if `index_file` is given, the 1a / 1b `variant` of
+    original notes `input_file` materialized on read (see iterate_notes), so variants need no copy on disk.
+    """
+    if index_file is None:
+        yield from iterate_table(input_file, chunksize)
+    else:
+        input_names = input_names if input_names is not None else config.SUBJECT_ID_to_NAME
+        yield from iterate_notes(input_file, index_file, input_names, variant, chunksize)
+
+
+def add_note_source_arguments(parser):
+    """Arguments of scripts reading notes with iterate_note_chunks"""
+    parser.add_argument(
+        "--index-file", help="Span index of original notes --input-file, to read --variant from (note_store.py)"
+    )
+    parser.add_argument("--variant", choices=VARIANTS, help="Variant to read with --index-file")
+    parser.add_argument("--input-names", help="Names to splice with --index-file (default SUBJECT_ID_to_NAME)")
+
+
+def get_reidentified_subject_ids(index_file: str, input_names: str) -> np.ndarray:
+    """Subject ids with at least one name placeholder that gets a name. Uses the span index only."""
+    span_index = SpanIndex(index_file)
+    subject_ids = np.unique(span_index.note_subject_ids[span_index.note_ids])
+    named_subject_ids = read_table(input_names, columns=["SUBJECT_ID"]).SUBJECT_ID.values
+
+    return np.intersect1d(subject_ids, named_subject_ids)
+
+
+from argparse import ArgumentParser
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("action", choices=["index", "reidentify", "materialize"])
+    parser.add_argument("--input-file", help="Original notes")
+    parser.add_argument("--index-file", required=True)
+    parser.add_argument("--input-names")
+    parser.add_argument("--variant", choices=VARIANTS)
+    parser.add_argument("--output-file")
+    parser.add_argument("--output-format", choices=OUTPUT_FORMATS, default="csv")
+    parser.add_argument("--chunksize", type=int, default=100000)
+
+    args = parser.parse_args()
+
+    if args.action == "index":
+        build_index(args.input_file, args.index_file, args.chunksize)
+    elif args.action == "reidentify":
+        subject_ids = get_reidentified_subject_ids(args.index_file, args.input_names)
+        print("Num Modified", len(subject_ids))
+        write_table(pd.DataFrame({"SUBJECT_ID": subject_ids}), args.output_file, args.output_format)
+    else:
+        chunks = iterate_notes(args.input_file, args.index_file, args.input_names, args.variant, args.chunksize)
+        if args.output_format == "parquet":
+            with PartitionedWriter(args.output_file) as writer:
+                for chunk in chunks:
+                    writer.write(chunk)
+        else:
+            remove_columnar(args.output_file)
+            with open(args.output_file, "w") as f:
+                for i, chunk in enumerate(chunks):
+                    chunk.to_csv(f, index=False, header=i == 0)
@@ -19,29 +19,67 @@ Output of this step should be a mapping
 2. `SUBJECT_ID` -> List of Notes (Modified 1.b) --- Store in `SUBJECT_ID_to_NOTES_1b.csv`
 """
 
-import re, os
+import re, os, shutil
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Iterator, Tuple
+
 import pandas as pd
 from tqdm import tqdm
 import swifter
 
 from setup_scripts.notes_preprocessing_functions import preprocess_text
+from setup_scripts.storage import (
+    OUTPUT_FORMATS,
+    import_csv,
+    iterate_table,
+    read_table,
+    remove_columnar,
+    write_table,
+)
 
 tqdm.pandas()
 
+OUTPUT_COLUMNS = ["SUBJECT_ID", "CATEGORY", "FIRST_NAME", "LAST_NAME", "CHARTDATE", "CHARTTIME", "TEXT"]
 
-def replace_text_with_regex(text, name, search_term):
-    pattern = re.compile(f"\[\*\*[^\*]*?{search_term}[^\*]*?\*\*\]", re.IGNORECASE)
-    return re.sub(pattern, name, text)
 
+## Every MIMIC de-identification placeholder looks like [** ... **] (no `*` inside)
+PLACEHOLDER_PATTERN = re.compile(r"\[\*\*([^\*]*?)\*\*\]")
 
-def add_name_at_pattern(row):
-    first_name = row["FIRST_NAME"]
-    last_name = row["LAST_NAME"]
-    original_note = row["MOD_TEXT"]
+## Placeholder kinds we substitute, in order of priority, with the (lowercased) term that identifies them
+PLACEHOLDER_KINDS = [("FIRST_NAME", "known firstname"), ("LAST_NAME", "known lastname")]
 
-    note = replace_text_with_regex(original_note, first_name, "Known firstname")
-    note = replace_text_with_regex(note, last_name, "Known lastname")
 
+def get_placeholder_kind(placeholder_body: str):
+    """Return kind (from PLACEHOLDER_KINDS) of the placeholder with this body, or None if we don't substitute it"""
+    placeholder_body = placeholder_body.lower()
+    for kind, search_term in PLACEHOLDER_KINDS:
+        if search_term in placeholder_body:
+            return kind
+
+    return None
+
+
+def substitute_names(text: str, first_name: str, last_name: str) -> Tuple[str, int]:
+    """Replace all first name / last name placeholders in text in a single scan.
+    Return the substituted text and number of substitutions made (> 0 iff text was modified).
+    """
+    names = {"FIRST_NAME": first_name, "LAST_NAME": last_name}
+    num_substitutions = 0
+
+    def substitute(match):
+        nonlocal num_substitutions
+        kind = get_placeholder_kind(match.group(1))
+        if kind is None:
+            return match.group(0)
+
+        num_substitutions += 1
+        return names[kind]
+
+    return PLACEHOLDER_PATTERN.sub(substitute, text), num_substitutions
+
+
+def add_name_at_pattern(row):
+    note, _ = substitute_names(row["MOD_TEXT"], row["FIRST_NAME"], row["LAST_NAME"])
     return note
 
 
@@ -55,46 +93,198 @@ def add_name_at_bos(row):
     return note
 
 
-def run(input_file, input_names, output_csv, replace_pattern_with_name, insert_name_at_bos):
-    """Save the data in two different output formats.
-    @param input_file  a CSV containing subject_ids to notes (Headers: SUBJECT_ID,TEXT).
-    @param input_names a CSV containing a mapping of subject_ids to names (Headers: SUBJECT_ID,FIRST_NAME,LAST_NAME).
-    @param output_csv is where to save the CSV (Headers: SUBJECT_ID,TEXT).
-    @param insert_name_at_bos should we prepend names to the beginning of every sentence.
+def insert_names(
+    subject_id_to_notes, subject_id_to_names, replace_pattern_with_name, insert_name_at_bos, use_swifter=True
+):
+    """Merge notes with names, substitute placeholders, preprocess and (optionally) prepend names to sentences.
+    Returns merged frame with TEXT replaced by the modified text (and MODIFIED column if placeholders replaced).
     """
-
-    subject_id_to_notes = pd.read_csv(input_file)
-    subject_id_to_names = pd.read_csv(input_names)
-
     subject_id_to_notes = subject_id_to_notes.merge(subject_id_to_names, how="inner", on="SUBJECT_ID")
 
     subject_id_to_notes["MOD_TEXT"] = subject_id_to_notes.TEXT.apply(lambda x : x)
 
     if replace_pattern_with_name:
-        subject_id_to_notes["MOD_TEXT"] = subject_id_to_notes.progress_apply(add_name_at_pattern, axis=1)
-        subject_id_to_notes["MODIFIED"] = subject_id_to_notes.apply(lambda x: x.TEXT != x.MOD_TEXT, axis=1)
-
-    subject_id_to_notes["MOD_TEXT"] = (
-        subject_id_to_notes["MOD_TEXT"]
-        .swifter.progress_bar(enable=True)
-        .allow_dask_on_strings()
-        .apply(preprocess_text)
-    )
+        substitutions = [
+            substitute_names(text, first_name, last_name)
+            for text, first_name, last_name in tqdm(
+                zip(subject_id_to_notes.MOD_TEXT, subject_id_to_notes.FIRST_NAME, subject_id_to_notes.LAST_NAME),
+                total=len(subject_id_to_notes),
+                disable=not use_swifter,
+            )
+        ]
+        subject_id_to_notes["MOD_TEXT"] = [note for note, _ in substitutions]
+        subject_id_to_notes["NUM_SUBSTITUTIONS"] = [n for _, n in substitutions]
+        subject_id_to_notes["MODIFIED"] = subject_id_to_notes.NUM_SUBSTITUTIONS > 0
+
+    if use_swifter:
+        subject_id_to_notes["MOD_TEXT"] = (
+            subject_id_to_notes["MOD_TEXT"]
+            .swifter.progress_bar(enable=True)
+            .allow_dask_on_strings()
+            .apply(preprocess_text)
+        )
+    else:
+        subject_id_to_notes["MOD_TEXT"] = [preprocess_text(text) for text in subject_id_to_notes.MOD_TEXT]
 
     subject_id_to_notes = subject_id_to_notes[~subject_id_to_notes.MOD_TEXT.isna()]
-    subject_id_to_notes = subject_id_to_notes[subject_id_to_notes.MOD_TEXT.apply(lambda x: len(x.strip()) > 0)]
+    subject_id_to_notes = subject_id_to_notes[subject_id_to_notes.MOD_TEXT.str.strip().str.len() > 0]
 
     if insert_name_at_bos:
-        subject_id_to_notes["MOD_TEXT"] = subject_id_to_notes.progress_apply(add_name_at_bos, axis=1)
+        subject_id_to_notes["MOD_TEXT"] = [
+            add_name_at_bos({"FIRST_NAME": first_name, "LAST_NAME": last_name, "MOD_TEXT": text})
+            for first_name, last_name, text in zip(
+                subject_id_to_notes.FIRST_NAME, subject_id_to_notes.LAST_NAME, subject_id_to_notes.MOD_TEXT
+            )
+        ]
 
     subject_id_to_notes["TEXT"] = subject_id_to_notes["MOD_TEXT"]
 
-    subject_id_to_notes[["SUBJECT_ID", "CATEGORY", "FIRST_NAME", "LAST_NAME", "CHARTDATE", "CHARTTIME", "TEXT"]].to_csv(output_csv, index=False)
+    return subject_id_to_notes
+
+
+def run(input_file, input_names, output_csv, replace_pattern_with_name, insert_name_at_bos, output_format="csv"):
+    """Save the data in two different output formats.
+    @param input_file  a CSV containing subject_ids to notes (Headers: SUBJECT_ID,TEXT).
+    @param input_names a CSV containing a mapping of subject_ids to names (Headers: SUBJECT_ID,FIRST_NAME,LAST_NAME).
+    @param output_csv is where to save the CSV (Headers: SUBJECT_ID,TEXT).
+    @param insert_name_at_bos should we prepend names to the beginning of every sentence.
+    @param output_format is csv or parquet (see setup_scripts/storage.py).
+    """
+
+    subject_id_to_notes = read_table(input_file)
+    subject_id_to_names = read_table(input_names)
+
+    subject_id_to_notes = insert_names(
+        subject_id_to_notes, subject_id_to_names, replace_pattern_with_name, insert_name_at_bos
+    )
+
+    write_table(subject_id_to_notes[OUTPUT_COLUMNS], output_csv, output_format)
 
     if replace_pattern_with_name and not insert_name_at_bos:
         print("Num Modified", subject_id_to_notes[subject_id_to_notes.MODIFIED].SUBJECT_ID.unique().size)
-        subject_id_to_notes[subject_id_to_notes.MODIFIED][["SUBJECT_ID"]].drop_duplicates().to_csv(
-            os.path.join(os.path.dirname(output_csv), "reidentified_subject_ids.csv"), index=False
+        write_table(
+            subject_id_to_notes[subject_id_to_notes.MODIFIED][["SUBJECT_ID"]].drop_duplicates(),
+            os.path.join(os.path.dirname(output_csv), "reidentified_subject_ids.csv"),
+            output_format,
+        )
+
+
+def iterate_subject_shards(input_file: str, shard_size: int) -> Iterator[pd.DataFrame]:
+    """Yield notes (sorted by SUBJECT_ID) in shards of about `shard_size` notes, never splitting a subject."""
+    carry = None
+    for chunk in iterate_table(input_file, shard_size):
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+
+        ## Last subject in chunk may continue in next chunk
+        is_last_subject = chunk.SUBJECT_ID == chunk.SUBJECT_ID.iloc[-1]
+        carry = chunk[is_last_subject]
+        if (~is_last_subject).any():
+            yield chunk[~is_last_subject]
+
+    if carry is not None and len(carry) > 0:
+        yield carry
+
+
+shard_subject_id_to_names = None
+
+
+def init_shard_worker(input_names):
+    """Each worker loads the (small) names file once, instead of receiving it with every shard"""
+    global shard_subject_id_to_names
+    shard_subject_id_to_names = read_table(input_names)
+
+
+def process_shard(shard_index, subject_id_to_notes, shard_dir, replace_pattern_with_name, insert_name_at_bos):
+    """Run the full name insertion on one shard in a worker and write it to `shard_dir`.
+    Return shard file and the modified subject ids in this shard.
+    """
+    subject_id_to_notes = insert_names(
+        subject_id_to_notes,
+        shard_subject_id_to_names,
+        replace_pattern_with_name,
+        insert_name_at_bos,
+        use_swifter=False,
+    )
+
+    shard_file = os.path.join(shard_dir, f"part-{shard_index:05d}.csv")
+    subject_id_to_notes[OUTPUT_COLUMNS].to_csv(shard_file, index=False)
+
+    modified_subject_ids = []
+    if replace_pattern_with_name:
+        modified_subject_ids = list(subject_id_to_notes[subject_id_to_notes.MODIFIED].SUBJECT_ID.unique())
+
+    return shard_index, shard_file, modified_subject_ids
+
+
+def run_sharded(
+    input_file,
+    input_names,
+    output_csv,
+    replace_pattern_with_name,
+    insert_name_at_bos,
+    workers,
+    shard_size=20000,
+    output_format="csv",
+):
+    """Same output as `run`, but shards of notes (by SUBJECT_ID) are processed end to end by a pool of `workers`
+    processes. Parent only reads shards and concatenates the ordered output shards, so it never holds
+    the full merged frame.
+    """
+    os.makedirs(os.path.dirname(output_csv) or ".", exist_ok=True)
+    shard_dir = output_csv + ".shards"
+    os.makedirs(shard_dir, exist_ok=True)
+
+    shard_files, modified_subject_ids = {}, set()
+
+    def collect(futures):
+        for future in futures:
+            shard_index, shard_file, shard_modified_subject_ids = future.result()
+            shard_files[shard_index] = shard_file
+            modified_subject_ids.update(shard_modified_subject_ids)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_shard_worker, initargs=(input_names,)) as executor:
+        pending = set()
+        for shard_index, shard in enumerate(tqdm(iterate_subject_shards(input_file, shard_size))):
+            pending.add(
+                executor.submit(
+                    process_shard, shard_index, shard, shard_dir, replace_pattern_with_name, insert_name_at_bos
+                )
+            )
+
+            ## Bound the number of shards held in memory
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+
+        collect(pending)
+
+    ## Concatenate output shards in order
+    with open(output_csv, "w", newline="") as output:
+        if len(shard_files) == 0:
+            output.write(",".join(OUTPUT_COLUMNS) + "\n")
+
+        for i, shard_index in enumerate(sorted(shard_files)):
+            with open(shard_files[shard_index], newline="") as shard:
+                header = shard.readline()
+                if i == 0:
+                    output.write(header)
+                shutil.copyfileobj(shard, output)
+
+    shutil.rmtree(shard_dir)
+
+    if output_format == "parquet":
+        import_csv(output_csv, shard_size)
+        os.remove(output_csv)
+    else:
+        remove_columnar(output_csv)
+
+    if replace_pattern_with_name and not insert_name_at_bos:
+        print("Num Modified", len(modified_subject_ids))
+        write_table(
+            pd.DataFrame({"SUBJECT_ID": sorted(modified_subject_ids)}),
+            os.path.join(os.path.dirname(output_csv), "reidentified_subject_ids.csv"),
+            output_format,
         )
 
 
@@ -106,7 +296,7 @@ if __name__ == "__main__":
         - python note_name_insertion.py --input-file SUBJECT_ID_to_NOTES_original.csv \
                                         --input-names subject_id_to_name.csv \
                                         --output-csv SUBJECT_ID_to_NOTES_1a.csv \
-                                        [--insert-name-at-bos]
+                                        [--insert-name-at-bos] [--workers N]
 
     Output Format #1:
         SUBJECT_ID,TEXT,MODIFIED
@@ -125,13 +315,29 @@ if __name__ == "__main__":
     parser.add_argument(
         "--insert-name-at-bos", action="store_true", help="Specify this to add name at beginning of sentence"
     )
+    parser.add_argument("--output-format", choices=OUTPUT_FORMATS, default="csv")
+    parser.add_argument("--workers", type=int, help="Process notes in SUBJECT_ID shards with this many processes")
+    parser.add_argument("--shard-size", type=int, default=20000, help="Approximate number of notes per shard")
 
     args = parser.parse_args()
-    run(
-        args.input_file,
-        args.input_names,
-        args.output_csv,
-        args.replace_pattern_with_name,
-        args.insert_name_at_bos,
-    )
+    if args.workers is not None:
+        run_sharded(
+            args.input_file,
+            args.input_names,
+            args.output_csv,
+            args.replace_pattern_with_name,
+            args.insert_name_at_bos,
+            args.workers,
+            args.shard_size,
+            args.output_format,
+        )
+    else:
+        run(
+            args.input_file,
+            args.input_names,
+            args.output_csv,
+            args.replace_pattern_with_name,
+            args.insert_name_at_bos,
+            args.output_format,
+        )
     print(f"Insertion Done and Saved at {args.output_csv}")
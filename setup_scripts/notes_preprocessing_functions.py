@@ -1,5 +1,8 @@
+import random
 import re
 import string
+import time
+from typing import Iterable, List
 
 
 def string_cleanup(x):
@@ -20,6 +23,62 @@ def string_cleanup(x):
     return y
 
 
+## Precompiled equivalent of "\\[(.*?)\\]" (the lazy .*? stops at the first ] and doesn't cross newlines)
+BRACKET_PATTERN = re.compile(r"\[[^\]\n]*\]")
+
+## A digit directly followed by a period. `[0-9]+\.` matches are these, extended back over the digit run
+DIGIT_PERIOD_PATTERN = re.compile(r"[0-9]\.")
+DIGITS = set(string.digits)
+
+## Literal substitutions of string_cleanup, in the same order. str.replace is same as re.sub for literals.
+LITERAL_REPLACEMENTS = [
+    ("dr.", "doctor"),
+    ("m.d.", "md"),
+    ("ms.", "ms"),
+    ("mr.", "mr"),
+    ("mrs.", "mrs"),
+    ("admission date:", ""),
+    ("discharge date:", ""),
+]
+SEPARATOR_PATTERN = re.compile(r"--|__|==")
+
+REMOVE_DIGITS = str.maketrans("", "", string.digits)
+
+
+def remove_numbering(y: str) -> str:
+    """Same as re.sub("[0-9]+\\.", "", y), but the regex only looks for a digit followed by a period"""
+    pieces, previous_end = [], 0
+    for match in DIGIT_PERIOD_PATTERN.finditer(y):
+        start = match.start()
+        while start > previous_end and y[start - 1] in DIGITS:
+            start -= 1
+        pieces.append(y[previous_end:start])
+        previous_end = match.end()
+
+    if previous_end == 0:
+        return y
+
+    pieces.append(y[previous_end:])
+    return "".join(pieces)
+
+
+def fast_string_cleanup(x: str) -> str:
+    """Same output as `string_cleanup`, but each rule is skipped when it can't match, literal rules use
+    str.replace and the remaining patterns are precompiled.
+    """
+    y = BRACKET_PATTERN.sub("", x) if "[" in x else x
+    y = remove_numbering(y) if "." in y else y
+
+    for old, new in LITERAL_REPLACEMENTS:
+        if old in y:
+            y = y.replace(old, new)
+
+    if "--" in y or "__" in y or "==" in y:
+        y = SEPARATOR_PATTERN.sub("", y)
+
+    return " ".join(y.translate(REMOVE_DIGITS).split())
+
+
 from spacy.lang.en import English
 
 sentence_nlp = English()  # just the language with no model
@@ -27,15 +86,21 @@ sentence_nlp.add_pipe(sentence_nlp.create_pipe("sentencizer"))
 sentence_nlp.max_length = 2000000
 
 
-def convert_to_sentence(text: str) -> str:
-    doc = sentence_nlp(text)
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def merge_short_sentences(sentences: Iterable[str], source=None) -> str:
+    """Attach sentences shorter than 20 chars to the previous one and return sentences as \n.join[sentences].
+    If segmentation fails midway, `source` (the text or doc being segmented) is printed and the sentences
+    merged so far are returned.
+    """
     text = []
     try:
-        for sent in doc.sents:
+        for sent in sentences:
             st = str(sent).strip()
             if len(st) < 20:
-                # a lot of abbreviation is segmented as one line. But these are all describing the previous things
-                # so I attached it to the sentence before
+                # a lot of abbreviation is segmented as one line. But these are all describing the previous
+                # things so I attached it to the sentence before
                 if len(text) != 0:
                     text[-1] = " ".join((text[-1], st))
                 else:
@@ -43,9 +108,39 @@ def convert_to_sentence(text: str) -> str:
             else:
                 text.append(st)
     except:
-        print(doc)
+        print(source)
+
+    return "\n".join([WHITESPACE_PATTERN.sub(" ", sent).strip() for sent in text if len(sent) > 0])
+
+
+def convert_to_sentence(text: str) -> str:
+    doc = sentence_nlp(text)
+    return merge_short_sentences(doc.sents, source=doc)
+
+
+def convert_to_sentences(texts: List[str], batch_size: int = 64, n_process: int = 1) -> List[str]:
+    """Batched version of `convert_to_sentence`. Runs the sentencizer over all texts with `nlp.pipe`,
+    using `n_process` processes.
+    """
+    return [
+        merge_short_sentences(doc.sents, source=doc)
+        for doc in sentence_nlp.pipe(texts, batch_size=batch_size, n_process=n_process)
+    ]
+
+
+## Split after sentence final punctuation (same punctuation the sentencizer splits on) followed by whitespace
+REGEX_SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+")
 
-    return "\n".join([re.sub(r"\s+", " ", sent).strip() for sent in text if len(sent) > 0])
+
+def convert_to_sentence_regex(text: str) -> str:
+    """Regex only approximation of `convert_to_sentence`, with the same rule for merging short sentences.
+    Splits only on `.`, `!` or `?` followed by whitespace, so unlike spaCy, doesn't split on punctuation
+    directly followed by a word (e.g. "stable.plan").
+    """
+    return merge_short_sentences(REGEX_SENTENCE_BOUNDARY.split(text), source=text)
+
+
+SEGMENTERS = ["spacy", "regex"]
 
 
 def preprocess_text(text: str, sentencize: bool = True):
@@ -60,3 +155,116 @@ def preprocess_text(text: str, sentencize: bool = True):
     #if sentencize:
         #text = convert_to_sentence(text)
     return text
+
+
+def preprocess_texts(
+    texts: List[str],
+    cleanup: bool = False,
+    sentencize: bool = False,
+    segmenter: str = "spacy",
+    batch_size: int = 64,
+    n_process: int = 1,
+) -> List[str]:
+    """Apply `preprocess_text` to a batch of texts, then optionally clean them up (`fast_string_cleanup`)
+    and sentencize them. Sentencization uses either the batched spaCy sentencizer or the regex segmenter.
+    """
+    assert segmenter in SEGMENTERS, f"Unknown segmenter, Select From {SEGMENTERS}"
+
+    texts = [preprocess_text(text) for text in texts]
+    if cleanup:
+        texts = [fast_string_cleanup(text) for text in texts]
+
+    if not sentencize:
+        return texts
+
+    if segmenter == "spacy":
+        return convert_to_sentences(texts, batch_size=batch_size, n_process=n_process)
+
+    return [convert_to_sentence_regex(text) for text in texts]
+
+
+def benchmark_segmenters(texts: List[str], batch_size: int = 64, n_process: int = 1):
+    """Time spaCy sentencizer (one document at a time, and batched) against the regex segmenter,
+    and report how often the regex segmenter gives the same output as spaCy.
+    """
+    start = time.time()
+    spacy_sentences = [convert_to_sentence(text) for text in texts]
+    print(f"spacy (one at a time) : {time.time() - start:.2f}s")
+
+    start = time.time()
+    batched_sentences = convert_to_sentences(texts, batch_size=batch_size, n_process=n_process)
+    print(f"spacy (batched, n_process={n_process}) : {time.time() - start:.2f}s")
+
+    start = time.time()
+    regex_sentences = [convert_to_sentence_regex(text) for text in texts]
+    print(f"regex : {time.time() - start:.2f}s")
+
+    assert batched_sentences == spacy_sentences
+    agreement = sum(x == y for x, y in zip(spacy_sentences, regex_sentences)) / max(1, len(texts))
+    print(f"regex output identical to spacy for {agreement:.2%} of texts")
+
+
+def generate_synthetic_notes(num_notes: int, seed: int = 2021) -> List[str]:
+    """Lowercased MIMIC style notes with de-identification brackets, numbered lists, titles and dates."""
+    rng = random.Random(seed)
+    pieces = [
+        "admission date: [**2101-10-20**] discharge date: [**2101-10-31**]",
+        "mr. [**known lastname 1234**] is a 65 yo m with h/o cad s/p cabg.",
+        "mrs. [**known firstname 52**] seen by dr. [**last name (stitle) 123**], m.d.",
+        "1. aspirin 81 mg po daily 2. metoprolol 25 mg po bid",
+        "ms. smith was extubated on [**10-22**].",
+        "pt is alert and oriented x3, vss, afebrile.",
+        "======== plan: --- continue current management __",
+        "bp 120/80 hr 72 rr 16 sat 98% on ra",
+        "mr.s. jones -admission date:- 3.5 mg",
+    ]
+    return [" ".join(rng.choice(pieces) for _ in range(rng.randint(20, 200))) for _ in range(num_notes)]
+
+
+def benchmark_cleanup(texts: List[str]):
+    """Check `fast_string_cleanup` gives byte for byte same output as `string_cleanup`, and time both."""
+    start = time.time()
+    expected = [string_cleanup(text) for text in texts]
+    elapsed = time.time() - start
+    print(f"string_cleanup : {elapsed:.2f}s ({sum(map(len, texts)) / elapsed / 1e6:.1f}M chars/s)")
+
+    start = time.time()
+    fused = [fast_string_cleanup(text) for text in texts]
+    elapsed = time.time() - start
+    print(f"fast_string_cleanup : {elapsed:.2f}s ({sum(map(len, texts)) / elapsed / 1e6:.1f}M chars/s)")
+
+    mismatches = [i for i, (x, y) in enumerate(zip(expected, fused)) if x != y]
+    assert len(mismatches) == 0, f"fast_string_cleanup differs from string_cleanup for texts {mismatches[:10]}"
+    print(f"Outputs identical for all {len(texts)} texts")
+
+
+if __name__ == "__main__":
+    """
+    Usage:
+        - python setup_scripts/notes_preprocessing_functions.py --benchmark {segmenters|cleanup} \
+            [--input-file SUBJECT_ID_to_NOTES_original.csv] --num-notes 1000 --n-process 4
+
+    Without --input-file, synthetic MIMIC style notes are used.
+    """
+    from argparse import ArgumentParser
+
+    from setup_scripts.storage import iterate_table
+
+    parser = ArgumentParser()
+    parser.add_argument("--benchmark", choices=["segmenters", "cleanup"], required=True)
+    parser.add_argument("--input-file")
+    parser.add_argument("--num-notes", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--n-process", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.input_file is not None:
+        notes = next(iterate_table(args.input_file, args.num_notes, columns=["TEXT"]))
+        texts = [preprocess_text(text) for text in notes.TEXT.values]
+    else:
+        texts = generate_synthetic_notes(args.num_notes)
+
+    if args.benchmark == "segmenters":
+        benchmark_segmenters(texts, batch_size=args.batch_size, n_process=args.n_process)
+    else:
+        benchmark_cleanup(texts)
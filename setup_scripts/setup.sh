@@ -11,7 +11,8 @@ python setup_scripts/subject_id_to_name.py \
 
 python setup_scripts/subject_id_to_notes_original.py \
 --input-file data/NOTEEVENTS.csv \
---output-file ${setup_output_folder}/SUBJECT_ID_to_NOTES_original.csv
+--output-file ${setup_output_folder}/SUBJECT_ID_to_NOTES_original.csv \
+--streaming --memory-budget-mb 2048
 
 ## each row contain subject id and one of the icd9 code associated with it.
 
@@ -0,0 +1,216 @@
+"""
+Columnar Storage for setup_outputs
+==================================
+
+Every artifact keyed by SUBJECT_ID (notes, names, conditions, reidentified ids) can be stored either as CSV
+(the default, and the export format) or as a parquet dataset next to it. The parquet dataset for
+`setup_outputs/X.csv` lives in directory `setup_outputs/X.parquet/` and is partitioned by SUBJECT_ID range
+(`SUBJECT_ID_RANGE=SUBJECT_ID // config.SUBJECT_ID_PARTITION_SIZE`), with zstd compressed typed columns.
+
+`read_table` always takes the CSV path. If a parquet dataset exists for it, that is read instead, with column
+projection and SUBJECT_ID filtering pushed down to the partitions. pyarrow is only needed for parquet.
+
+Usage:
+    - python setup_scripts/storage.py import --path setup_outputs/SUBJECT_ID_to_NOTES_1a.csv
+    - python setup_scripts/storage.py export --path setup_outputs/SUBJECT_ID_to_NOTES_1a.csv
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from typing import Iterable, Iterator, List
+
+import config
+import pandas as pd
+
+OUTPUT_FORMATS = ["csv", "parquet"]
+PARTITION_COLUMN = "SUBJECT_ID_RANGE"
+
+## Condition codes look numeric for most ICD9 codes (and lose leading zeros), so always keep them as strings
+COLUMN_DTYPES = {"CODE": str, "FIRST_NAME": str, "LAST_NAME": str}
+
+
+def columnar_path(path: str) -> str:
+    """Return location of parquet dataset corresponding to CSV file `path`"""
+    return os.path.splitext(path)[0] + ".parquet"
+
+
+def has_columnar(path: str) -> bool:
+    return os.path.isdir(columnar_path(path))
+
+
+class PartitionedWriter:
+    """Write DataFrame batches with a SUBJECT_ID column into a parquet dataset partitioned by SUBJECT_ID range.
+
+    Batches are appended to the file of their partition, so input doesn't need to be sorted, but rows within
+    a partition keep their input order.
+    """
+
+    def __init__(self, path: str, partition_size: int = config.SUBJECT_ID_PARTITION_SIZE, compression="zstd"):
+        self.root = columnar_path(path)
+        self.partition_size = partition_size
+        self.compression = compression
+        self.schema = None
+        self.writers = {}
+
+        if os.path.exists(self.root):
+            shutil.rmtree(self.root)
+        os.makedirs(self.root)
+
+    def get_schema(self, table):
+        import pyarrow as pa
+
+        ## Columns that are all null in the first batch would otherwise be typed as null
+        fields = [pa.field(f.name, pa.string()) if pa.types.is_null(f.type) else f for f in table.schema]
+        return pa.schema(fields)
+
+    def write(self, df: pd.DataFrame):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        ## Categories can differ across batches, so store them as plain (dictionary encoded) strings
+        df = df.astype({c: object for c in df.columns if isinstance(df[c].dtype, pd.CategoricalDtype)})
+
+        for partition, part_df in df.groupby(df.SUBJECT_ID // self.partition_size, sort=True):
+            table = pa.Table.from_pandas(part_df, preserve_index=False)
+            if self.schema is None:
+                self.schema = self.get_schema(table)
+            table = table.cast(self.schema)
+
+            if partition not in self.writers:
+                partition_dir = os.path.join(self.root, f"{PARTITION_COLUMN}={partition:05d}")
+                os.makedirs(partition_dir, exist_ok=True)
+                self.writers[partition] = pq.ParquetWriter(
+                    os.path.join(partition_dir, "part-0.parquet"), self.schema, compression=self.compression
+                )
+            self.writers[partition].write_table(table)
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def remove_columnar(path: str):
+    """Remove parquet dataset for `path`, so a stale dataset doesn't shadow a newly written CSV"""
+    if has_columnar(path):
+        shutil.rmtree(columnar_path(path))
+
+
+def write_table(df: pd.DataFrame, path: str, output_format: str = "csv"):
+    """Write `df` to CSV file `path`, or to the parquet dataset for `path` if output_format is parquet."""
+    assert output_format in OUTPUT_FORMATS, f"Unknown output format, Select From {OUTPUT_FORMATS}"
+
+    if output_format == "parquet":
+        with PartitionedWriter(path) as writer:
+            writer.write(df)
+    else:
+        remove_columnar(path)
+        df.to_csv(path, index=False)
+
+
+def read_table(path: str, columns: List[str] = None, subject_ids: Iterable[int] = None) -> pd.DataFrame:
+    """Read the artifact stored at CSV `path` (or its parquet dataset, if one exists).
+
+    ### Args:
+        columns: Only load these columns
+        subject_ids: Only load rows with SUBJECT_ID in this collection
+    """
+    if subject_ids is not None:
+        subject_ids = sorted(set(int(x) for x in subject_ids))
+
+    if has_columnar(path):
+        import pyarrow.dataset as ds
+
+        dataset = ds.dataset(columnar_path(path), format="parquet", partitioning="hive")
+        if columns is None:
+            columns = [name for name in dataset.schema.names if name != PARTITION_COLUMN]
+
+        filter_ = None
+        if subject_ids is not None:
+            partitions = sorted(set(x // config.SUBJECT_ID_PARTITION_SIZE for x in subject_ids))
+            filter_ = ds.field(PARTITION_COLUMN).isin(partitions) & ds.field("SUBJECT_ID").isin(subject_ids)
+
+        return dataset.to_table(columns=columns, filter=filter_).to_pandas()
+
+    df = pd.read_csv(path, usecols=columns, dtype=COLUMN_DTYPES)
+    if subject_ids is not None:
+        df = df[df.SUBJECT_ID.isin(subject_ids)]
+
+    return df
+
+
+def iterate_table(path: str, chunksize: int, columns: List[str] = None) -> Iterator[pd.DataFrame]:
+    """Yield the artifact stored at CSV `path` (or its parquet dataset) in chunks of about `chunksize` rows."""
+    if has_columnar(path):
+        import pyarrow.dataset as ds
+
+        dataset = ds.dataset(columnar_path(path), format="parquet", partitioning="hive")
+        if columns is None:
+            columns = [name for name in dataset.schema.names if name != PARTITION_COLUMN]
+
+        for batch in dataset.to_batches(columns=columns, batch_size=chunksize):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, usecols=columns, dtype=COLUMN_DTYPES, chunksize=chunksize)
+
+
+def get_table_signature(path: str) -> str:
+    """Identify the files read_table / iterate_table read for `path` (its parquet dataset if one exists,
+    else the CSV) by relative path, size and mtime, to detect data derived from a different version
+    """
+    if has_columnar(path):
+        root = columnar_path(path)
+        files = sorted(os.path.join(d, f) for d, _, fs in os.walk(root) for f in fs)
+    else:
+        root, files = os.path.dirname(path), [path]
+
+    signature = [
+        (os.path.relpath(f, root), os.stat(f).st_size, int(os.stat(f).st_mtime)) for f in files
+    ]
+    return hashlib.sha1(json.dumps(signature).encode("utf-8")).hexdigest()
+
+
+def import_csv(path: str, chunksize: int = 100000):
+    """Convert CSV file at `path` to a parquet dataset, reading the CSV in chunks."""
+    with PartitionedWriter(path) as writer:
+        for chunk in pd.read_csv(path, chunksize=chunksize, dtype=COLUMN_DTYPES):
+            writer.write(chunk)
+
+
+def export_csv(path: str):
+    """Write parquet dataset for `path` back to CSV file `path`."""
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(columnar_path(path), format="parquet", partitioning="hive")
+    columns = [name for name in dataset.schema.names if name != PARTITION_COLUMN]
+
+    header = True
+    with open(path, "w") as f:
+        for batch in dataset.to_batches(columns=columns):
+            batch.to_pandas().to_csv(f, index=False, header=header)
+            header = False
+
+
+from argparse import ArgumentParser
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("action", choices=["import", "export"])
+    parser.add_argument("--path", required=True, help="CSV path of the artifact")
+    parser.add_argument("--chunksize", type=int, default=100000)
+    args = parser.parse_args()
+
+    if args.action == "import":
+        import_csv(args.path, args.chunksize)
+        print(f"Saved parquet dataset to {columnar_path(args.path)}")
+    else:
+        export_csv(args.path)
+        print(f"Saved CSV to {args.path}")
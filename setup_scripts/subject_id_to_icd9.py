@@ -4,6 +4,8 @@ from typing import Dict
 import config
 import pandas as pd
 
+from setup_scripts.storage import OUTPUT_FORMATS, write_table
+
 
 def icd_to_english() -> Dict[str, str]:
     """
@@ -22,8 +24,8 @@ def icd_to_english() -> Dict[str, str]:
     return code_to_english
 
 
-def run(input_file: str, output_file: str, output_descriptions_file: str):
-    patients_icd_df = pd.read_csv(input_file)
+def run(input_file: str, output_file: str, output_descriptions_file: str, output_format: str = "csv"):
+    patients_icd_df = pd.read_csv(input_file, dtype={"ICD9_CODE": str})
     code_to_english = icd_to_english()
 
     valid_codes = set(list(code_to_english.keys()))
@@ -32,7 +34,7 @@ def run(input_file: str, output_file: str, output_descriptions_file: str):
     patients_icd_df = patients_icd_df[patients_icd_df.ICD9_CODE.isin(valid_codes)]
     patients_icd_df = patients_icd_df.rename(columns={"ICD9_CODE": "CODE"})[["SUBJECT_ID", "CODE"]]
 
-    patients_icd_df.sort_values(by=["SUBJECT_ID", "CODE"]).to_csv(output_file, index=False)
+    write_table(patients_icd_df.sort_values(by=["SUBJECT_ID", "CODE"]), output_file, output_format)
 
     codes, descriptions = list(zip(*code_to_english.items()))
     descriptions_df = pd.DataFrame({"CODE": codes, "DESCRIPTION": descriptions})
@@ -57,5 +59,6 @@ if __name__ == "__main__":
     parser.add_argument("--input-file", required=True)
     parser.add_argument("--output-file", required=True)
     parser.add_argument("--output-descriptions-file", required=True)
+    parser.add_argument("--output-format", choices=OUTPUT_FORMATS, default="csv")
     args = parser.parse_args()
-    run(args.input_file, args.output_file, args.output_descriptions_file)
+    run(args.input_file, args.output_file, args.output_descriptions_file, args.output_format)
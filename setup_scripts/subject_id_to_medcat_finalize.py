@@ -1,11 +1,21 @@
 import os, json 
+import csv
+import glob
+import heapq
+import itertools
+import re
+from functools import lru_cache
 import pandas as pd
 from tqdm import tqdm
 
-from medcat.cdb import CDB 
-cdb = CDB()
-cdb.load_dict(os.environ["MEDCAT_CDB_FILE"]) 
-print("Loaded CDB")
+from setup_scripts.medcat_models import get_cdb
+from setup_scripts.storage import OUTPUT_FORMATS, PartitionedWriter, remove_columnar
+
+@lru_cache(maxsize=None)
+def get_normalized_name_and_abbreviation(cui):
+    """Return (pretty name without spaces, abbreviation from first letters of words) of cui, lower cased"""
+    pretty_name = get_cdb().cui2pretty_name[cui]
+    return pretty_name.replace(" ", "").lower(), "".join([c[0] for c in pretty_name.split()]).lower()
 
 def denormalize(entities) :
     if len(entities) == 0 :
@@ -15,9 +25,8 @@ def denormalize(entities) :
 
     overlaps = 0 
     for text, cui, icd10 in entities:
-        cui_name = cdb.cui2pretty_name[cui].replace(" ", "").lower()
+        cui_name, abbr = get_normalized_name_and_abbreviation(cui)
         text = text.replace(" ", "").lower()
-        abbr = "".join([c[0] for c in cdb.cui2pretty_name[cui].split()]).lower()
         if text == cui_name or text in cui_name or cui_name in text or abbr in text:
             overlaps += 1
 
@@ -25,21 +34,91 @@ def denormalize(entities) :
 
 switch_comma = lambda x : x.split(",", 1)[1].strip() + " " + x.split(",", 1)[0].strip()
 
-def run(input_file: str, output_file: str, output_descriptions_file: str) :
-    data = [json.loads(line) for line in open(input_file)]
-    subject_ids, conditions = [], []
-    overlaps = []
-    for d in tqdm(data) :
-        cuis, overlap = denormalize(d["CONDITIONS"])
-        subject_ids += [d["SUBJECT_ID"] for _ in range(len(cuis))]
-        conditions += cuis
-        overlaps.append(overlap)
-
-    output_df = pd.DataFrame({"SUBJECT_ID": subject_ids, "CODE": conditions})
-    output_df.sort_values(by=["SUBJECT_ID", "CODE"]).to_csv(output_file, index=False)
-
-    cuis = sorted(list(set(conditions)))
-    code_descriptions = [cdb.cui2pretty_name[cui] for cui in cuis]
+def iterate_shard(shard_file):
+    """Yield (SUBJECT_ID, CONDITIONS) records of one preprocess output file, which is sorted by SUBJECT_ID"""
+    previous_subject_id = None
+    with open(shard_file) as f:
+        for line in f:
+            record = json.loads(line)
+            subject_id = int(record["SUBJECT_ID"])
+            assert (
+                previous_subject_id is None or subject_id >= previous_subject_id
+            ), f"{shard_file} is not sorted by SUBJECT_ID"
+            previous_subject_id = subject_id
+            yield subject_id, record["CONDITIONS"]
+
+## Suffix .n_jobs.job_num of distributed preprocess outputs
+SHARD_SUFFIX_PATTERN = re.compile(r"\.\d+\.\d+$")
+
+def iterate_subjects(input_pattern):
+    """Stream merge all files matching `input_pattern` (a file, or a glob like X.jsonl.8.* for distributed shards)
+    and yield (SUBJECT_ID, unique entities) in order of SUBJECT_ID. Shards split notes by row, so a subject
+    can occur in two shards, its entities are combined.
+    """
+    ## Only the file itself or its .n_jobs.job_num shards, not e.g. the <output-file>.chunks checkpoint folders
+    shard_files = sorted(
+        f
+        for f in glob.glob(input_pattern)
+        if os.path.isfile(f) and (f == input_pattern or SHARD_SUFFIX_PATTERN.search(f) is not None)
+    )
+    assert len(shard_files) > 0, f"No files match {input_pattern}"
+    print(f"Merging {len(shard_files)} files")
+
+    records = heapq.merge(*[iterate_shard(shard_file) for shard_file in shard_files], key=lambda x: x[0])
+    for subject_id, group in itertools.groupby(records, key=lambda x: x[0]):
+        entities = set(
+            (text, cui, tuple(icd10)) for _, conditions in group for text, cui, icd10 in conditions
+        )
+        yield subject_id, list(entities)
+
+def run(input_file: str, output_file: str, output_descriptions_file: str, output_format: str = "csv",
+        batch_size: int = 100000) :
+    """Write SUBJECT_ID,CODE rows sorted by (SUBJECT_ID, CODE), one subject at a time.
+    For parquet, rows are written in batches of `batch_size`.
+    """
+    assert output_format in OUTPUT_FORMATS, f"Unknown output format, Select From {OUTPUT_FORMATS}"
+
+    all_cuis = set()
+    overlap_sum, num_subjects = 0, 0
+
+    if output_format == "parquet":
+        writer = PartitionedWriter(output_file)
+        subject_ids, conditions = [], []
+    else:
+        remove_columnar(output_file)
+        f = open(output_file, "w", newline="")
+        csv_writer = csv.writer(f)
+        csv_writer.writerow(["SUBJECT_ID", "CODE"])
+
+    for subject_id, entities in tqdm(iterate_subjects(input_file)) :
+        cuis, overlap = denormalize(entities)
+        if overlap is not None:
+            overlap_sum += overlap
+            num_subjects += 1
+        cuis = sorted(cuis)
+        all_cuis.update(cuis)
+
+        if output_format == "parquet":
+            subject_ids += [subject_id] * len(cuis)
+            conditions += cuis
+            if len(subject_ids) >= batch_size:
+                writer.write(pd.DataFrame({"SUBJECT_ID": subject_ids, "CODE": conditions}))
+                subject_ids, conditions = [], []
+        else:
+            csv_writer.writerows((subject_id, cui) for cui in cuis)
+
+    if output_format == "parquet":
+        if len(subject_ids) > 0:
+            writer.write(pd.DataFrame({"SUBJECT_ID": subject_ids, "CODE": conditions}))
+        writer.close()
+    else:
+        f.close()
+
+    if num_subjects > 0:
+        print(f"Average fraction of entities overlapping their CUI name -- {overlap_sum / num_subjects:.3f}")
+
+    cuis = sorted(list(all_cuis))
+    code_descriptions = [get_cdb().cui2pretty_name[cui] for cui in cuis]
     code_descriptions = pd.DataFrame({"CODE": cuis, "DESCRIPTION": code_descriptions})
     code_descriptions["DESCRIPTION"] = code_descriptions.DESCRIPTION.apply(lambda x : switch_comma(x) if "," in x else x)
     code_descriptions.to_csv(output_descriptions_file, index=False)
@@ -47,12 +126,21 @@ def run(input_file: str, output_file: str, output_descriptions_file: str) :
 from argparse import ArgumentParser
 
 if __name__ == "__main__" :
+    '''
+    Usage:
+        - python subject_id_to_medcat_finalize.py --input-file "SUBJECT_ID_to_MedCAT.jsonl*" \
+            --output-file SUBJECT_ID_to_MedCAT.csv --output-descriptions-file MedCAT_descriptions.csv
+
+    --input-file takes a single preprocess output, or a glob over the .n_jobs.job_num shards of a distributed
+    run (quote it, so the shell doesn't expand it). Other matches (like the .chunks checkpoint folders) are
+    skipped.
+    '''
     parser = ArgumentParser()
-    parser.add_argument("--input-file", required=True)
+    parser.add_argument("--input-file", required=True, help="File or glob of preprocess outputs")
     parser.add_argument("--output-file", required=True)
     parser.add_argument("--output-descriptions-file", required=True)
+    parser.add_argument("--output-format", choices=OUTPUT_FORMATS, default="csv")
 
     args = parser.parse_args()
 
-    run(args.input_file, args.output_file, args.output_descriptions_file)
-    
+    run(args.input_file, args.output_file, args.output_descriptions_file, args.output_format)
@@ -1,31 +1,47 @@
 import os
+import json
+import multiprocessing
 from argparse import ArgumentParser
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 
-import pandas as pd
 from tqdm import tqdm
 import numpy as np
 
-from medcat.cat import CAT
-from medcat.utils.vocab import Vocab
-from medcat.cdb import CDB 
+from setup_scripts.entity_cache import EntityCache, get_model_fingerprint, split_segments
+from setup_scripts.medcat_models import TUI_FILTER, get_cat
+from setup_scripts.storage import iterate_table, read_table
 
-vocab = Vocab()
-vocab.load_dict(os.environ["MEDCAT_VOCAB_FILE"])
-print("Loaded Vocab")
-
-# Load the cdb model you downloaded
-cdb = CDB()
-cdb.load_dict(os.environ["MEDCAT_CDB_FILE"]) 
-print("Loaded CDB")
-
-# create cat
-cat = CAT(cdb=cdb, vocab=vocab)
-cat.spacy_cat.TUI_FILTER = ['T047', 'T048', 'T184']
+## CDB / vocab are loaded by get_cat() on first use, not at import
+entity_cache = None
+if "MEDCAT_ENTITY_CACHE" in os.environ:
+    entity_cache = EntityCache(
+        os.environ["MEDCAT_ENTITY_CACHE"],
+        get_model_fingerprint(os.environ["MEDCAT_VOCAB_FILE"], os.environ["MEDCAT_CDB_FILE"], extra=str(TUI_FILTER)),
+    )
+    print(f"Using entity cache {os.environ['MEDCAT_ENTITY_CACHE']}")
 
 tqdm.pandas()
 
 def get_entities(text) :
-    doc = cat.get_entities(text)
+    """Return list of unique (string, cui, icd codes) of conditions in text.
+    With MEDCAT_ENTITY_CACHE set, text is annotated per paragraph and each paragraph is only annotated once.
+    """
+    if entity_cache is None:
+        return get_entities_uncached(text)
+
+    entities = set()
+    for segment in split_segments(text):
+        segment_entities = entity_cache.get(segment)
+        if segment_entities is None:
+            segment_entities = get_entities_uncached(segment)
+            entity_cache.put(segment, segment_entities)
+        entities.update(segment_entities)
+
+    return list(entities)
+
+
+def get_entities_uncached(text) :
+    doc = get_cat().get_entities(text)
     relevant_entities = []
     for ent in doc :
         if "icd10" in ent["info"] :
@@ -42,7 +58,7 @@ def get_entities(text) :
 
 
 def run(input_file, output_file, distributed: bool, args):
-    notes_df = pd.read_csv(input_file).reset_index(drop=True)
+    notes_df = read_table(input_file, columns=["SUBJECT_ID", "TEXT"]).reset_index(drop=True)
     if distributed :
         notes_df = np.array_split(notes_df, args.n_jobs)[args.job_num]
 
@@ -60,12 +76,127 @@ def run(input_file, output_file, distributed: bool, args):
     notes_df.to_json(output_file, orient="records", lines=True)
 
 
+def process_chunk(chunk_index, subject_ids, texts, checkpoint_file):
+    """Extract entities for one chunk of notes (in a forked worker, sharing `cat` copy-on-write) and save
+    them aggregated per subject to `checkpoint_file`.
+    """
+    subject_id_to_conditions = {}
+    for subject_id, text in zip(subject_ids, texts):
+        subject_id_to_conditions.setdefault(int(subject_id), set()).update(get_entities(text))
+
+    ## Write then rename, so an interrupted run never leaves a partial checkpoint behind
+    with open(checkpoint_file + ".tmp", "w") as f:
+        for subject_id, conditions in subject_id_to_conditions.items():
+            f.write(json.dumps({"SUBJECT_ID": subject_id, "CONDITIONS": list(conditions)}) + "\n")
+    os.replace(checkpoint_file + ".tmp", checkpoint_file)
+
+    return chunk_index
+
+
+def load_checkpoint(checkpoint_file):
+    with open(checkpoint_file) as f:
+        for line in f:
+            record = json.loads(line)
+            yield record["SUBJECT_ID"], set(tuple(x[:2]) + (tuple(x[2]),) for x in record["CONDITIONS"])
+
+
+def run_parallel(input_file, output_file, workers: int, chunk_size: int, checkpoint_dir: str):
+    """Local multi process version of `run`. Same output, for notes sorted by SUBJECT_ID.
+
+    Workers are forked after CDB / vocab are loaded, so they share the model. Notes are streamed to them in
+    chunks of `chunk_size` and each chunk's entities are checkpointed in `checkpoint_dir`. Rerunning with
+    the same arguments skips chunks that are already checkpointed. Chunk results are merged per subject in
+    order, and subjects are written out as soon as no later chunk can contain them.
+    """
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    meta_file = os.path.join(checkpoint_dir, "meta.json")
+    meta = {"input_file": os.path.abspath(input_file), "chunk_size": chunk_size}
+    if os.path.exists(meta_file):
+        with open(meta_file) as f:
+            assert json.load(f) == meta, f"{checkpoint_dir} has checkpoints for different input or chunk size"
+    else:
+        with open(meta_file, "w") as f:
+            json.dump(meta, f)
+
+    checkpoint_files = {}
+    subject_id_to_conditions = {}
+    next_chunk_to_merge = 0
+
+    output_dir = os.path.dirname(output_file)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    output = open(output_file, "w")
+
+    def merge_ready_chunks(last_subject_ids):
+        """Merge finished chunks in order, and write subjects that can't appear in later chunks"""
+        nonlocal next_chunk_to_merge
+        while next_chunk_to_merge in checkpoint_files:
+            for subject_id, conditions in load_checkpoint(checkpoint_files.pop(next_chunk_to_merge)):
+                subject_id_to_conditions.setdefault(subject_id, set()).update(conditions)
+
+            last_subject_id = last_subject_ids.pop(next_chunk_to_merge)
+            for subject_id in sorted(subject_id_to_conditions):
+                if subject_id >= last_subject_id:
+                    break
+                conditions = subject_id_to_conditions.pop(subject_id)
+                output.write(json.dumps({"SUBJECT_ID": subject_id, "CONDITIONS": list(conditions)}) + "\n")
+
+            next_chunk_to_merge += 1
+
+    ## Load model before forking, so workers share it
+    get_cat()
+
+    last_subject_ids, previous_last_subject_id = {}, None
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"))
+    with executor:
+        pending = set()
+        chunks = iterate_table(input_file, chunk_size, columns=["SUBJECT_ID", "TEXT"])
+        for chunk_index, chunk in enumerate(tqdm(chunks)):
+            assert (
+                previous_last_subject_id is None or chunk.SUBJECT_ID.min() >= previous_last_subject_id
+            ), "Notes need to be sorted by SUBJECT_ID"
+            previous_last_subject_id = last_subject_ids[chunk_index] = int(chunk.SUBJECT_ID.max())
+
+            checkpoint_file = os.path.join(checkpoint_dir, f"chunk-{chunk_index:06d}.jsonl")
+            if os.path.exists(checkpoint_file):
+                checkpoint_files[chunk_index] = checkpoint_file
+            else:
+                pending.add(
+                    executor.submit(
+                        process_chunk, chunk_index, chunk.SUBJECT_ID.values, chunk.TEXT.values, checkpoint_file
+                    )
+                )
+
+            ## Bound the number of chunks held in memory
+            while len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = future.result()
+                    checkpoint_files[index] = os.path.join(checkpoint_dir, f"chunk-{index:06d}.jsonl")
+
+            merge_ready_chunks(last_subject_ids)
+
+        for future in pending:
+            index = future.result()
+            checkpoint_files[index] = os.path.join(checkpoint_dir, f"chunk-{index:06d}.jsonl")
+
+    merge_ready_chunks(last_subject_ids)
+
+    for subject_id in sorted(subject_id_to_conditions):
+        conditions = subject_id_to_conditions[subject_id]
+        output.write(json.dumps({"SUBJECT_ID": subject_id, "CONDITIONS": list(conditions)}) + "\n")
+    output.close()
+
+
 parser = ArgumentParser()
 parser.add_argument("--input-file", required=True)
 parser.add_argument("--output-file", required=True)
 parser.add_argument("--distributed", action="store_true")
 parser.add_argument("--n-jobs", type=int)
 parser.add_argument("--job-num", type=int)
+parser.add_argument("--workers", type=int, help="Run locally with this many (forked) worker processes")
+parser.add_argument("--chunk-size", type=int, default=1000, help="Notes per chunk with --workers")
+parser.add_argument("--checkpoint-dir", help="Checkpoints with --workers (default: <output-file>.chunks)")
 
 
 if __name__ == "__main__":
@@ -86,4 +217,8 @@ if __name__ == "__main__":
     if args.distributed :
         assert "n_jobs" in args and "job_num" in args
 
-    run(args.input_file, args.output_file, args.distributed, args)
+    if args.workers is not None:
+        checkpoint_dir = args.checkpoint_dir if args.checkpoint_dir is not None else args.output_file + ".chunks"
+        run_parallel(args.input_file, args.output_file, args.workers, args.chunk_size, checkpoint_dir)
+    else:
+        run(args.input_file, args.output_file, args.distributed, args)
@@ -1,5 +1,7 @@
 import pandas as pd
 
+from setup_scripts.storage import OUTPUT_FORMATS, write_table
+
 
 def sample_first_name(first_name_file, num_samples):
     """Load the file and get a distribution of first names.
@@ -28,7 +30,7 @@ def sample_last_name(last_name_file, num_samples):
     return list(names.values)
 
 
-def run(input_file, output_file, first_name_f, last_name_f):
+def run(input_file, output_file, first_name_f, last_name_f, output_format="csv"):
     patients = pd.read_csv(input_file)
     patients = patients[["SUBJECT_ID", "GENDER"]]
 
@@ -47,7 +49,7 @@ def run(input_file, output_file, first_name_f, last_name_f):
     patients["FIRST_NAME"] = first_names
     patients["LAST_NAME"] = last_names
 
-    patients.sort_values(by="SUBJECT_ID").to_csv(output_file, index=False)
+    write_table(patients.sort_values(by="SUBJECT_ID"), output_file, output_format)
 
 
 from argparse import ArgumentParser
@@ -57,6 +59,7 @@ parser.add_argument("--input-file", required=True)
 parser.add_argument("--output-file", required=True)
 parser.add_argument("--first-name-f", default="data/yob1950.txt")
 parser.add_argument("--last-name-f", default="data/Names_2010Census.csv")
+parser.add_argument("--output-format", choices=OUTPUT_FORMATS, default="csv")
 
 if __name__ == "__main__":
     """
@@ -71,6 +74,6 @@ if __name__ == "__main__":
     """
 
     args = parser.parse_args()
-    run(args.input_file, args.output_file, args.first_name_f, args.last_name_f)
+    run(args.input_file, args.output_file, args.first_name_f, args.last_name_f, args.output_format)
 
     print(f"Saved Named to {args.output_file}")
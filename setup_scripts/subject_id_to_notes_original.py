@@ -1,11 +1,18 @@
 import os
+import csv
+import heapq
+import tempfile
 from argparse import ArgumentParser
 import pandas as pd
 
+from setup_scripts.storage import OUTPUT_FORMATS, import_csv, remove_columnar, write_table
+
 CATEGORIES_TO_USE = ["Physician ", "Nursing", "Nursing/other", "Discharge summary"]
+COLUMNS_TO_KEEP = ["SUBJECT_ID", "CATEGORY", "CHARTDATE", "CHARTTIME", "TEXT"]
+COLUMN_DTYPES = {"SUBJECT_ID": "int32", "CATEGORY": "category", "CHARTDATE": "category", "TEXT": "object"}
 
 
-def run(input_file, output_file):
+def run(input_file, output_file, output_format="csv"):
     notes_df = pd.read_csv(input_file)
     print(f"Loaded Data from CSV -- {len(notes_df)}")
 
@@ -15,15 +22,94 @@ def run(input_file, output_file):
 
     notes_df = notes_df[~notes_df.TEXT.isna()]
     notes_df = notes_df[notes_df.TEXT.apply(lambda x: len(x.strip()) > 0)]
-    notes_df = notes_df[["SUBJECT_ID", "CATEGORY", "CHARTDATE", "CHARTTIME", "TEXT"]].sort_values(by="SUBJECT_ID")
+    notes_df = notes_df[COLUMNS_TO_KEEP].sort_values(by="SUBJECT_ID")
 
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
-    notes_df.to_csv(output_file, index=False)
+    write_table(notes_df, output_file, output_format)
+
+
+def filter_chunk(notes_df: pd.DataFrame) -> pd.DataFrame:
+    """Keep rows in CATEGORIES_TO_USE with non empty TEXT. Vectorized version of the filters in `run`."""
+    notes_df = notes_df[notes_df.CATEGORY.isin(CATEGORIES_TO_USE)]
+    non_empty = notes_df.TEXT.notna() & (notes_df.TEXT.str.strip().str.len() > 0)
+    return notes_df[non_empty]
+
+
+def spill_run(buffer, run_dir, run_files):
+    """Sort the buffered chunks by SUBJECT_ID (stable) and write them as one sorted run to disk."""
+    run_df = pd.concat(buffer, ignore_index=True).sort_values(by="SUBJECT_ID", kind="mergesort")
+    run_file = os.path.join(run_dir, f"run_{len(run_files)}.csv")
+    run_df.to_csv(run_file, index=False)
+    run_files.append(run_file)
+    print(f"Spilled sorted run {len(run_files)} -- {len(run_df)} notes")
+
+
+def iterate_run(run_file, chunksize):
+    """Yield rows of a sorted run as (SUBJECT_ID, row values) without loading the whole run."""
+    reader = pd.read_csv(run_file, dtype=str, keep_default_na=False, chunksize=chunksize)
+    for chunk in reader:
+        for row in chunk.itertuples(index=False, name=None):
+            yield int(row[0]), row
+
+
+def run_streaming(input_file, output_file, chunksize, memory_budget_mb, output_format="csv"):
+    """Out of core version of `run`. Same output as `run`, but memory stays within memory_budget_mb.
+
+    NOTEEVENTS is read in chunks of `chunksize` rows (only COLUMNS_TO_KEEP, categorical dtypes) and filtered.
+    Filtered chunks are buffered until they exceed the budget, then sorted and spilled as a run to a
+    temporary directory next to the output. Finally, all runs are k-way merged on SUBJECT_ID.
+    Notes of same SUBJECT_ID keep their NOTEEVENTS order. For parquet output, the merged CSV is
+    then imported chunk by chunk.
+    """
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    memory_budget = memory_budget_mb * 1024 * 1024
+
+    reader = pd.read_csv(input_file, usecols=COLUMNS_TO_KEEP, dtype=COLUMN_DTYPES, chunksize=chunksize)
+
+    total, kept = 0, 0
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(output_file)) as run_dir:
+        run_files, buffer, buffer_size = [], [], 0
+        for chunk in reader:
+            total += len(chunk)
+            chunk = filter_chunk(chunk)[COLUMNS_TO_KEEP]
+            kept += len(chunk)
+
+            buffer.append(chunk)
+            buffer_size += chunk.memory_usage(deep=True).sum()
+            if buffer_size >= memory_budget:
+                spill_run(buffer, run_dir, run_files)
+                buffer, buffer_size = [], 0
+
+        if len(buffer) > 0:
+            spill_run(buffer, run_dir, run_files)
+
+        print(f"Loaded Data from CSV -- {total}")
+        print(f"Filtered to -- {kept}")
+
+        ## Each run gets an equal share of the budget for its read buffer
+        merge_chunksize = max(1, chunksize // max(1, len(run_files)))
+        runs = [iterate_run(run_file, merge_chunksize) for run_file in run_files]
+
+        with open(output_file, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(COLUMNS_TO_KEEP)
+            for _, row in heapq.merge(*runs, key=lambda x: x[0]):
+                writer.writerow(row)
+
+    if output_format == "parquet":
+        import_csv(output_file, chunksize)
+        os.remove(output_file)
+    else:
+        remove_columnar(output_file)
 
 
 parser = ArgumentParser()
 parser.add_argument("--input-file", required=True)
 parser.add_argument("--output-file", required=True)
+parser.add_argument("--streaming", action="store_true", help="Read NOTEEVENTS in chunks with bounded memory")
+parser.add_argument("--chunksize", type=int, default=100000, help="Rows per chunk in streaming mode")
+parser.add_argument("--memory-budget-mb", type=int, default=2048, help="Memory budget in streaming mode")
+parser.add_argument("--output-format", choices=OUTPUT_FORMATS, default="csv")
 
 
 if __name__ == "__main__":
@@ -33,7 +119,8 @@ if __name__ == "__main__":
     2. Remove any empty / na strings
     3. Sentencize the notes and then restructure them as \n.join[sentences]
     Usage:
-        - python subject_id_to_name.py --input-file NOTEEVENTS.csv --output-file SUBJECT_ID_to_NOTES_original.csv
+        - python subject_id_to_name.py --input-file NOTEEVENTS.csv --output-file SUBJECT_ID_to_NOTES_original.csv \
+            [--streaming --chunksize 100000 --memory-budget-mb 2048]
 
     Output Format:
         SUBJECT_ID,TEXT
@@ -45,4 +132,7 @@ if __name__ == "__main__":
     """
 
     args = parser.parse_args()
-    run(args.input_file, args.output_file)
+    if args.streaming:
+        run_streaming(args.input_file, args.output_file, args.chunksize, args.memory_budget_mb, args.output_format)
+    else:
+        run(args.input_file, args.output_file, args.output_format)
@@ -1,10 +1,12 @@
 from experiments.utilities import get_subject_id_to_patient_info, get_condition_code_to_descriptions
+from setup_scripts.storage import OUTPUT_FORMATS, write_table
 
 from argparse import ArgumentParser
 
 parser = ArgumentParser()
 parser.add_argument("--condition-type", required=True)
 parser.add_argument("--output-file", required=True)
+parser.add_argument("--output-format", choices=OUTPUT_FORMATS, default="csv")
 
 args = parser.parse_args()
 
@@ -31,4 +33,4 @@ import pandas as pd
 
 df = pd.DataFrame({"SUBJECT_ID": subject_ids, "TEXT": templates})
 
-df.to_csv(args.output_file, index=False)
+write_table(df, args.output_file, args.output_format)
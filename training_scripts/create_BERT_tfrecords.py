@@ -1,19 +1,16 @@
 from argparse import ArgumentParser
 
-import pandas as pd
 import os
-import numpy as np
 import subprocess
 
+from setup_scripts.note_store import add_note_source_arguments, iterate_note_chunks
 
-def run(input_file, output_dir, distributed, n_jobs, job_num):
-    df = pd.read_csv(input_file)
-
-    if distributed:
-        df = np.array_split(df, n_jobs)[job_num]
-
-    print(f"Loaded {len(df)} records -- {df.index.min()}-{df.index.max()}")
 
+def run(input_file, output_dir, distributed, n_jobs, job_num, index_file=None, input_names=None, variant=None):
+    """Write sentences of notes at `input_file` (or of `variant` read through span index `index_file`, see
+    setup_scripts/note_store.py) to a text file, then create BERT tfrecords from it.
+    With `distributed`, job `job_num` takes the notes of patients with SUBJECT_ID % n_jobs == job_num.
+    """
     tmp_file_for_sentences = f"{output_dir}/notes.sentences"
 
     if distributed :
@@ -22,11 +19,23 @@ def run(input_file, output_dir, distributed, n_jobs, job_num):
     if not(os.path.exists(tmp_file_for_sentences)):
         os.makedirs(os.path.dirname(tmp_file_for_sentences), exist_ok=True)
 
-        with open(tmp_file_for_sentences, "w") as tmp_file:
-            for sentences in df.TEXT.values:
-                if len(sentences) > 0:
-                    tmp_file.write(sentences.strip() + "\n")
-                tmp_file.write("\n")
+        num_records = 0
+        with open(tmp_file_for_sentences + ".tmp", "w") as tmp_file:
+            chunks = iterate_note_chunks(
+                input_file, index_file=index_file, input_names=input_names, variant=variant
+            )
+            for df in chunks:
+                if distributed:
+                    df = df[df.SUBJECT_ID % n_jobs == job_num]
+                num_records += len(df)
+
+                for sentences in df.TEXT.values:
+                    if len(sentences) > 0:
+                        tmp_file.write(sentences.strip() + "\n")
+                    tmp_file.write("\n")
+        os.replace(tmp_file_for_sentences + ".tmp", tmp_file_for_sentences)
+
+        print(f"Loaded {num_records} records")
 
     """
     Training Code for BERT
@@ -59,6 +68,16 @@ if __name__ == "__main__":
     parser.add_argument("--distributed", action="store_true")
     parser.add_argument("--n-jobs", type=int)
     parser.add_argument("--job-num", type=int)
+    add_note_source_arguments(parser)
     args = parser.parse_args()
 
-    run(args.input_file, args.output_dir, args.distributed, args.n_jobs, args.job_num)
+    run(
+        args.input_file,
+        args.output_dir,
+        args.distributed,
+        args.n_jobs,
+        args.job_num,
+        index_file=args.index_file,
+        input_names=args.input_names,
+        variant=args.variant,
+    )
@@ -4,10 +4,11 @@ import os
 import time
 
 import gensim
-import pandas as pd
 import spacy
 import glob
 
+from setup_scripts.note_store import add_note_source_arguments, iterate_note_chunks
+
 nlp = spacy.load("en_core_web_sm", disable=["tagger", "parser", "ner"])
 
 
@@ -51,10 +52,17 @@ def train_word_embeddings(args: argparse.Namespace):
     @param window_size is the window size of the model.
     @param model_save_name is where to save the model.
     """
-    all_notes = glob.glob(args.input_file)
+    all_notes = glob.glob(args.input_file) or [args.input_file]  ## CSV may only exist as parquet dataset
     all_sentences = []
     for note_f in all_notes:
-        notes = pd.read_csv(note_f).TEXT
+        ## With --index-file, notes are the --variant of original notes note_f, spliced on read
+        notes = [
+            note
+            for chunk in iterate_note_chunks(
+                note_f, index_file=args.index_file, input_names=args.input_names, variant=args.variant
+            )
+            for note in chunk.TEXT.values
+        ]
 
         print("Loaded Text")
         sentences = [sentence for note in notes for sentence in note.split("\n")]
@@ -95,6 +103,7 @@ if __name__ == "__main__":
     parser.add_argument("--embedding-size", help="How large are the word vectors?", default=200, type=int)
     parser.add_argument("--epochs", help="The number of epochs to train for.", default=10, type=int)
     parser.add_argument("--window-size", help="What window size to use.", default=6, type=int)
+    add_note_source_arguments(parser)
     args = parser.parse_args()
 
     train_word_embeddings(args)